@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# group-commit writer for tracker_data
+# uplinks are put on a bounded in-process queue, a background thread drains the
+# queue in batches (by size or max delay) and loads each batch with a single COPY
+# and a single commit, so ingest rate is no longer capped by one fsync per packet
+# COPY can't skip rows that are already there, so batches are copied into a
+# temporary staging table and moved into tracker_data with ON CONFLICT DO NOTHING,
+# a retried uplink is written once
+#
+# durability levels:
+# - "queued": submit() returns as soon as the row is on the queue
+#   (rows still in the queue are lost if the process dies)
+# - "committed": submit() waits until the batch holding the row has committed, or
+#   at most commit_timeout seconds
+
+import io
+import os
+import sys
+import time
+import queue
+import threading
+import collections
+import psycopg2
+
+# per connection staging table for COPY, also used by /push in flask-apiserver
+STAGE_SQL = """CREATE TEMPORARY TABLE IF NOT EXISTS tracker_data_stage (LIKE tracker_data INCLUDING DEFAULTS);"""
+
+COPY_SQL = """COPY tracker_data_stage (gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location)
+FROM STDIN"""
+
+# empty the staging table into tracker_data, skipping rows whose natural key
+# (gw_id, dev_eui, gw_rx_timestamp) is already there, returns the rows that were inserted
+# no conflict target, so this also works before the unique index has been created
+MERGE_SQL = """WITH staged AS (DELETE FROM tracker_data_stage RETURNING *)
+INSERT INTO tracker_data (gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location)
+SELECT gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location FROM staged
+ON CONFLICT DO NOTHING
+RETURNING gw_id, dev_eui, gw_rx_timestamp;"""
+
+# used one row at a time when a whole batch is rejected, so one bad row can't block the queue
+INSERT_SQL = """INSERT INTO tracker_data (gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location)
+VALUES (%s, ST_SetSRID(st_makepoint(%s,%s,%s),4326), %s, %s, %s, %s, %s, %s, ST_SetSRID(st_makepoint(%s,%s,%s),4326))
+ON CONFLICT DO NOTHING;"""
+
+DURABILITY = ('queued', 'committed')
+
+# raised by submit() when the queue stays full for longer than the submit timeout
+class QueueFull(Exception):
+    pass
+
+# raised by submit() in "committed" mode when the row could not be written, or
+# wasn't committed within commit_timeout (it may still be written later)
+class WriteFailed(Exception):
+    pass
+
+# a row waiting in the queue, plus what submit() needs to wait for its commit
+class _Pending(object):
+    __slots__ = ('row', 'submitted', 'done', 'error', 'inserted')
+    def __init__(self, row, wait):
+        self.row = row
+        self.submitted = time.monotonic()
+        self.done = threading.Event() if wait else None
+        self.error = None
+        self.inserted = False # False if the row was already in tracker_data
+
+# escape a value for COPY text format
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+# row layout is the same as the uplink insert parameters:
+# (gw_id, gw_lon, gw_lat, gw_alt, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, lon, lat, alt)
+# every field is escaped, so a value that isn't the number it should be fails its row
+# instead of adding columns or rows
+def copy_line(row):
+    return '\t'.join(copy_value(value) for value in (
+        row[0], 'SRID=4326;POINT Z({} {} {})'.format(row[1], row[2], row[3]),
+        row[4], row[5], row[6].isoformat(), row[7], row[8], row[9].isoformat(),
+        'SRID=4326;POINT Z({} {} {})'.format(row[10], row[11], row[12]),
+    )) + '\n'
+
+class BatchWriter(object):
+    def __init__(self, connect, batch_size=500, max_delay=0.2, queue_size=10000, durability='committed', submit_timeout=5, stats_interval=60, commit_timeout=60):
+        if durability not in DURABILITY:
+            raise ValueError('durability must be one of {}'.format(', '.join(DURABILITY)))
+        self.connect = connect # callable returning a new psycopg2 connection
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue_size = queue_size
+        self.durability = durability
+        self.submit_timeout = submit_timeout
+        self.commit_timeout = commit_timeout
+        self.stats_interval = stats_interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.dbconn = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.ack_latency = collections.deque(maxlen=10000)
+        self.batch_rows = collections.deque(maxlen=1000)
+        self.commit_time = collections.deque(maxlen=1000)
+        self.rows_written = 0
+        self.rows_skipped = 0
+        self.rows_failed = 0
+        self.commits = 0
+
+    # start the writer thread in this process
+    # passenger forks after import, so this happens on first submit, not at import time
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue_size)
+            self.dbconn = None
+            self._reset_stats()
+            self.thread = threading.Thread(target=self._run, name='batchwriter', daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    # queue a row, and for "committed" durability wait for it to be committed
+    # returns True if the row was inserted and False if it was already there, or
+    # None for "queued" durability
+    def submit(self, row):
+        if self.pid != os.getpid():
+            self._start()
+        pending = _Pending(row, self.durability == 'committed')
+        try:
+            self.queue.put(pending, timeout=self.submit_timeout)
+        except queue.Full:
+            raise QueueFull()
+        if pending.done is not None:
+            if not pending.done.wait(self.commit_timeout):
+                raise WriteFailed('not committed within {}s'.format(self.commit_timeout))
+            if pending.error is not None:
+                raise WriteFailed(pending.error)
+        self.ack_latency.append(time.monotonic() - pending.submitted)
+        if pending.done is None:
+            return None
+        return pending.inserted
+
+    def _run(self):
+        last_stats = time.monotonic()
+        while True:
+            try:
+                first = self.queue.get(timeout=self.stats_interval)
+            except queue.Empty:
+                first = None
+            if first is not None:
+                batch = [first]
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                self._flush(batch)
+            if self.stats_interval and time.monotonic() - last_stats >= self.stats_interval:
+                last_stats = time.monotonic()
+                self._print_stats()
+
+    # never raises, so the writer thread keeps running and every waiting submit() is
+    # woken up whatever happens to its batch
+    def _flush(self, batch):
+        started = time.monotonic()
+        try:
+            try:
+                self._copy(batch)
+                failed = []
+            except psycopg2.Error as e:
+                print('batchwriter: COPY of {} rows failed, retrying row by row: {}'.format(len(batch), e), file=sys.stderr)
+                self._discard_connection()
+                failed = self._insert_each(batch)
+        except Exception as e:
+            # not a database error, eg. a row that can't be formatted, fail the whole batch
+            print('batchwriter: dropped batch of {} rows: {!r}'.format(len(batch), e), file=sys.stderr)
+            self._discard_connection()
+            for pending in batch:
+                if pending.error is None and not pending.inserted:
+                    pending.error = repr(e)
+            failed = [pending for pending in batch if pending.error is not None]
+        finally:
+            for pending in batch:
+                if pending.done is not None:
+                    pending.done.set()
+        inserted = sum(1 for pending in batch if pending.inserted)
+        self.commit_time.append(time.monotonic() - started)
+        self.batch_rows.append(len(batch) - len(failed))
+        self.rows_written += inserted
+        self.rows_skipped += len(batch) - len(failed) - inserted
+        self.rows_failed += len(failed)
+        self.commits += 1
+
+    def _get_connection(self):
+        if self.dbconn is None or self.dbconn.closed:
+            self.dbconn = self.connect()
+            self.dbconn.autocommit = False
+            cur = self.dbconn.cursor()
+            cur.execute(STAGE_SQL)
+            self.dbconn.commit()
+        return self.dbconn
+
+    def _discard_connection(self):
+        if self.dbconn is not None:
+            try:
+                self.dbconn.close()
+            except psycopg2.Error:
+                pass
+        self.dbconn = None
+
+    def _copy(self, batch):
+        dbconn = self._get_connection()
+        buf = io.StringIO(''.join(copy_line(pending.row) for pending in batch))
+        try:
+            cur = dbconn.cursor()
+            cur.copy_expert(COPY_SQL, buf)
+            cur.execute(MERGE_SQL)
+            inserted = collections.Counter(cur.fetchall())
+            dbconn.commit()
+        except psycopg2.Error:
+            dbconn.rollback()
+            raise
+        # a row that is in the batch twice is only inserted once
+        for pending in batch:
+            key = (pending.row[0], pending.row[5], pending.row[6])
+            if inserted[key] > 0:
+                inserted[key] -= 1
+                pending.inserted = True
+
+    # fall back to one INSERT and commit per row, returns the rows that failed
+    def _insert_each(self, batch):
+        failed = []
+        for pending in batch:
+            try:
+                dbconn = self._get_connection()
+                cur = dbconn.cursor()
+                cur.execute(INSERT_SQL, pending.row)
+                pending.inserted = cur.rowcount == 1
+                dbconn.commit()
+            except psycopg2.Error as e:
+                print('batchwriter: dropped row {}: {}'.format(pending.row, e), file=sys.stderr)
+                self._discard_connection()
+                pending.error = str(e)
+                failed.append(pending)
+        return failed
+
+    def stats(self):
+        latency = sorted(self.ack_latency)
+        commit_time = list(self.commit_time)
+        batch_rows = list(self.batch_rows)
+        def percentile(values, p):
+            if len(values) == 0:
+                return None
+            return round(values[min(len(values) - 1, int(len(values) * p / 100))], 6)
+        return {
+            'durability': self.durability,
+            'batch_size': self.batch_size,
+            'max_delay': self.max_delay,
+            'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+            'rows_written': self.rows_written,
+            'rows_skipped': self.rows_skipped,
+            'rows_failed': self.rows_failed,
+            'commits': self.commits,
+            'rows_per_commit': round(sum(batch_rows) / len(batch_rows), 1) if len(batch_rows) > 0 else None,
+            'rows_per_second': round(sum(batch_rows) / sum(commit_time), 1) if sum(commit_time) > 0 else None,
+            'ack_latency_p50': percentile(latency, 50),
+            'ack_latency_p99': percentile(latency, 99),
+        }
+
+    def _print_stats(self):
+        stats = self.stats()
+        if stats['commits'] == 0:
+            return
+        print('batchwriter: {rows_written} rows ({rows_skipped} duplicates skipped) in {commits} commits, {rows_per_commit} rows/commit, {rows_per_second} rows/s while writing, ack p50={ack_latency_p50}s p99={ack_latency_p99}s, queue={queue_depth}'.format(**stats), file=sys.stderr)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# micro-benchmark of uplink payload decoding
+# compares the original int.from_bytes/strptime code from the API servers with
+# uplinkdecode.decode_payload() and the numpy uplinkdecode.decode_batch()
+
+import argparse
+parser = argparse.ArgumentParser(description='Uplink decode benchmark')
+
+parser.add_argument('-n', '--count',
+                    type=int,
+                    default=100000,
+                    help='Number of payloads to decode per run (default 100000)',
+)
+
+parser.add_argument('-r', '--repeat',
+                    type=int,
+                    default=5,
+                    help='Number of runs, the best one is reported (default 5)',
+)
+
+args = parser.parse_args()
+
+import base64
+import random
+import timeit
+import datetime
+import uplinkdecode
+
+# the decode as it was copy-pasted in apiserver.py and lora-apiserver.py
+def legacy_decode(data):
+    uplink_data = base64.decodebytes(data.encode())
+    f_lat = int.from_bytes(uplink_data[0:4], byteorder='big', signed=True) / 1000000
+    f_lon = int.from_bytes(uplink_data[4:8], byteorder='big', signed=True) / 1000000
+    f_alt = int.from_bytes(uplink_data[8:12], byteorder='big', signed=True) / 100
+    gps_date = int.from_bytes(uplink_data[12:16], byteorder='big', signed=False)
+    gps_time = int.from_bytes(uplink_data[16:20], byteorder='big', signed=False)
+    if gps_time == 0:
+        gps_timestamp = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+    else:
+        gps_timestamp = datetime.datetime.strptime("{0:0>6} {1:0>8}".format(gps_date, gps_time), '%d%m%y %H%M%S%f').replace(tzinfo=datetime.timezone.utc)
+    return (f_lat, f_lon, f_alt, gps_timestamp)
+
+def new_decode(data):
+    return uplinkdecode.decode_payload(base64.b64decode(data))
+
+# random but valid tracker payloads
+random.seed(1)
+payloads = []
+for i in range(args.count):
+    ts = datetime.datetime(2019, 1, 1) + datetime.timedelta(seconds=random.randrange(365 * 86400), microseconds=random.randrange(100) * 10000)
+    raw = uplinkdecode.PAYLOAD.pack(
+        random.randrange(-90000000, 90000000),
+        random.randrange(-180000000, 180000000),
+        random.randrange(-10000, 1000000),
+        int(ts.strftime('%d%m%y')),
+        int(ts.strftime('%H%M%S')) * 100 + ts.microsecond // 10000,
+    )
+    payloads.append(base64.b64encode(raw).decode())
+
+# make sure they agree before timing them
+for p in payloads[:1000]:
+    assert legacy_decode(p) == new_decode(p), p
+if uplinkdecode.numpy is not None:
+    batch = uplinkdecode.decode_batch(payloads[:1000])
+    for i, p in enumerate(payloads[:1000]):
+        lat, lon, alt, ts = legacy_decode(p)
+        assert (batch['lat'][i], batch['lon'][i], batch['alt'][i]) == (lat, lon, alt), p
+        assert batch['gps_timestamp'][i] == uplinkdecode.numpy.datetime64(ts.replace(tzinfo=None)), p
+
+def report(name, seconds):
+    print('{:<24} {:>10.3f} ms/run {:>10.3f} us/payload {:>12.0f} payloads/s'.format(name, seconds * 1000, seconds * 1000000 / args.count, args.count / seconds))
+
+baseline = min(timeit.repeat(lambda: [legacy_decode(p) for p in payloads], number=1, repeat=args.repeat))
+report('legacy strptime', baseline)
+single = min(timeit.repeat(lambda: [new_decode(p) for p in payloads], number=1, repeat=args.repeat))
+report('decode_payload', single)
+if uplinkdecode.numpy is not None:
+    batch = min(timeit.repeat(lambda: uplinkdecode.decode_batch(payloads), number=1, repeat=args.repeat))
+    report('decode_batch (numpy)', batch)
+else:
+    print('numpy not installed, skipping decode_batch')
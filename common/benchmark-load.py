@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# load test of the API servers
+# drives each endpoint in turn from --concurrency keep-alive connections for
+# --duration seconds with realistic loraserver uplinks and sync rows, and reports
+# requests/s, rows/s and p50/p95/p99 latency per endpoint
+# the server is started here (flask-apiserver or simple-apiserver against the database
+# in their usual configuration), or already running at --url, or a stand-in that
+# answers with recorded responses, to check the client side without a database, eg.
+# benchmark-load.py -s flask                              flask-apiserver with its local_config.json
+# benchmark-load.py -s lora -- -b                         lora-apiserver.py in batch mode (/uplink only)
+# benchmark-load.py -u http://gw1.example -e pull         a server that is already running
+# benchmark-load.py -s flask --record responses.json      then
+# benchmark-load.py -s standin --responses responses.json
+# results are saved as JSON with --output, --baseline compares a run with an earlier one
+
+import argparse
+parser = argparse.ArgumentParser(description='API server load test')
+
+parser.add_argument('-s', '--server',
+                    type=str,
+                    choices=['none', 'flask', 'lora', 'standin'],
+                    default='none',
+                    help='Server to start for the test, none to test --url (default none)',
+)
+
+parser.add_argument('-u', '--url',
+                    type=str,
+                    default='http://127.0.0.1:8088',
+                    help='Server to test with --server none (default http://127.0.0.1:8088)',
+)
+
+parser.add_argument('-p', '--port',
+                    type=int,
+                    default=8089,
+                    help='TCP port for a started server (default 8089)',
+)
+
+parser.add_argument('-e', '--endpoints',
+                    type=str,
+                    default=None,
+                    help='Comma separated endpoints to test in order, of {} (default all but gwarea, uplink only for lora)'.format(','.join(('uplink', 'push', 'pull', 'gwlocation', 'trlocation', 'gwarea', 'gwlatest'))),
+)
+
+parser.add_argument('-c', '--concurrency',
+                    type=int,
+                    default=8,
+                    help='Concurrent connections (default 8)',
+)
+
+parser.add_argument('-t', '--duration',
+                    type=float,
+                    default=10,
+                    help='Seconds to drive each endpoint for (default 10)',
+)
+
+parser.add_argument('-w', '--warmup',
+                    type=float,
+                    default=2,
+                    help='Seconds to drive each endpoint for before measuring (default 2)',
+)
+
+parser.add_argument('-g', '--gateways',
+                    type=int,
+                    default=10,
+                    help='Number of simulated gateways (default 10)',
+)
+
+parser.add_argument('-T', '--trackers',
+                    type=int,
+                    default=100,
+                    help='Number of simulated trackers (default 100)',
+)
+
+parser.add_argument('--uplinks',
+                    type=str,
+                    default=None,
+                    help='Send the uplinks in this file (eg. from simulate-data.py --output ndjson) instead of random ones, with the current time',
+)
+
+parser.add_argument('--push-rows',
+                    type=int,
+                    default=500,
+                    help='Rows per /push request (default 500)',
+)
+
+parser.add_argument('--pull-limit',
+                    type=int,
+                    default=2000,
+                    help='?limit for /pull requests (default 2000)',
+)
+
+parser.add_argument('-o', '--output',
+                    type=str,
+                    default=None,
+                    help='Save the results to this JSON file',
+)
+
+parser.add_argument('-B', '--baseline',
+                    type=str,
+                    default=None,
+                    help='Compare the results with this earlier --output file',
+)
+
+parser.add_argument('--record',
+                    type=str,
+                    default=None,
+                    help='Save the first successful response of each endpoint to this JSON file, for --server standin',
+)
+
+parser.add_argument('--responses',
+                    type=str,
+                    default=None,
+                    help='Responses for --server standin from --record (default built in examples)',
+)
+
+parser.add_argument('--server-log',
+                    type=str,
+                    default=None,
+                    help='Write the output of a started server to this file (default discard it)',
+)
+
+parser.add_argument('server_args',
+                    nargs='*',
+                    help='Extra arguments for a started server, after --',
+)
+
+args = parser.parse_args()
+
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import socket
+import datetime
+import threading
+import subprocess
+import collections
+import http.client
+import http.server
+import urllib.parse
+import multiprocessing
+import uplinkdecode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+UTC = datetime.timezone.utc
+
+ENDPOINTS = ('uplink', 'push', 'pull', 'gwlocation', 'trlocation', 'gwarea', 'gwlatest')
+
+# /gwarea needs GATEWAYRADIUS set, so it is only tested when asked for
+DEFAULT_ENDPOINTS = ('uplink', 'push', 'pull', 'gwlocation', 'trlocation', 'gwlatest')
+
+# what --server standin answers without --responses, shaped like the real responses
+STANDIN_RESPONSES = {
+    'uplink': {'status': 200, 'content_type': 'application/json', 'body': '{"inserted":1,"skipped":0}'},
+    'push': {'status': 200, 'content_type': 'application/json', 'body': '{"inserted":500,"skipped":0}'},
+    'pull': {'status': 200, 'content_type': 'application/json', 'body': json.dumps([
+        ['0123456789abcdef', 'SRID=4326;POINT Z(144.96 -37.81 41)', 1, 'fedcba9876543210', '2019-01-03T22:48:16.080583+00:00', -110, -3.5, '2019-01-03T22:48:16+00:00', 'SRID=4326;POINT Z(144.97 -37.82 0)'],
+    ] * 100)},
+    'gwlocation': {'status': 200, 'content_type': 'application/json', 'body': json.dumps({
+        '{:016x}'.format(i): {'type': 'Point', 'coordinates': [144.96, -37.81, 41]} for i in range(10)
+    })},
+    'trlocation': {'status': 200, 'content_type': 'application/json', 'body': json.dumps({
+        '{:016x}'.format(i): {'type': 'Point', 'coordinates': [144.97, -37.82, 0]} for i in range(100)
+    })},
+    'gwarea': {'status': 200, 'content_type': 'application/json', 'body': json.dumps({
+        'ffffffffffffffff': {'type': 'Polygon', 'coordinates': [[[144.95, -37.82], [144.97, -37.82], [144.97, -37.80], [144.95, -37.80], [144.95, -37.82]]]},
+    })},
+    'gwlatest': {'status': 200, 'content_type': 'application/json', 'body': json.dumps({
+        '{:016x}'.format(i): '2019-01-03T22:48:16.080583+0000' for i in range(10)
+    })},
+}
+
+# the first path component of a request is the endpoint name
+def endpoint_name(path):
+    return urllib.parse.urlsplit(path).path.split('/')[1]
+
+# answers every request to an endpoint with the same recorded response, after
+# reading the whole request like a real server would
+def serve_standin(port, responses):
+    class StandinHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately, don't wait for delayed ACKs between them
+        disable_nagle_algorithm = True
+
+        def respond(self):
+            length = int(self.headers.get('Content-Length', 0))
+            if length > 0:
+                self.rfile.read(length)
+            response = responses.get(endpoint_name(self.path))
+            if response is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = response['body'].encode()
+            self.send_response(response['status'])
+            self.send_header('Content-Type', response['content_type'])
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = respond
+        do_POST = respond
+
+        def log_message(self, format, *args):
+            pass
+
+    http.server.ThreadingHTTPServer(('127.0.0.1', port), StandinHandler).serve_forever()
+
+# a server subprocess.Popen or multiprocessing.Process has exited
+def exited(process):
+    if isinstance(process, subprocess.Popen):
+        return process.poll() is not None
+    return not process.is_alive()
+
+# wait until something accepts connections on port, or the process has exited
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if exited(process):
+            raise RuntimeError('server exited before it started listening')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server not listening on port {} after {}s'.format(port, timeout))
+
+# random gateways and trackers around Melbourne, and request bodies for each endpoint
+class Workload(object):
+    def __init__(self, gateways, trackers, push_rows, pull_limit, uplinks=None):
+        rng = random.Random(1)
+        self.gateways = [
+            ('{:016x}'.format(rng.getrandbits(64)), round(144.96 + rng.uniform(-0.2, 0.2), 6), round(-37.81 + rng.uniform(-0.2, 0.2), 6), float(rng.randrange(0, 100)))
+            for i in range(gateways)
+        ]
+        self.trackers = ['{:016x}'.format(rng.getrandbits(64)) for i in range(trackers)]
+        self.push_rows = push_rows
+        self.pull_limit = pull_limit
+        self.started = datetime.datetime.now(UTC)
+        self.uplinks = uplinks
+        self.uplink_count = 0
+        self.lock = threading.Lock()
+        self.last = self.started
+
+    # the current time, never the same twice, so no uplink or pushed row is a duplicate
+    def clock(self, count=1):
+        with self.lock:
+            now = max(datetime.datetime.now(UTC), self.last + datetime.timedelta(microseconds=1))
+            self.last = now + datetime.timedelta(microseconds=count - 1)
+        return now
+
+    def row(self, ts):
+        gw_id, gw_lon, gw_lat, gw_alt = random.choice(self.gateways)
+        return (
+            gw_id, gw_lon, gw_lat, gw_alt, 1, random.choice(self.trackers), ts,
+            random.randrange(-130, -60), random.randrange(-80, 40) / 4, ts.replace(microsecond=0),
+            round(gw_lon + random.uniform(-0.05, 0.05), 6), round(gw_lat + random.uniform(-0.05, 0.05), 6), random.randrange(0, 10000) / 100,
+        )
+
+    # (method, path, body, rows sent) for a request to endpoint
+    def request(self, endpoint):
+        if endpoint == 'uplink':
+            if self.uplinks is not None:
+                with self.lock:
+                    uplink = self.uplinks[self.uplink_count % len(self.uplinks)]
+                    self.uplink_count += 1
+                uplink = dict(uplink, rxInfo=[dict(uplink['rxInfo'][0], time=self.clock().strftime('%Y-%m-%dT%H:%M:%S.%fZ'))])
+            else:
+                uplink = uplinkdecode.encode_uplink(self.row(self.clock()))
+            return ('POST', '/uplink', json.dumps(uplink).encode(), 1)
+        if endpoint == 'push':
+            # the /pull row layout, with locations as EWKT
+            start = self.clock(self.push_rows)
+            body = []
+            for i in range(self.push_rows):
+                r = self.row(start + datetime.timedelta(microseconds=i))
+                body.append([
+                    r[0], 'SRID=4326;POINT Z({} {} {})'.format(r[1], r[2], r[3]), r[4], r[5], r[6].isoformat(), r[7], r[8], r[9].isoformat(),
+                    'SRID=4326;POINT Z({} {} {})'.format(r[10], r[11], r[12]),
+                ])
+            return ('POST', '/push', json.dumps(body).encode(), self.push_rows)
+        if endpoint == 'pull':
+            # everything received by the simulated gateways since an hour before the test
+            since = (self.started - datetime.timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S.%f%z')
+            body = {gw[0]: since for gw in self.gateways}
+            return ('POST', '/pull?limit={}'.format(self.pull_limit), json.dumps(body).encode(), None)
+        if endpoint == 'gwarea':
+            return ('GET', '/gwarea/mid', None, None)
+        if endpoint == 'gwlatest':
+            return ('GET', '/gwlatest', None, None)
+        return ('GET', '/{}/all'.format(endpoint), None, None)
+
+# rows in a /pull response, not counting the continuation token
+def pull_rows(body):
+    try:
+        rows = json.loads(body.decode())
+    except ValueError:
+        return 0
+    return len([r for r in rows if isinstance(r, list)])
+
+# nearest rank percentile of sorted values, like BatchWriter.stats()
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# runs every request to one endpoint for seconds from each of concurrency threads
+# returns a list of (latency seconds, status, rows) and the seconds it took
+def drive(url, workload, endpoint, concurrency, seconds, recorded=None):
+    results = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def connect():
+        if url.scheme == 'https':
+            return http.client.HTTPSConnection(url.hostname, url.port, timeout=30)
+        return http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+
+    def worker():
+        conn = connect()
+        local = []
+        while time.monotonic() < deadline:
+            method, path, body, rows = workload.request(endpoint)
+            # the read endpoints only answer requests with a JSON content type
+            headers = {'Content-Type': 'application/json'}
+            start = time.monotonic()
+            try:
+                conn.request(method, url.path.rstrip('/') + path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                conn = connect()
+                status = type(e).__name__
+                data = b''
+            latency = time.monotonic() - start
+            if endpoint == 'pull' and status == 200:
+                rows = pull_rows(data)
+            if recorded is not None and isinstance(status, int) and 200 <= status < 300 and endpoint not in recorded:
+                with lock:
+                    recorded.setdefault(endpoint, {'status': status, 'content_type': response.getheader('Content-Type', 'application/json'), 'body': data.decode()})
+            local.append((latency, status, rows))
+        conn.close()
+        with lock:
+            results.extend(local)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (results, time.monotonic() - started)
+
+def summarise(results, seconds):
+    latency = sorted(r[0] for r in results if r[1] in (200, 204, 304))
+    statuses = collections.Counter(str(r[1]) for r in results)
+    rows = sum(r[2] for r in results if r[1] in (200, 204) and r[2] is not None)
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': len(results),
+        'errors': len(results) - len(latency),
+        'statuses': dict(statuses),
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(len(latency) / seconds, 1) if seconds > 0 else None,
+        'rows_per_second': round(rows / seconds, 1) if seconds > 0 and rows > 0 else None,
+        'latency_ms_p50': ms(percentile(latency, 50)),
+        'latency_ms_p95': ms(percentile(latency, 95)),
+        'latency_ms_p99': ms(percentile(latency, 99)),
+        'latency_ms_max': ms(latency[-1] if len(latency) > 0 else None),
+    }
+
+def report(endpoint, stats):
+    print('{:<12} {:>8} req {:>6} err {:>10} req/s {:>10} rows/s   p50 {:>9} ms  p95 {:>9} ms  p99 {:>9} ms  {}'.format(
+        endpoint, stats['requests'], stats['errors'], stats['requests_per_second'], stats['rows_per_second'] or '-',
+        stats['latency_ms_p50'], stats['latency_ms_p95'], stats['latency_ms_p99'],
+        ' '.join('{}:{}'.format(status, count) for status, count in sorted(stats['statuses'].items())),
+    ))
+
+# per cent change from old to new
+def change(old, new):
+    if old is None or new is None or old == 0:
+        return '    n/a'
+    return '{:>+6.1f}%'.format((new - old) * 100 / old)
+
+def compare(baseline, results):
+    print('compared with {} ({})'.format(args.baseline, baseline.get('started')))
+    for endpoint, stats in results['endpoints'].items():
+        old = baseline['endpoints'].get(endpoint)
+        if old is None:
+            continue
+        print('{:<12} req/s {:>10} -> {:>10} {}   p95 {:>9} -> {:>9} ms {}   p99 {:>9} -> {:>9} ms {}'.format(
+            endpoint,
+            old['requests_per_second'], stats['requests_per_second'], change(old['requests_per_second'], stats['requests_per_second']),
+            old['latency_ms_p95'], stats['latency_ms_p95'], change(old['latency_ms_p95'], stats['latency_ms_p95']),
+            old['latency_ms_p99'], stats['latency_ms_p99'], change(old['latency_ms_p99'], stats['latency_ms_p99']),
+        ))
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if args.endpoints is not None:
+    endpoints = args.endpoints.split(',')
+elif args.server == 'lora':
+    endpoints = ['uplink']
+else:
+    endpoints = list(DEFAULT_ENDPOINTS)
+for endpoint in endpoints:
+    if endpoint not in ENDPOINTS:
+        parser.error('unknown endpoint {}'.format(endpoint))
+
+uplinks = None
+if args.uplinks is not None:
+    with open(args.uplinks) as f:
+        uplinks = [json.loads(line) for line in f if line.strip() != '']
+
+# start the server
+server = None
+log = None
+url = args.url
+if args.server != 'none':
+    url = 'http://127.0.0.1:{}'.format(args.port)
+    log = open(args.server_log or os.devnull, 'w')
+    if args.server == 'flask':
+        # flask's own threaded server, for numbers closer to production run the app
+        # under its real WSGI server and use --url
+        env = dict(os.environ, FLASK_APP='apiserver.py')
+        server = subprocess.Popen([sys.executable, '-m', 'flask', 'run', '--with-threads', '--port', str(args.port)] + args.server_args,
+            cwd=os.path.join(HERE, '..', 'flask-apiserver'), env=env, stdout=log, stderr=subprocess.STDOUT)
+    elif args.server == 'lora':
+        server = subprocess.Popen([sys.executable, 'lora-apiserver.py', '-p', str(args.port)] + args.server_args,
+            cwd=os.path.join(HERE, '..', 'simple-apiserver'), stdout=log, stderr=subprocess.STDOUT)
+    else:
+        responses = STANDIN_RESPONSES
+        if args.responses is not None:
+            with open(args.responses) as f:
+                responses = dict(STANDIN_RESPONSES, **json.load(f))
+        server = multiprocessing.Process(target=serve_standin, args=(args.port, responses), daemon=True)
+        server.start()
+    print('started {} server: {}'.format(args.server, url if args.server == 'standin' else ' '.join(shlex.quote(a) for a in server.args)))
+    wait_for_port(args.port, server)
+
+workload = Workload(args.gateways, args.trackers, args.push_rows, args.pull_limit, uplinks)
+recorded = {} if args.record is not None else None
+results = {
+    'started': datetime.datetime.now(UTC).isoformat(),
+    'revision': revision(),
+    'server': args.server,
+    'server_args': args.server_args,
+    'url': url,
+    'concurrency': args.concurrency,
+    'duration': args.duration,
+    'gateways': args.gateways,
+    'trackers': args.trackers,
+    'push_rows': args.push_rows,
+    'pull_limit': args.pull_limit,
+    'endpoints': {},
+}
+try:
+    for endpoint in endpoints:
+        if args.warmup > 0:
+            drive(urllib.parse.urlsplit(url), workload, endpoint, args.concurrency, args.warmup)
+        stats = summarise(*drive(urllib.parse.urlsplit(url), workload, endpoint, args.concurrency, args.duration, recorded))
+        results['endpoints'][endpoint] = stats
+        report(endpoint, stats)
+finally:
+    if isinstance(server, subprocess.Popen):
+        server.terminate()
+        server.wait()
+    elif server is not None:
+        server.terminate()
+        server.join()
+    if log is not None:
+        log.close()
+
+if args.output is not None:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+if args.record is not None:
+    with open(args.record, 'w') as f:
+        json.dump(recorded, f, indent=2)
+if args.baseline is not None:
+    with open(args.baseline) as f:
+        compare(json.load(f), results)
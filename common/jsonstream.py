@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# incremental parser for a top-level JSON array read from a file-like stream
+# yields one decoded element at a time, so only the current element and one read
+# buffer are held in memory instead of the whole request body
+
+import json
+import codecs
+
+WHITESPACE = ' \t\n\r'
+NUMBER = '0123456789+-.eE'
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def iterarray(stream, read_size=65536):
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    # multi-byte UTF-8 characters may be split across reads
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    # top up the buffer from the stream, returns False at end of stream
+    def fill():
+        nonlocal buf, pos, eof
+        data = stream.read(read_size)
+        if not data:
+            eof = True
+            return False
+        if isinstance(data, bytes):
+            data = utf8.decode(data)
+        buf = buf[pos:] + data
+        pos = 0
+        return True
+
+    # skip whitespace and return the next character without consuming it
+    def peek():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                return None
+
+    if peek() != '[':
+        raise ValueError('expected JSON array')
+    pos += 1
+    if peek() == ']':
+        return
+    while True:
+        if peek() is None:
+            raise ValueError('unterminated JSON array')
+        # raw_decode fails on a truncated element, read more and try again
+        while True:
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+                if eof or not is_number(element):
+                    break
+                # a number running up to the end of the buffer may continue in the
+                # next read, even when raw_decode stopped short of it ("2.5" of "2.5e")
+                i = end
+                while i < len(buf) and buf[i] in NUMBER:
+                    i += 1
+                if i < len(buf):
+                    break
+            except ValueError:
+                if eof:
+                    raise
+            if not fill():
+                element, end = decoder.raw_decode(buf, pos)
+                break
+        pos = end
+        yield element
+        c = peek()
+        if c == ',':
+            pos += 1
+        elif c == ']':
+            return
+        else:
+            raise ValueError('expected , or ] in JSON array')
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# tests for jsonstream.iterarray()
+# run with python3 -m unittest test_jsonstream (or pytest) from this directory
+# every input is parsed at every read size, so each element and token is split
+# across reads at every possible place
+
+import io
+import json
+import unittest
+import jsonstream
+
+VALID = [
+    '[]',
+    '[2.5e3, [1,2]]',
+    '[1, 23, -4.5E-2, 0, 100000000000000000000]',
+    '[12]',
+    ' [ "a,]b" , true , false , null ] ',
+    '[{"x": [1.5, {"y": "\\u00e9"}]}, "é中"]',
+    '[["0123456789abcdef", "SRID=4326;POINT Z(144.96 -37.81 41)", 1, "fedcba9876543210", "2019-01-03T22:48:16.080583+00:00", -110, -3.5]]',
+]
+
+INVALID = [
+    '',
+    '{}',
+    '[',
+    '[1',
+    '[1,',
+    '[1 2]',
+    '[2.5e]',
+    '[2.5x]',
+    '[1.]',
+    '[tru]',
+]
+
+def parse(text, read_size):
+    return list(jsonstream.iterarray(io.BytesIO(text.encode()), read_size))
+
+class IterArrayTest(unittest.TestCase):
+    def test_valid_every_read_size(self):
+        for text in VALID:
+            expected = json.loads(text)
+            for read_size in range(1, len(text.encode()) + 2):
+                with self.subTest(text=text, read_size=read_size):
+                    self.assertEqual(parse(text, read_size), expected)
+
+    def test_invalid_every_read_size(self):
+        for text in INVALID:
+            for read_size in range(1, len(text.encode()) + 2):
+                with self.subTest(text=text, read_size=read_size):
+                    with self.assertRaises(ValueError):
+                        parse(text, read_size)
+
+    def test_str_stream(self):
+        self.assertEqual(list(jsonstream.iterarray(io.StringIO('[2.5e3, [1,2]]'), 1)), [2500.0, [1, 2]])
+
+if __name__ == '__main__':
+    unittest.main()
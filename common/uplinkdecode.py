@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# decode loraserver HTTP integration uplinks from the GPS tracker
+# shared by flask-apiserver and simple-apiserver
+#
+# the tracker payload is 20 bytes of packed data (5 x 32bit big-endian words):
+# long i_lat: decimal latitude millionths - divide by 1,000,000 for decimal
+# long i_lon: decimal longitude millionths
+# long i_alt: cm above sea level - divide by 100 for decimal M
+# u_long gps_date: date stamp of GPS in DDMMYY
+# u_long gps_time: time stamp of GPS in HHMMSSff - divide by 100 for decimal S
+
+import base64
+import struct
+import datetime
+
+# numpy is only needed for decode_batch()
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PAYLOAD = struct.Struct('>iiiII')
+
+# raised by decode_uplink() for any malformed uplink message
+class DecodeError(ValueError):
+    pass
+
+UTC = datetime.timezone.utc
+
+# LoRa packet received without GPS fix gets a dummy timestamp
+NO_FIX = datetime.datetime.min.replace(tzinfo=UTC)
+
+# same century rule as strptime('%y')
+def _year(yy):
+    if yy < 69:
+        return 2000 + yy
+    return 1900 + yy
+
+# gps_date DDMMYY + gps_time HHMMSSff to an aware datetime
+# raises ValueError for impossible dates, like strptime() did
+def gps_datetime(gps_date, gps_time):
+    if gps_time == 0:
+        return NO_FIX
+    return datetime.datetime(
+        _year(gps_date % 100), (gps_date // 100) % 100, gps_date // 10000,
+        gps_time // 1000000, (gps_time // 10000) % 100, (gps_time // 100) % 100, (gps_time % 100) * 10000,
+        tzinfo=UTC,
+    )
+
+# decode the raw 20 byte payload, returns (lat, lon, alt, gps_timestamp)
+def decode_payload(data):
+    i_lat, i_lon, i_alt, gps_date, gps_time = PAYLOAD.unpack_from(data)
+    return (i_lat / 1000000, i_lon / 1000000, i_alt / 100, gps_datetime(gps_date, gps_time))
+
+# parse the loraserver rxInfo time, eg 2019-01-03T22:48:16.080583Z
+# equivalent to strptime(s, '%Y-%m-%dT%H:%M:%S.%fZ') without the format parsing
+def parse_rx_time(s):
+    if len(s) < 21 or s[4] != '-' or s[7] != '-' or s[10] != 'T' or s[13] != ':' or s[16] != ':' or s[19] != '.' or s[-1] != 'Z':
+        raise ValueError('time data {!r} does not match format %Y-%m-%dT%H:%M:%S.%fZ'.format(s))
+    fraction = s[20:-1]
+    if not 1 <= len(fraction) <= 6 or not fraction.isdigit():
+        raise ValueError('time data {!r} does not match format %Y-%m-%dT%H:%M:%S.%fZ'.format(s))
+    return datetime.datetime(
+        int(s[0:4]), int(s[5:7]), int(s[8:10]),
+        int(s[11:13]), int(s[14:16]), int(s[17:19]), int(fraction.ljust(6, '0')),
+        tzinfo=UTC,
+    )
+
+# decode a loraserver uplink JSON message into the tracker_data row layout used by
+# the insert statements and common/batchwriter.py:
+# (gw_id, gw_lon, gw_lat, gw_alt, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, lon, lat, alt)
+# numeric fields are converted here, the batch writer writes them into COPY text as they are
+def decode_uplink(payload):
+    try:
+        rx_info = payload['rxInfo'][0]
+        location = rx_info['location']
+        f_lat, f_lon, f_alt, gps_timestamp = decode_payload(base64.b64decode(payload['data']))
+        return (
+            rx_info['gatewayID'], float(location['longitude']), float(location['latitude']), float(location['altitude']),
+            int(payload['applicationID']), payload['devEUI'],
+            parse_rx_time(rx_info['time']), int(rx_info['rssi']), float(rx_info['loRaSNR']),
+            gps_timestamp, f_lon, f_lat, f_alt,
+        )
+    except (KeyError, IndexError, TypeError, ValueError, struct.error) as e:
+        raise DecodeError('malformed uplink: {!r}'.format(e))
+
+# the reverse of decode_payload(), for simulated and replayed uplinks
+# NO_FIX is sent as gps_date and gps_time 0
+def encode_payload(lat, lon, alt, gps_timestamp):
+    if gps_timestamp == NO_FIX:
+        gps_date = gps_time = 0
+    else:
+        gps_date = (gps_timestamp.day * 100 + gps_timestamp.month) * 100 + gps_timestamp.year % 100
+        gps_time = ((gps_timestamp.hour * 100 + gps_timestamp.minute) * 100 + gps_timestamp.second) * 100 + gps_timestamp.microsecond // 10000
+    return PAYLOAD.pack(round(lat * 1000000), round(lon * 1000000), round(alt * 100), gps_date, gps_time)
+
+# the reverse of decode_uplink(), a loraserver uplink JSON message (as a dict) from a
+# row in the tracker_data row layout, decode_uplink() gives back the same row to
+# the payload's precision
+def encode_uplink(row):
+    gw_id, gw_lon, gw_lat, gw_alt, app_id, dev_eui, gw_rx_timestamp, rssi, snr, gps_timestamp, lon, lat, alt = row
+    return {
+        'applicationID': app_id,
+        'devEUI': dev_eui,
+        'rxInfo': [{
+            'gatewayID': gw_id,
+            'time': gw_rx_timestamp.astimezone(UTC).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'rssi': rssi,
+            'loRaSNR': snr,
+            'location': {'latitude': gw_lat, 'longitude': gw_lon, 'altitude': gw_alt},
+        }],
+        'data': base64.b64encode(encode_payload(lat, lon, alt, gps_timestamp)).decode(),
+    }
+
+BATCH_DTYPE = [
+    ('lat', 'f8'),
+    ('lon', 'f8'),
+    ('alt', 'f8'),
+    ('gps_timestamp', 'datetime64[us]'),
+]
+
+# standard base64 alphabet to 6 bit values, padding decodes as 0
+if numpy is not None:
+    _B64 = numpy.zeros(256, dtype=numpy.uint8)
+    _B64[numpy.frombuffer(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/', dtype=numpy.uint8)] = numpy.arange(64, dtype=numpy.uint8)
+
+# base64 of 20 bytes is always 28 characters, decode them all at once
+def _b64decode_batch(encoded):
+    chars = numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8).reshape(-1, 7, 4)
+    v = _B64[chars]
+    raw = numpy.empty((len(encoded), 7, 3), dtype=numpy.uint8)
+    raw[:, :, 0] = (v[:, :, 0] << 2) | (v[:, :, 1] >> 4)
+    raw[:, :, 1] = (v[:, :, 1] << 4) | (v[:, :, 2] >> 2)
+    raw[:, :, 2] = (v[:, :, 2] << 6) | v[:, :, 3]
+    return numpy.ascontiguousarray(raw.reshape(-1, 21)[:, :20])
+
+# decode many base64 payloads (str or bytes) at once into a numpy structured array
+# with fields lat, lon, alt and gps_timestamp (UTC, NaT when there was no GPS fix)
+# for replaying or backfilling large numbers of stored uplinks
+def decode_batch(payloads):
+    if numpy is None:
+        raise RuntimeError('decode_batch() needs numpy')
+    encoded = [p.encode() if isinstance(p, str) else p for p in payloads]
+    encoded = [e.strip() for e in encoded]
+    if all(len(e) == 28 for e in encoded):
+        raw = _b64decode_batch(encoded)
+    else:
+        # unusual encoding (line breaks, missing padding), fall back to one at a time
+        raw = numpy.frombuffer(b''.join(base64.b64decode(e)[:20] for e in encoded), dtype=numpy.uint8).reshape(-1, 20)
+    signed = raw.view('>i4')
+    unsigned = raw.view('>u4')
+
+    out = numpy.empty(len(encoded), dtype=BATCH_DTYPE)
+    out['lat'] = signed[:, 0] / 1000000
+    out['lon'] = signed[:, 1] / 1000000
+    out['alt'] = signed[:, 2] / 100
+
+    gps_date = unsigned[:, 3].astype(numpy.int64)
+    gps_time = unsigned[:, 4].astype(numpy.int64)
+    yy = gps_date % 100
+    year = numpy.where(yy < 69, 2000 + yy, 1900 + yy)
+    month = (gps_date // 100) % 100
+    day = gps_date // 10000
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    microseconds = (((gps_time // 1000000) * 60 + (gps_time // 10000) % 100) * 60 + (gps_time // 100) % 100) * 1000000 + (gps_time % 100) * 10000
+    timestamps = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]') + microseconds.astype('timedelta64[us]')
+    # no fix, or a date strptime would have refused
+    invalid = (gps_time == 0) | (month < 1) | (month > 12) | (day < 1) | (timestamps.astype('datetime64[M]') != months) \
+        | (gps_time // 1000000 > 23) | ((gps_time // 10000) % 100 > 59) | ((gps_time // 100) % 100 > 59)
+    timestamps[invalid] = numpy.datetime64('NaT')
+    out['gps_timestamp'] = timestamps
+    return out
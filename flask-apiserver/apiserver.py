@@ -6,7 +6,7 @@
 # flask-based JSON API server
 # read LoRaWAN JSON structure from loraserver, parse tracker data, write to PostGIS
 
-from flask import Flask, jsonify, request, abort
+from flask import Flask, jsonify, request, abort, g, Response, stream_with_context
 app = Flask(__name__)
 app.config.from_json('global_config.json', silent=False)
 app.config.from_json('local_config.json', silent=True)
@@ -25,128 +25,343 @@ def limit_content_length(max_length):
             return f(*args, **kwargs)
         return wrapper
     return decorator
-def limit_content_type(allowed_type):
+def limit_content_type(*allowed_types):
     def decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             ct = request.content_type
-            if ct == None or ct != allowed_type:
+            if ct == None or ct not in allowed_types:
                 abort(415)
             return f(*args, **kwargs)
         return wrapper
     return decorator
 
-import datetime # for datetime.strptime()
 import base64 # for base64.decode()
+import binascii # for binascii.Error
 import psycopg2 # for database
 import string # for string.hexdigits()
 import json # for json.dumps() and json.loads()
+import dbpool # for pooled database connections
+
+# modules shared with simple-apiserver live in ../common
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import batchwriter # for group-commit uplink ingest
+import uplinkdecode # for decoding tracker uplinks
+import jsonstream # for streaming JSON parsing of /push
+import io # for io.StringIO()
+import poscache # for the in-memory latest position cache
+import queue # for queue.Empty
+import threading # for threading.BoundedSemaphore()
+import wireformat # for the columnar /pull and /push format
+import math # for math.isfinite()
+import datetime # for parsing ?since=
+
+# one connection pool per worker process, see dbpool.py
+pool = dbpool.DBPool(app.config)
+
+# check out a pooled connection for the rest of this request
+# it is handed back to the pool in put_db() once the request is finished
+def get_db(autocommit=True):
+    if 'dbconn' not in g:
+        try:
+            g.dbconn = pool.getconn()
+        except dbpool.PoolTimeout:
+            # every connection is busy, tell the client to come back later
+            abort(503)
+    g.dbconn.autocommit = autocommit
+    return g.dbconn
+
+@app.teardown_appcontext
+def put_db(exception):
+    dbconn = g.pop('dbconn', None)
+    if dbconn is not None:
+        pool.putconn(dbconn)
+
+# dedicated (unpooled) connection for background threads
+def connect_db():
+    return psycopg2.connect(dbname=app.config['DBNAME'], user=app.config['DBUSER'], password=app.config['DBPASS'], host=app.config['DBHOST'], port=app.config['DBPORT'])
+
+# INGESTMODE "batch" queues uplinks for the group-commit writer instead of
+# doing one INSERT and commit per packet, see common/batchwriter.py
+writer = None
+if app.config['INGESTMODE'] == 'batch':
+    writer = batchwriter.BatchWriter(
+        connect_db,
+        batch_size=app.config['INGESTBATCHSIZE'],
+        max_delay=app.config['INGESTBATCHDELAY'],
+        queue_size=app.config['INGESTQUEUESIZE'],
+        durability=app.config['INGESTDURABILITY'],
+        submit_timeout=app.config['DBPOOLTIMEOUT'],
+        stats_interval=app.config['INGESTSTATSINTERVAL'],
+    )
+
+# POSCACHE keeps the latest tracker and gateway positions in memory in every
+# worker process, kept coherent across processes with LISTEN/NOTIFY, see poscache.py
+# /gwlatest still reads the database because sync needs the committed state
+cache = None
+if app.config['POSCACHE']:
+    cache = poscache.PositionCache(
+        connect_db,
+    )
+
+# maximum concurrent /stream viewers per worker process
+stream_slots = threading.BoundedSemaphore(app.config['STREAMMAXCLIENTS'])
 
 @app.route('/uplink', methods = ['POST'])
 @limit_content_length(4096)
 @limit_content_type('application/json')
 def uplink():
     payload = request.get_json()
-    # this is just copy-paste from lora-apiserver.py
-    # handle uplink data
-    app_id = payload['applicationID']
-    dev_eui = payload['devEUI']
-    gw_id = payload['rxInfo'][0]['gatewayID']
-    gw_lat = payload['rxInfo'][0]['location']['latitude']
-    gw_lon = payload['rxInfo'][0]['location']['longitude']
-    gw_alt = payload['rxInfo'][0]['location']['altitude']
-    gw_rx_time = payload['rxInfo'][0]['time']
-    gw_rx_rssi = payload['rxInfo'][0]['rssi']
-    gw_rx_snr = payload['rxInfo'][0]['loRaSNR']
-    uplink_data = base64.decodebytes(payload['data'].encode())
-
-    # uplink_data is the byte stream coming out of the tracker
-    # output is 20 bytes of packed data (5 x 32bit words):
-    # long i_lat: decimal latitude millionths - divide by 1,000,000 for decimal
-    # long i_lon: decimal longitude millionths
-    # long i_alt: cm above sea level - divide by 100 for decimal M
-    # u_long gps_date: date stamp of GPS in DDMMYY
-    # u_long gps_time: time stamp of GPS in HHMMSSff - divide by 100 for decimal S
-    
-    f_lat = int.from_bytes(uplink_data[0:4], byteorder='big', signed=True) / 1000000
-    f_lon = int.from_bytes(uplink_data[4:8], byteorder='big', signed=True) / 1000000
-    f_alt = int.from_bytes(uplink_data[8:12], byteorder='big', signed=True) / 100
-    gps_date = int.from_bytes(uplink_data[12:16], byteorder='big', signed=False)
-    gps_time = int.from_bytes(uplink_data[16:20], byteorder='big', signed=False)
-
-    gw_rx_timestamp = datetime.datetime.strptime(gw_rx_time, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=datetime.timezone.utc)
-    if gps_time == 0:
-        # LoRa packet received without GPS fix, insert a dummy timestamp
-        gps_timestamp = datetime.datetime.min().replace(tzinfo=datetime.timezone.utc)
-    else:
-        gps_timestamp = datetime.datetime.strptime("{0:0>6} {1:0>8}".format(gps_date, gps_time), '%d%m%y %H%M%S%f').replace(tzinfo=datetime.timezone.utc)
+    # decode is shared with lora-apiserver.py, see common/uplinkdecode.py
+    try:
+        row = uplinkdecode.decode_uplink(payload)
+    except uplinkdecode.DecodeError:
+        abort(400)
+    if writer is not None:
+        # hand off to the group-commit writer
+        try:
+            inserted = writer.submit(row)
+        except batchwriter.QueueFull:
+            abort(503)
+        except batchwriter.WriteFailed:
+            abort(500)
+        if inserted is None:
+            # "queued" durability, not written yet
+            return ('', 204) # 204 = HTTP no content
+        return jsonify(inserted_counts(int(inserted), 1))
 
     # insert into the db
-    dbconn = psycopg2.connect(dbname=app.config['DBNAME'], user=app.config['DBUSER'], password=app.config['DBPASS'], host=app.config['DBHOST'], port=app.config['DBPORT'])
-    dbconn.autocommit = False
+    # a retried uplink that is already there inserts nothing
+    dbconn = get_db(autocommit=False)
     cur = dbconn.cursor()
-    cur.execute("""INSERT INTO tracker_data (gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location) 
-        VALUES (%s, ST_SetSRID(st_makepoint(%s,%s,%s),4326), %s, %s, %s, %s, %s, %s, ST_SetSRID(st_makepoint(%s,%s,%s),4326));""", 
-        (gw_id, gw_lon, gw_lat, gw_alt, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, f_lon, f_lat, f_alt)
-    )
-    if cur.rowcount != 1:
+    cur.execute("EXECUTE uplink_insert (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);", row)
+    if cur.rowcount not in (0, 1):
         # insert failed?
         dbconn.rollback()
         abort(500)
     
     dbconn.commit()
 
-    return ('', 204) # 204 = HTTP no content
+    return jsonify(inserted_counts(cur.rowcount, 1))
+
+# response body of /uplink and /push
+def inserted_counts(inserted, total):
+    return {'inserted': inserted, 'skipped': total - inserted}
+
+# push changed tracker and gateway positions to the browser as Server-Sent Events
+# events:
+# - "tracker", "gateway": {"id": dev_eui or gw_id, "geojson": location}
+# - "reload": changes may have been missed, the stream ends and the client should
+#   fetch everything again once its EventSource reconnects
+# all streams in a worker process share the position cache's LISTEN connection
+# each open stream holds a request thread for as long as the viewer is connected
+@app.route('/stream', methods = ['GET'])
+def stream():
+    if cache is None or not app.config['STREAM']:
+        abort(404)
+    if not stream_slots.acquire(blocking=False):
+        # too many viewers on this worker, map.html falls back to polling
+        abort(503)
+    subscriber = cache.subscribe()
+
+    closed = []
+    def close():
+        if len(closed) == 0:
+            closed.append(True)
+            cache.unsubscribe(subscriber)
+            stream_slots.release()
+
+    def generate():
+        # tell EventSource how long to wait (ms) before reconnecting
+        yield 'retry: {}\n\n'.format(app.config['STREAMRETRY'])
+        while True:
+            try:
+                event, data = subscriber.get(timeout=app.config['STREAMKEEPALIVE'])
+            except queue.Empty:
+                # comment line, keeps proxies from timing out an idle stream
+                yield ': keepalive\n\n'
+                continue
+            if event == 'reload':
+                yield 'event: reload\ndata: {}\n\n'
+                return
+            yield 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+
+    response = Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(close)
+    return response
+
+# conditional GET support for the read endpoints
+# a version is (row count, sum of seq, last change) of tracker_latest/gateway_latest,
+# or of a single row of them, see simple-apiserver/latest-positions.pgsql
+# it is read before the data, so a response is never older than its ETag
+def latest_version(kind, key=None):
+    if cache is not None and cache.ready():
+        if key is None:
+            return cache.version(kind)
+        position = cache.position(kind, key)
+        if position is None:
+            return None
+        return (1, position[2], position[3])
+    cur = get_db().cursor()
+    if key is None:
+        cur.execute("EXECUTE {}_version;".format(kind))
+    else:
+        cur.execute("EXECUTE {}_version_one (%s);".format(kind), (key,))
+    return cur.fetchone()
+
+# return the ETag for the current version, or abort with 304 Not Modified
+# if the client already has it
+# ETags are weak because the cache and the database can format the same data differently
+def check_not_modified(version, *extra):
+    if version is None:
+        # nothing to compare against, let the handler deal with it (usually 404)
+        return None
+    etag = '-'.join(str(v) for v in (version[0], version[1]) + extra)
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag):
+            abort(add_validators(Response(status=304), etag, version))
+    elif request.if_modified_since is not None and version[2] is not None:
+        if version[2].replace(microsecond=0) <= request.if_modified_since:
+            abort(add_validators(Response(status=304), etag, version))
+    return etag
+
+def add_validators(response, etag, version):
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+        if version[2] is not None:
+            response.last_modified = version[2]
+        # browsers may keep the body, but must revalidate it every time
+        response.cache_control.no_cache = True
+    return response
+
+# ?bbox=west,south,east,north (degrees) and ?since=timestamp filters of /gwlocation/all
+# and /trlocation/all, so a map only fetches what is on screen
+# returns None when neither is given, otherwise the arguments of the *_bbox statements:
+# (west, south, east, north, west2, east2, since), the second box is the part of the
+# viewport past the antimeridian, or the first box again
+# a west greater than east crosses the antimeridian, as do longitudes past +/-180 from
+# a wrapped web map
+def parse_viewport():
+    bbox = request.args.get('bbox', None)
+    since = request.args.get('since', None)
+    if bbox is None and since is None:
+        return None
+    west, south, east, north = -180.0, -90.0, 180.0, 90.0
+    if bbox is not None:
+        try:
+            west, south, east, north = [float(v) for v in bbox.split(',')]
+        except ValueError:
+            abort(400)
+        if not all(math.isfinite(v) for v in (west, south, east, north)) or not -90 <= south <= north <= 90:
+            abort(400)
+        if east < west:
+            east += 360
+        if east - west >= 360:
+            west, east = -180.0, 180.0
+        else:
+            # move west into -180..180, east follows and may go past 180
+            shift = (west + 180) % 360 - 180 - west
+            west += shift
+            east += shift
+    if east <= 180:
+        wrapped = (west, east)
+    else:
+        wrapped = (-180.0, east - 360)
+        east = 180.0
+    if since is not None:
+        try:
+            since = datetime.datetime.fromisoformat(since.replace('Z', '+00:00'))
+        except ValueError:
+            abort(400)
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+    return (west, south, east, north) + wrapped + (since,)
+
+# is a cached (timestamp, geojson, seq, updated) position in the viewport
+def in_viewport(viewport, position):
+    west, south, east, north, west2, east2, since = viewport
+    lon, lat = position[1]['coordinates'][:2]
+    return south <= lat <= north and (west <= lon <= east or west2 <= lon <= east2) \
+        and (since is None or position[0] >= since)
+
+# ETag parts for a viewport, each viewport is validated on its own
+# both parameters have been parsed, so they hold no quotes
+def viewport_tag(viewport):
+    if viewport is None:
+        return ()
+    return (request.args.get('bbox', ''), request.args.get('since', ''))
+
+# return group-commit writer statistics (rows per commit, ack latency) for tuning batch size
+@app.route('/ingeststats', methods = ['GET'])
+@limit_content_type('application/json')
+def ingeststats():
+    if writer is None:
+        abort(404)
+    return jsonify(writer.stats())
 
 # return location of a requested gateway
 # gateway ID must be one of:
 # - 16 hex digits
 # - "self" (return gateway ID defined in config, or "mid" if not defined)
 # - "mid" (return middle of all gateway locations)
-# - "all" (return all gateway locations)
+# - "all" (return all gateway locations, or with ?bbox= and/or ?since= only those in
+#   the viewport, see parse_viewport())
 @app.route('/gwlocation/<gateway>', methods = ['GET'])
 @limit_content_type('application/json')
 def gwlocation(gateway):
-    # set up DB connection
-    dbconn = psycopg2.connect(dbname=app.config['DBNAME'], user=app.config['DBUSER'], password=app.config['DBPASS'], host=app.config['DBHOST'], port=app.config['DBPORT'])
-    dbconn.autocommit = True
-    cur = dbconn.cursor()
-
     if gateway == 'self':
         # we are trying to find ourself
         if app.config['GATEWAYID'] == None:
             gateway = 'mid'
         else:
             gateway = app.config['GATEWAYID']
+    if gateway != 'mid' and gateway != 'all':
+        if len(gateway) != 16: # gateway ID is 16 hex characters, make sure it is
+            abort(404)
+        if not all(c in string.hexdigits for c in gateway):
+            abort(404)
+
+    viewport = parse_viewport() if gateway == 'all' else None
+    version = latest_version('gateway', None if gateway == 'mid' or gateway == 'all' else gateway)
+    etag = check_not_modified(version, gateway, *viewport_tag(viewport))
+
+    if cache is not None and cache.ready():
+        # serve from this worker's position cache, no database round trip
+        positions = cache.gateway_positions()
+        if gateway == 'mid':
+            if len(positions) == 0:
+                abort(404)
+            return add_validators(jsonify({'ffffffffffffffff': poscache.centroid([p[1] for p in positions.values()])}), etag, version)
+        if gateway != 'all':
+            if gateway not in positions:
+                # gateway not found
+                abort(404)
+            positions = {gateway: positions[gateway]}
+        elif viewport is not None:
+            positions = {gw_id: p for gw_id, p in positions.items() if in_viewport(viewport, p)}
+        return add_validators(jsonify({gw_id: p[1] for gw_id, p in positions.items()}), etag, version)
+
+    # set up DB connection
+    dbconn = get_db()
+    cur = dbconn.cursor()
+
     if gateway == 'mid':
         # return the middle of all gateway last known locations
-        cur.execute("""SELECT 'ffffffffffffffff'::char(16), ST_AsGeoJSON(ST_Centroid(ST_Collect(gw.gw_location)))
-            FROM (
-	            SELECT DISTINCT ON (gw_id) gw_id, gw_location::geometry
-	            FROM tracker_data
-	            ORDER BY gw_id, gw_rx_timestamp DESC
-            ) AS gw;""")
+        cur.execute("EXECUTE gwlocation_mid;")
+    elif viewport is not None:
+        # return the last known locations of gateways in the viewport, through idx_gl_location
+        cur.execute("EXECUTE gwlocation_bbox (%s, %s, %s, %s, %s, %s, %s);", viewport)
     elif gateway == 'all':
         # return the location of all gateway last known locations
-        cur.execute("""SELECT DISTINCT ON (gw_id) gw_id, ST_AsGeoJSON(gw_location)
-            FROM tracker_data
-            ORDER BY gw_id, gw_rx_timestamp DESC;""",
-        )
+        cur.execute("EXECUTE gwlocation_all;")
     else:
-        if len(gateway) != 16: # gateway ID is 16 hex characters, make sure it is
-            abort(404)
-        if not all(c in string.hexdigits for c in gateway):
-            abort(404)
         # return the last known location of the requested gateway
-        cur.execute("""SELECT DISTINCT ON (gw_id) gw_id, ST_AsGeoJSON(gw_location)
-            FROM tracker_data
-            WHERE gw_id = %s
-            ORDER BY gw_id, gw_rx_timestamp DESC;""",
-            (gateway,)
-        )
+        cur.execute("EXECUTE gwlocation_one (%s);", (gateway,))
 
-    if cur.rowcount == 0:
-        # gateway not found
+    if cur.rowcount == 0 and viewport is None:
+        # gateway not found, an empty viewport is just empty
         abort(404)
         
     gateways = {}
@@ -154,16 +369,11 @@ def gwlocation(gateway):
         geojson = json.loads(record[1])
         gateways[record[0]] = geojson
     
-    return jsonify(gateways)
+    return add_validators(jsonify(gateways), etag, version)
 
 @app.route('/gwarea/<gateway>', methods = ['GET'])
 @limit_content_type('application/json')
 def gwarea(gateway):
-    # set up DB connection
-    dbconn = psycopg2.connect(dbname=app.config['DBNAME'], user=app.config['DBUSER'], password=app.config['DBPASS'], host=app.config['DBHOST'], port=app.config['DBPORT'])
-    dbconn.autocommit = True
-    cur = dbconn.cursor()
-
     if app.config['GATEWAYRADIUS'] == 0:
         # you definitely need to configure this...
         print("Configure GATEWAYRADIUS to non-zero in M from gateway")
@@ -174,32 +384,41 @@ def gwarea(gateway):
             gateway = 'mid'
         else:
             gateway = app.config['GATEWAYID']
-    if gateway == 'mid':
-        # return the middle of all gateway last known locations
-        cur.execute("""SELECT 'ffffffffffffffff'::char(16), ST_AsGeoJSON(Box2D(ST_Buffer(ST_SetSRID(ST_Centroid(ST_Collect(gw.gw_location)),4326)::geography,%s,'quad_segs=1')::geometry))
-            FROM (
-                SELECT DISTINCT ON (gw_id) gw_id, gw_location::geometry
-                FROM tracker_data
-                ORDER BY gw_id, gw_rx_timestamp DESC
-            ) AS gw;""",
-            (app.config['GATEWAYRADIUS'],)
-        )
-    else:
-        # return the last known location of the requested gateway
+    if gateway != 'mid':
         if len(gateway) != 16: # gateway ID is 16 hex characters, make sure it is
             abort(404)
         if not all(c in string.hexdigits for c in gateway):
             abort(404)
-        cur.execute("""SELECT gw.gw_id, ST_AsGeoJSON(Box2D(ST_Buffer(ST_SetSRID(ST_Centroid(ST_Collect(gw.gw_location)),4326)::geography,%s,'quad_segs=1')::geometry))
-            FROM (
-                SELECT DISTINCT ON (gw_id) gw_id, gw_location::geometry
-                FROM tracker_data
-                WHERE gw_id = %s
-                ORDER BY gw_id, gw_rx_timestamp DESC
-            ) AS gw
-            GROUP BY 1;""",
-            (app.config['GATEWAYRADIUS'],gateway)
-        )
+
+    version = latest_version('gateway', None if gateway == 'mid' else gateway)
+    etag = check_not_modified(version, gateway, app.config['GATEWAYRADIUS'])
+
+    if cache is not None and cache.ready():
+        # serve from this worker's position cache, no database round trip
+        positions = cache.gateway_positions()
+        if gateway == 'mid':
+            if len(positions) == 0:
+                abort(404)
+            centre = poscache.centroid([p[1] for p in positions.values()])
+            gw_id = 'ffffffffffffffff'
+        else:
+            if gateway not in positions:
+                # gateway not found
+                abort(404)
+            centre = positions[gateway][1]
+            gw_id = gateway
+        return add_validators(jsonify({gw_id: poscache.area_box(centre, app.config['GATEWAYRADIUS'])}), etag, version)
+
+    # set up DB connection
+    dbconn = get_db()
+    cur = dbconn.cursor()
+
+    if gateway == 'mid':
+        # return the middle of all gateway last known locations
+        cur.execute("EXECUTE gwarea_mid (%s);", (app.config['GATEWAYRADIUS'],))
+    else:
+        # return the last known location of the requested gateway
+        cur.execute("EXECUTE gwarea_one (%s, %s);", (app.config['GATEWAYRADIUS'],gateway))
     if cur.rowcount == 0:
         # gateway not found
         abort(404)
@@ -209,41 +428,54 @@ def gwarea(gateway):
         geojson = json.loads(record[1])
         gateways[record[0]] = geojson
     
-    return jsonify(gateways)
+    return add_validators(jsonify(gateways), etag, version)
 
 # return location of a requested tracker
 # tracker ID must be one of:
 # - 16 hex digits
-# - "all" (return all tracker locations)
+# - "all" (return all tracker locations, or with ?bbox= and/or ?since= only those in
+#   the viewport, see parse_viewport())
 @app.route('/trlocation/<tracker>', methods = ['GET'])
 @limit_content_type('application/json')
 def trlocation(tracker):
+    if tracker != 'all':
+        if len(tracker) != 16: # gateway ID is 16 hex characters, make sure it is
+            abort(404)
+        if not all(c in string.hexdigits for c in tracker):
+            abort(404)
+
+    viewport = parse_viewport() if tracker == 'all' else None
+    version = latest_version('tracker', None if tracker == 'all' else tracker)
+    etag = check_not_modified(version, tracker, *viewport_tag(viewport))
+
+    if cache is not None and cache.ready():
+        # serve from this worker's position cache, no database round trip
+        positions = cache.tracker_positions()
+        if tracker != 'all':
+            if tracker not in positions:
+                # tracker not found
+                abort(404)
+            positions = {tracker: positions[tracker]}
+        elif viewport is not None:
+            positions = {dev_eui: p for dev_eui, p in positions.items() if in_viewport(viewport, p)}
+        return add_validators(jsonify({dev_eui: p[1] for dev_eui, p in positions.items()}), etag, version)
+
     # set up DB connection
-    dbconn = psycopg2.connect(dbname=app.config['DBNAME'], user=app.config['DBUSER'], password=app.config['DBPASS'], host=app.config['DBHOST'], port=app.config['DBPORT'])
-    dbconn.autocommit = True
+    dbconn = get_db()
     cur = dbconn.cursor()
 
-    if tracker == 'all':
+    if viewport is not None:
+        # return the last known locations of trackers in the viewport, through idx_tl_location
+        cur.execute("EXECUTE trlocation_bbox (%s, %s, %s, %s, %s, %s, %s);", viewport)
+    elif tracker == 'all':
         # return the location of all gateway last known locations
-        cur.execute("""SELECT DISTINCT ON (dev_eui) dev_eui, ST_AsGeoJSON(gps_location)
-            FROM tracker_data
-            ORDER BY dev_eui, gps_timestamp DESC;""",
-        )
+        cur.execute("EXECUTE trlocation_all;")
     else:
-        if len(tracker) != 16: # gateway ID is 16 hex characters, make sure it is
-            abort(404)
-        if not all(c in string.hexdigits for c in tracker):
-            abort(404)
         # return the last known location of the requested gateway
-        cur.execute("""SELECT DISTINCT ON (dev_eui) dev_eui, ST_AsGeoJSON(gps_location)
-            FROM tracker_data
-            WHERE dev_eui = %s
-            ORDER BY dev_eui, gps_timestamp DESC;""",
-            (tracker,)
-        )
+        cur.execute("EXECUTE trlocation_one (%s);", (tracker,))
 
-    if cur.rowcount == 0:
-        # gateway not found
+    if cur.rowcount == 0 and viewport is None:
+        # gateway not found, an empty viewport is just empty
         abort(404)
         
     trackers = {}
@@ -251,7 +483,91 @@ def trlocation(tracker):
         geojson = json.loads(record[1])
         trackers[record[0]] = geojson
     
-    return jsonify(trackers)
+    return add_validators(jsonify(trackers), etag, version)
+
+# return the trail of a requested tracker as a GeoJSON LineString Feature, one point
+# per GPS fix in gps_timestamp order, tracker ID must be 16 hex digits
+# optional query parameters:
+# - from, to: time window, from inclusive, to exclusive (default the last TRHISTORYHOURS hours)
+# - zoom: web map zoom level the trail is drawn at, points less than about a pixel off
+#   the line are dropped (Douglas-Peucker), default all points
+# - limit: return at most this many fixes (default and maximum TRHISTORYPOINTS)
+# - continuation: token from the previous page, the next page starts at the previous
+#   page's last point so the lines join up
+# response:
+# {"type": "Feature", "geometry": {"type": "LineString", "coordinates": [[lon, lat, alt], ...]},
+#  "properties": {"dev_eui": "tracker id", "from": "first fix", "to": "last fix", "points": fixes, "continuation": "token" or null}}
+@app.route('/trhistory/<tracker>', methods = ['GET'])
+@limit_content_type('application/json')
+def trhistory(tracker):
+    if len(tracker) != 16: # tracker ID is 16 hex characters, make sure it is
+        abort(404)
+    if not all(c in string.hexdigits for c in tracker):
+        abort(404)
+
+    limit = request.args.get('limit', app.config['TRHISTORYPOINTS'], type=int)
+    if limit < 2 or limit > app.config['TRHISTORYPOINTS']:
+        abort(400)
+    zoom = request.args.get('zoom', None, type=int)
+    if zoom is None:
+        tolerance = 0
+    elif 0 <= zoom <= 30:
+        # degrees of longitude per pixel of a 256 pixel tile at the equator
+        tolerance = 360 / (256 * 2 ** zoom)
+    else:
+        abort(400)
+    start = request.args.get('from', None)
+    end = request.args.get('to', None)
+    if 'continuation' in request.args:
+        try:
+            start = decode_history_continuation(request.args['continuation'])
+        except ValueError:
+            abort(400)
+
+    # set up DB connection
+    dbconn = get_db()
+    cur = dbconn.cursor()
+    try:
+        cur.execute("EXECUTE trhistory (%s, %s, %s, %s, %s, %s);",
+            (tracker, start, end, limit, tolerance, app.config['TRHISTORYHOURS']))
+    except psycopg2.DataError:
+        # malformed timestamps
+        dbconn.rollback()
+        abort(400)
+    points, first, last, line = cur.fetchone()
+    if points == 0:
+        # no fixes in the window
+        abort(404)
+
+    geometry = json.loads(line)
+    if len(geometry['coordinates']) == 1:
+        # a single fix, a LineString needs two positions
+        geometry['coordinates'] *= 2
+    return jsonify({
+        'type': 'Feature',
+        'geometry': geometry,
+        'properties': {
+            'dev_eui': tracker,
+            'from': first.strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
+            'to': last.strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
+            'points': points,
+            # a full page, there may be more
+            'continuation': encode_history_continuation(last) if points == limit else None,
+        },
+    })
+
+# /trhistory continuation tokens are the gps_timestamp of the last point sent
+def encode_history_continuation(ts):
+    return base64.urlsafe_b64encode(json.dumps([ts.isoformat()]).encode()).decode()
+
+def decode_history_continuation(token):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except (TypeError, UnicodeDecodeError, binascii.Error):
+        raise ValueError('invalid continuation token')
+    if not isinstance(key, list) or len(key) != 1 or not isinstance(key[0], str):
+        raise ValueError('invalid continuation token')
+    return key[0]
 
 # return latest timestamp of requested gateway (for sync purposes)
 # gateway ID must be one of:
@@ -261,23 +577,21 @@ def trlocation(tracker):
 @app.route('/gwlatest', methods = ['GET'])
 @limit_content_type('application/json')
 def gwlatest():
-    # set up DB connection
-    dbconn = psycopg2.connect(dbname=app.config['DBNAME'], user=app.config['DBUSER'], password=app.config['DBPASS'], host=app.config['DBHOST'], port=app.config['DBPORT'])
-    dbconn.autocommit = True
-    cur = dbconn.cursor()
+    # always read the database, sync needs the committed state
+    cur = get_db().cursor()
+    cur.execute("EXECUTE gateway_version;")
+    version = cur.fetchone()
+    etag = check_not_modified(version, 'gwlatest')
 
     # return the latest timestamp of all gateway rx timestamps
-    cur.execute("""SELECT DISTINCT ON (gw_id) gw_id, gw_rx_timestamp
-        FROM tracker_data
-        ORDER BY gw_id, gw_rx_timestamp DESC;""",
-    )
+    cur.execute("EXECUTE gwlatest;")
 
     gateways = {}
     for record in cur:
         # need to use strftime becuase .isoformat generates an unparseable timezone
         gateways[record[0]] = record[1].strftime('%Y-%m-%dT%H:%M:%S.%f%z')
     
-    return jsonify(gateways)
+    return add_validators(jsonify(gateways), etag, version)
 
 # return tracker data later than the given timestamp for the given gateway
 # allow to specify multiple gateways with different timestamps
@@ -285,42 +599,236 @@ def gwlatest():
 # {
 #    "gateway id": "timestamp"
 # }
+# or a list of time ranges (from inclusive, to exclusive, null for open ended), as
+# used by reconciliation, see /digest:
+# [
+#    ["gateway id", "from timestamp", "to timestamp"]
+# ]
+# rows are streamed from a server-side cursor in (gw_id, gw_rx_timestamp, dev_eui) order
+# response format depends on the Accept header:
+# - application/json (default): one JSON array, written incrementally
+# - application/x-ndjson: one JSON row array per line
+# optional query parameters for paging through large backlogs:
+# - limit: return at most this many rows, if the limit is reached the last
+#   element/line is {"continuation": "token"} instead of a row
+# - continuation: token from the previous page, to resume after its last row
 @app.route('/pull', methods = ['POST'])
 @limit_content_type('application/json')
 def pull():
     payload = request.get_json()
-    
+    if isinstance(payload, dict):
+        # everything after the timestamp
+        ranges = [(gw_id, ts, True, None) for gw_id, ts in payload.items()]
+    else:
+        ranges = [(gw_id, lo, False, hi) for gw_id, lo, hi in parse_ranges(payload)]
+
+    limit = request.args.get('limit', None, type=int)
+    if limit is not None and limit <= 0:
+        abort(400)
+    after = None
+    if 'continuation' in request.args:
+        try:
+            after = decode_continuation(request.args['continuation'])
+        except ValueError:
+            abort(400)
+    mimetype = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson', wireformat.MIMETYPE], 'application/json')
+    ndjson = mimetype == 'application/x-ndjson'
+
     # set up DB connection
-    dbconn = psycopg2.connect(dbname=app.config['DBNAME'], user=app.config['DBUSER'], password=app.config['DBPASS'], host=app.config['DBHOST'], port=app.config['DBPORT'])
-    dbconn.autocommit = True
-    cur = dbconn.cursor()
+    # named (server-side) cursors only exist inside a transaction
+    dbconn = get_db(autocommit=False)
+    cur = dbconn.cursor(name='pull')
+    cur.itersize = app.config['PULLFETCHSIZE']
 
-    # construct SQL statement with appropriate number of boolean operators in the WHERE clause
-    sql = """SELECT gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location
-FROM tracker_data
+    # join against the requested gateways instead of building an OR chain
+    # "after" timestamps become inclusive lower bounds one microsecond later, so
+    # every range is a plain index range scan
+    sql = """SELECT td.gw_id, td.gw_location, td.app_id, td.dev_eui, td.gw_rx_timestamp, td.gw_rx_rssi, td.gw_rx_snr, td.gps_timestamp, td.gps_location
+FROM tracker_data td
+JOIN (
+    SELECT gw_id,
+        CASE WHEN after THEN lo + interval '1 microsecond' ELSE coalesce(lo, '-infinity') END AS lo,
+        coalesce(hi, 'infinity') AS hi
+    FROM unnest(%s::char(16)[], %s::timestamptz[], %s::boolean[], %s::timestamptz[]) AS r(gw_id, lo, after, hi)
+) AS req
+    ON td.gw_id = req.gw_id AND td.gw_rx_timestamp >= req.lo AND td.gw_rx_timestamp < req.hi
 """
-    where = " WHERE "
-    first = True
-    args = []
-    for gw_id in payload.keys():
-        args.append(gw_id)
-        args.append(payload[gw_id])
-        sql += where
-        sql += "(gw_id = %s AND gw_rx_timestamp > %s)\n"
-        if first:
-            first = False
-            where = " OR "
-    cur.execute(sql, args)
-    if cur.rowcount == 0:
+    args = [[r[0] for r in ranges], [r[1] for r in ranges], [r[2] for r in ranges], [r[3] for r in ranges]]
+    if after is not None:
+        sql += "WHERE (td.gw_id, td.gw_rx_timestamp, td.dev_eui) > (%s, %s, %s)\n"
+        args.extend(after)
+    sql += "ORDER BY td.gw_id, td.gw_rx_timestamp, td.dev_eui\n"
+    if limit is not None:
+        sql += "LIMIT %s\n"
+        args.append(limit)
+    try:
+        cur.execute(sql, args)
+    except psycopg2.DataError:
+        # malformed timestamps
+        dbconn.rollback()
+        abort(400)
+
+    # named cursors don't know their rowcount, so look at the first batch before
+    # committing to a 200 response
+    first = cur.fetchmany(app.config['PULLFETCHSIZE'])
+    if len(first) == 0:
         # data not found
         abort(404)
-    
-    # can't use fetchall because jsonify(datetime) doesn't keep microsecond timestamps, need to use .isoformat() instead
-    data = []
+
+    if mimetype == wireformat.MIMETYPE:
+        return pull_columnar(cur, dbconn, first, limit)
+
+    def generate():
+        count = 0
+        last = None
+        if not ndjson:
+            yield '['
+        rows = first
+        while len(rows) > 0:
+            for record in rows:
+                # can't use jsonify because jsonify(datetime) doesn't keep microsecond timestamps, need to use .isoformat() instead
+                line = json.dumps([record[0], record[1], record[2], record[3], record[4].isoformat(), record[5], record[6], record[7].isoformat(), record[8]])
+                if ndjson:
+                    yield line + '\n'
+                elif count == 0:
+                    yield line
+                else:
+                    yield ',' + line
+                count += 1
+                last = record
+            rows = cur.fetchmany(app.config['PULLFETCHSIZE'])
+        cur.close()
+        dbconn.commit()
+        if limit is not None and count == limit:
+            # there may be more rows, tell the client where to carry on from
+            line = json.dumps({'continuation': encode_continuation(last)})
+            if ndjson:
+                yield line + '\n'
+            else:
+                yield ',' + line
+        if not ndjson:
+            yield ']'
+
+    if ndjson:
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+# stream the rows as wireformat.py frames, one block of rows per fetch
+def pull_columnar(cur, dbconn, first, limit):
+    encoding = wireformat.choose_encoding(request.headers.get('Accept-Encoding'))
+
+    def generate():
+        compressor = wireformat.Compressor(encoding)
+        count = 0
+        last = None
+        rows = first
+        while len(rows) > 0:
+            yield compressor.compress(wireformat.rows_frame(rows))
+            count += len(rows)
+            last = rows[-1]
+            rows = cur.fetchmany(app.config['PULLFETCHSIZE'])
+        cur.close()
+        dbconn.commit()
+        if limit is not None and count == limit:
+            # there may be more rows, tell the client where to carry on from
+            yield compressor.compress(wireformat.continuation_frame(encode_continuation(last)))
+        yield compressor.flush()
+
+    response = Response(stream_with_context(generate()), mimetype=wireformat.MIMETYPE)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept')
+    response.vary.add('Accept-Encoding')
+    return response
+
+# continuation tokens are the (gw_id, gw_rx_timestamp, dev_eui) key of the last row sent
+def encode_continuation(record):
+    return base64.urlsafe_b64encode(json.dumps([record[0], record[4].isoformat(), record[3]]).encode()).decode()
+
+def decode_continuation(token):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except (TypeError, UnicodeDecodeError, binascii.Error):
+        raise ValueError('invalid continuation token')
+    if not isinstance(key, list) or len(key) != 3 or not all(isinstance(k, str) for k in key):
+        raise ValueError('invalid continuation token')
+    return key
+
+# [gw_id, from, to] time ranges from a /pull or /digest request body, from inclusive,
+# to exclusive, either may be null for open ended
+def parse_ranges(payload):
+    if not isinstance(payload, list):
+        abort(400)
+    for r in payload:
+        if not isinstance(r, list) or len(r) != 3 or not isinstance(r[0], str) \
+                or not all(ts is None or isinstance(ts, str) for ts in r[1:]):
+            abort(400)
+    return payload
+
+# exact microseconds since 1970 of a timestamptz, extract(epoch) is a double and can be off by one
+def sql_microseconds(ts):
+    return "(extract(epoch FROM date_trunc('second', {0}))::bigint * 1000000 + mod(extract(microseconds FROM {0})::bigint, 1000000))".format(ts)
+
+DIGEST_SQL = """SELECT req.n, {bucket} AS bucket, count(*), sum({hash})::text, min(td.gw_rx_timestamp), max(td.gw_rx_timestamp)
+FROM tracker_data td
+JOIN unnest(%(gw_ids)s::char(16)[], %(los)s::timestamptz[], %(his)s::timestamptz[]) WITH ORDINALITY AS req(gw_id, lo, hi, n)
+    ON td.gw_id = req.gw_id AND td.gw_rx_timestamp >= req.lo AND td.gw_rx_timestamp < req.hi
+GROUP BY 1, 2
+ORDER BY 1, 2;""".format(
+    # open ended ranges are one bucket, closed ones are split into equal lengths of time
+    bucket="""CASE WHEN req.lo = '-infinity' OR req.hi = 'infinity' THEN 0
+        ELSE div(({0} - {1})::numeric * %(buckets)s, ({2} - {1})::numeric)::int END""".format(
+        sql_microseconds('td.gw_rx_timestamp'), sql_microseconds('req.lo'), sql_microseconds('req.hi'),
+    ),
+    hash="""('x' || left(md5(td.gw_id || td.dev_eui || {0}::text), 16))::bit(64)::bigint""".format(
+        sql_microseconds('td.gw_rx_timestamp'),
+    ),
+)
+
+# row counts and hashes of time buckets of tracker data, so two servers can find out
+# which parts of their history differ without sending the rows, see syncclient.reconcile()
+# JSON request data format, time ranges as for /pull:
+# [
+#    ["gateway id", "from timestamp", "to timestamp"]
+# ]
+# closed ranges are split into ?buckets=N (default 16) equal lengths of time, a range
+# with an open end is one bucket
+# response, for every requested range its non-empty buckets:
+# [
+#    [[bucket number, row count, hash, first timestamp, last timestamp], ...]
+# ]
+# the hash is the sum of 64 bit hashes of each row's (gw_id, dev_eui, gw_rx_timestamp),
+# so servers holding the same rows give the same count and hash whatever order they
+# were inserted in
+@app.route('/digest', methods = ['POST'])
+@limit_content_type('application/json')
+def digest():
+    ranges = parse_ranges(request.get_json())
+    buckets = request.args.get('buckets', 16, type=int)
+    if buckets < 1 or buckets > 1024:
+        abort(400)
+
+    dbconn = get_db()
+    cur = dbconn.cursor()
+    try:
+        cur.execute(DIGEST_SQL, {
+            'gw_ids': [r[0] for r in ranges],
+            'los': [r[1] or '-infinity' for r in ranges],
+            'his': [r[2] or 'infinity' for r in ranges],
+            'buckets': buckets,
+        })
+    except psycopg2.DataError:
+        # malformed timestamps
+        dbconn.rollback()
+        abort(400)
+
+    result = [[] for r in ranges]
     for record in cur:
-        data.append([record[0], record[1], record[2], record[3], record[4].isoformat(), record[5], record[6], record[7].isoformat(), record[8]])
-    
-    return jsonify(data)
+        result[record[0] - 1].append([
+            record[1], record[2], record[3],
+            record[4].strftime('%Y-%m-%dT%H:%M:%S.%f%z'), record[5].strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
+        ])
+    return jsonify(result)
 
 # insert tracker data from remote gateways
 # JSON request data format:
@@ -337,30 +845,77 @@ FROM tracker_data
 #       gps_location
 #   ]
 # ]
+# or Content-Type: application/x-loratracker-columnar, see wireformat.py
+# rows that are already there (same gw_id, dev_eui and gw_rx_timestamp) are skipped
+# response: {"inserted": rows inserted, "skipped": rows already there}
 @app.route('/push', methods = ['POST'])
-@limit_content_type('application/json')
+@limit_content_type('application/json', wireformat.MIMETYPE)
 def push():
-    payload = request.get_json()
-    
     # set up DB connection
-    dbconn = psycopg2.connect(dbname=app.config['DBNAME'], user=app.config['DBUSER'], password=app.config['DBPASS'], host=app.config['DBHOST'], port=app.config['DBPORT'])
-    dbconn.autocommit = False # run inserts inside a transaction
+    dbconn = get_db(autocommit=False) # run all chunks inside one transaction
     cur = dbconn.cursor()
+    cur.execute(batchwriter.STAGE_SQL)
+
+    # stream-parse the request body one row at a time and COPY every PUSHCHUNKSIZE rows
+    # so a large sync never holds the whole body or all rows in memory
+    chunk = []
+    total = 0
+    inserted = 0
+    try:
+        if request.content_type == wireformat.MIMETYPE:
+            records = push_columnar_records()
+        else:
+            # read through DecompressingReader only to count bytes against PUSHMAXBYTES
+            records = jsonstream.iterarray(wireformat.DecompressingReader(request.stream, None, max_size=app.config['PUSHMAXBYTES']))
+        for record in records:
+            if not isinstance(record, list):
+                raise ValueError('expected a row array, got {}'.format(type(record).__name__))
+            if len(record) != 9:
+                raise ValueError('expected 9 columns, got {}'.format(len(record)))
+            if total + len(chunk) >= app.config['PUSHMAXROWS']:
+                raise wireformat.TooLarge('over {} rows'.format(app.config['PUSHMAXROWS']))
+            chunk.append('\t'.join(batchwriter.copy_value(value) for value in record) + '\n')
+            if len(chunk) >= app.config['PUSHCHUNKSIZE']:
+                inserted += copy_push_chunk(cur, chunk)
+                total += len(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            inserted += copy_push_chunk(cur, chunk)
+            total += len(chunk)
+    except wireformat.TooLarge:
+        # over PUSHMAXROWS, PUSHMAXBYTES or PUSHMAXFRAME
+        dbconn.rollback()
+        abort(413)
+    except ValueError:
+        # malformed JSON, a row that isn't a 9 element array
+        dbconn.rollback()
+        abort(400)
+    except psycopg2.DataError:
+        # malformed row data
+        dbconn.rollback()
+        abort(400)
 
-    # construct SQL statement with appropriate number of boolean operators in the WHERE clause
-    sql = """INSERT INTO tracker_data(gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location)
-VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-"""
-    for record in payload:
-        cur.execute(sql, record)
-        if cur.rowcount != 1:
-            # insert failed?
-            dbconn.rollback()
-            abort(500)
-    
     dbconn.commit()
 
-    return ('', 204) # 204 = HTTP no content
+    return jsonify(inserted_counts(inserted, total))
+
+# rows from a columnar /push body, decompressed and decoded one block at a time
+def push_columnar_records():
+    encoding = request.headers.get('Content-Encoding')
+    if encoding not in (None, '', 'identity') and encoding not in wireformat.ENCODINGS:
+        abort(415)
+    stream = wireformat.DecompressingReader(request.stream, encoding, max_size=app.config['PUSHMAXBYTES'])
+    for kind, data in wireformat.iterframes(stream, app.config['PUSHMAXFRAME']):
+        if kind == b'R':
+            for record in wireformat.decode_block(data):
+                yield record
+
+# COPY into the staging table and move the new rows into tracker_data, see
+# common/batchwriter.py, returns the number of rows inserted
+def copy_push_chunk(cur, chunk):
+    cur.copy_expert(batchwriter.COPY_SQL, io.StringIO(''.join(chunk)))
+    cur.execute(batchwriter.MERGE_SQL)
+    return cur.rowcount
 
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# benchmark of /pull and /push body encodings
+# compares the JSON rows /pull sends with the wireformat.py columnar encoding,
+# uncompressed and with each supported compression, for size and encode/decode time
+# rows are simulated: a few gateways hearing many trackers, sorted like /pull sorts them
+
+import argparse
+parser = argparse.ArgumentParser(description='Sync wire format benchmark')
+
+parser.add_argument('-n', '--count',
+                    type=int,
+                    default=20000,
+                    help='Number of rows per run (default 20000)',
+)
+
+parser.add_argument('-g', '--gateways',
+                    type=int,
+                    default=10,
+                    help='Number of gateways (default 10)',
+)
+
+parser.add_argument('-t', '--trackers',
+                    type=int,
+                    default=100,
+                    help='Number of trackers (default 100)',
+)
+
+parser.add_argument('-b', '--block-size',
+                    type=int,
+                    default=2000,
+                    help='Rows per columnar block, like PULLFETCHSIZE (default 2000)',
+)
+
+parser.add_argument('-r', '--repeat',
+                    type=int,
+                    default=3,
+                    help='Number of runs, the best one is reported (default 3)',
+)
+
+args = parser.parse_args()
+
+import json
+import gzip
+import random
+import struct
+import timeit
+import datetime
+import wireformat
+
+def ewkb(lon, lat, alt):
+    # geography(PointZ, 4326) as psycopg2 returns it
+    return struct.pack('<BIIddd', 1, 0xa0000001, 4326, lon, lat, alt).hex().upper()
+
+# simulated tracker_data records, as the /pull cursor returns them
+random.seed(1)
+gateways = []
+for i in range(args.gateways):
+    gateways.append(('{:016x}'.format(random.getrandbits(64)), ewkb(144.96 + random.uniform(-0.2, 0.2), -37.81 + random.uniform(-0.2, 0.2), random.uniform(0, 100))))
+trackers = ['{:016x}'.format(random.getrandbits(64)) for i in range(args.trackers)]
+start = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+records = []
+for i in range(args.count):
+    gw_id, gw_location = random.choice(gateways)
+    rx = start + datetime.timedelta(seconds=random.randrange(30 * 86400), microseconds=random.randrange(1000000))
+    records.append((
+        gw_id, gw_location, 1, random.choice(trackers), rx, random.randrange(-120, -30), random.randrange(-80, 40) / 4,
+        rx - datetime.timedelta(seconds=random.randrange(5)),
+        ewkb(round(144.96 + random.uniform(-0.2, 0.2), 6), round(-37.81 + random.uniform(-0.2, 0.2), 6), random.randrange(0, 10000) / 100),
+    ))
+records.sort(key=lambda r: (r[0], r[4], r[3]))
+
+# the same as pull() in apiserver.py
+def encode_json(records):
+    return ('[' + ','.join(json.dumps([r[0], r[1], r[2], r[3], r[4].isoformat(), r[5], r[6], r[7].isoformat(), r[8]]) for r in records) + ']').encode()
+
+def decode_json(body):
+    return json.loads(body.decode())
+
+def encode_columnar(records, encoding):
+    compressor = wireformat.Compressor(encoding)
+    out = []
+    for i in range(0, len(records), args.block_size):
+        out.append(compressor.compress(wireformat.rows_frame(records[i:i + args.block_size])))
+    out.append(compressor.flush())
+    return b''.join(out)
+
+def decode_columnar(body, encoding):
+    frames, continuation = wireformat.split_frames(wireformat.decompress(body, encoding))
+    return [row for frame in frames for row in wireformat.decode_block(frame[wireformat.FRAME.size:])]
+
+# make sure the columnar rows match the JSON ones, to the encoding's precision
+for row, original in zip(decode_columnar(encode_columnar(records, None), None), records):
+    assert row[0] == original[0] and row[2] == original[2] and row[3] == original[3], row
+    assert row[4] == original[4].isoformat() and row[7] == original[7].isoformat(), row
+    assert row[5] == original[5] and row[6] == original[6], row
+
+def report(name, size, encode_seconds, decode_seconds):
+    print('{:<20} {:>10} bytes {:>8.1f} bytes/row {:>10.3f} us/row encode {:>10.3f} us/row decode'.format(
+        name, size, size / args.count, encode_seconds * 1000000 / args.count, decode_seconds * 1000000 / args.count,
+    ))
+
+body = encode_json(records)
+report('json',
+    len(body),
+    min(timeit.repeat(lambda: encode_json(records), number=1, repeat=args.repeat)),
+    min(timeit.repeat(lambda: decode_json(body), number=1, repeat=args.repeat)),
+)
+gzipped = gzip.compress(body)
+report('json gzip',
+    len(gzipped),
+    min(timeit.repeat(lambda: gzip.compress(encode_json(records)), number=1, repeat=args.repeat)),
+    min(timeit.repeat(lambda: decode_json(gzip.decompress(gzipped)), number=1, repeat=args.repeat)),
+)
+for encoding in (None,) + wireformat.ENCODINGS:
+    body = encode_columnar(records, encoding)
+    report('columnar {}'.format(encoding or ''),
+        len(body),
+        min(timeit.repeat(lambda: encode_columnar(records, encoding), number=1, repeat=args.repeat)),
+        min(timeit.repeat(lambda: decode_columnar(body, encoding), number=1, repeat=args.repeat)),
+    )
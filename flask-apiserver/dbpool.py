@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# process-wide PostgreSQL connection pool for the flask API server
+# passenger forks worker processes after importing the app, so the real pool is
+# created lazily on first use in each process, never shared across a fork
+
+import os
+import threading
+import psycopg2
+import psycopg2.pool
+
+# server-side prepared statements for the fixed hot queries
+# the read queries use the tracker_latest/gateway_latest tables from
+# simple-apiserver/latest-positions.pgsql, which hold one row per device
+# these are PREPAREd once on every new pooled connection, handlers then run
+# cur.execute("EXECUTE name (%s, ...)", args) and skip the parse/plan step
+PREPARED = {
+    'uplink_insert': """(char(16), float8, float8, float8, int, char(16), timestamptz, int, float8, timestamptz, float8, float8, float8) AS
+        INSERT INTO tracker_data (gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location)
+        VALUES ($1, ST_SetSRID(st_makepoint($2,$3,$4),4326), $5, $6, $7, $8, $9, $10, ST_SetSRID(st_makepoint($11,$12,$13),4326))
+        ON CONFLICT DO NOTHING""",
+    'gwlocation_mid': """AS
+        SELECT 'ffffffffffffffff'::char(16), ST_AsGeoJSON(ST_Centroid(ST_Collect(gw_location::geometry)))
+        FROM gateway_latest""",
+    'gwlocation_all': """AS
+        SELECT gw_id, ST_AsGeoJSON(gw_location)
+        FROM gateway_latest""",
+    # (west, south, east, north) boxes $1-$4 and ($5, $2, $6, $4), the same box twice
+    # unless the viewport crosses the antimeridian, and since $7 or null
+    'gwlocation_bbox': """(float8, float8, float8, float8, float8, float8, timestamptz) AS
+        SELECT gw_id, ST_AsGeoJSON(gw_location)
+        FROM gateway_latest
+        WHERE (gw_location::geometry && ST_MakeEnvelope($1, $2, $3, $4, 4326)
+                OR gw_location::geometry && ST_MakeEnvelope($5, $2, $6, $4, 4326))
+            AND gw_rx_timestamp >= coalesce($7, '-infinity')""",
+    'gwlocation_one': """(char(16)) AS
+        SELECT gw_id, ST_AsGeoJSON(gw_location)
+        FROM gateway_latest
+        WHERE gw_id = $1""",
+    'gwarea_mid': """(float8) AS
+        SELECT 'ffffffffffffffff'::char(16), ST_AsGeoJSON(Box2D(ST_Buffer(ST_SetSRID(ST_Centroid(ST_Collect(gw_location::geometry)),4326)::geography,$1,'quad_segs=1')::geometry))
+        FROM gateway_latest""",
+    'gwarea_one': """(float8, char(16)) AS
+        SELECT gw_id, ST_AsGeoJSON(Box2D(ST_Buffer(gw_location,$1,'quad_segs=1')::geometry))
+        FROM gateway_latest
+        WHERE gw_id = $2""",
+    'trlocation_all': """AS
+        SELECT dev_eui, ST_AsGeoJSON(gps_location)
+        FROM tracker_latest""",
+    'trlocation_bbox': """(float8, float8, float8, float8, float8, float8, timestamptz) AS
+        SELECT dev_eui, ST_AsGeoJSON(gps_location)
+        FROM tracker_latest
+        WHERE (gps_location::geometry && ST_MakeEnvelope($1, $2, $3, $4, 4326)
+                OR gps_location::geometry && ST_MakeEnvelope($5, $2, $6, $4, 4326))
+            AND gps_timestamp >= coalesce($7, '-infinity')""",
+    'trlocation_one': """(char(16)) AS
+        SELECT dev_eui, ST_AsGeoJSON(gps_location)
+        FROM tracker_latest
+        WHERE dev_eui = $1""",
+    # one page of a tracker's trail: (fixes, first fix, last fix, GeoJSON LineString)
+    # a fix heard by several gateways is one point, the line is simplified with
+    # tolerance $5 degrees when it is above 0, with a from $2 defaulting to $6 hours
+    # before to $3 (or now)
+    'trhistory': """(char(16), timestamptz, timestamptz, int, float8, float8) AS
+        WITH page AS (
+            SELECT DISTINCT ON (gps_timestamp) gps_timestamp, gps_location::geometry AS geom
+            FROM tracker_data
+            WHERE dev_eui = $1
+                AND gps_timestamp >= coalesce($2, coalesce($3, now()) - $6 * interval '1 hour')
+                AND gps_timestamp < coalesce($3, 'infinity')
+            ORDER BY gps_timestamp
+            LIMIT $4
+        )
+        SELECT count(*), min(gps_timestamp), max(gps_timestamp),
+            ST_AsGeoJSON(CASE WHEN $5 > 0
+                THEN ST_Simplify(ST_MakeLine(geom ORDER BY gps_timestamp), $5, true)
+                ELSE ST_MakeLine(geom ORDER BY gps_timestamp) END, 6)
+        FROM page""",
+    'gwlatest': """AS
+        SELECT gw_id, gw_rx_timestamp
+        FROM gateway_latest""",
+    # version of the latest tables for conditional GET: (row count, sum of seq, last change)
+    'gateway_version': """AS
+        SELECT count(*), coalesce(sum(seq), 0), max(updated)
+        FROM gateway_latest""",
+    'gateway_version_one': """(char(16)) AS
+        SELECT 1, seq, updated
+        FROM gateway_latest
+        WHERE gw_id = $1""",
+    'tracker_version': """AS
+        SELECT count(*), coalesce(sum(seq), 0), max(updated)
+        FROM tracker_latest""",
+    'tracker_version_one': """(char(16)) AS
+        SELECT 1, seq, updated
+        FROM tracker_latest
+        WHERE dev_eui = $1""",
+}
+
+# raised when no pooled connection becomes free within DBPOOLTIMEOUT seconds
+class PoolTimeout(Exception):
+    pass
+
+# ThreadedConnectionPool that PREPAREs the hot queries on each new connection
+class PreparedConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    def __init__(self, minconn, maxconn, prepared, *args, **kwargs):
+        self.prepared = prepared
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        conn.autocommit = True
+        cur = conn.cursor()
+        for name, statement in self.prepared.items():
+            cur.execute("PREPARE {} {};".format(name, statement))
+        cur.close()
+        return conn
+
+class DBPool(object):
+    def __init__(self, config, prepared=PREPARED):
+        self.config = config
+        self.prepared = prepared
+        self.lock = threading.Lock()
+        self.pid = None
+        self.pool = None
+        self.slots = None
+
+    # return the pool for this process, creating it after a fork if needed
+    def _get_pool(self):
+        if self.pid == os.getpid():
+            return self.pool
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pool = PreparedConnectionPool(
+                    self.config['DBPOOLMIN'],
+                    self.config['DBPOOLMAX'],
+                    self.prepared,
+                    dbname=self.config['DBNAME'],
+                    user=self.config['DBUSER'],
+                    password=self.config['DBPASS'],
+                    host=self.config['DBHOST'],
+                    port=self.config['DBPORT'],
+                )
+                # psycopg2 pools raise immediately when exhausted, so gate checkouts
+                # with a semaphore to get a blocking checkout with a timeout
+                self.slots = threading.BoundedSemaphore(self.config['DBPOOLMAX'])
+                self.pid = os.getpid()
+        return self.pool
+
+    # check out a connection, waiting up to DBPOOLTIMEOUT seconds for one to be free
+    def getconn(self):
+        pool = self._get_pool()
+        if not self.slots.acquire(timeout=self.config['DBPOOLTIMEOUT']):
+            raise PoolTimeout()
+        try:
+            # retry once per pool slot in case several idle connections went stale
+            # eg. after a database restart
+            for i in range(self.config['DBPOOLMAX']):
+                conn = pool.getconn()
+                if self._healthy(conn):
+                    return conn
+                pool.putconn(conn, close=True)
+            raise psycopg2.OperationalError('no healthy database connection available')
+        except:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        try:
+            self._get_pool().putconn(conn, close=close or bool(conn.closed))
+        finally:
+            self.slots.release()
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if not self.config['DBPOOLCHECK']:
+            return True
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+        except psycopg2.Error:
+            return False
+        return True
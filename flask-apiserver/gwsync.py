@@ -4,6 +4,9 @@
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
 # sync tracker_data by comparing timestamps, then pull & push data
+# data is copied in chunks of --chunk-size rows, and an interrupted run carries on
+# from the last pushed chunk next time, see syncclient.py
+# to keep many servers in sync continuously use gwsyncd.py instead
 # NOTE: there is a relatively slow race condition on multiple runs of this script
 # this script may connect to different passenger processes on multiple runs
 # but the first process may still be committing the transaction when the second
@@ -43,84 +46,56 @@ parser.add_argument('-B', '--local-uri-base',
                     help='Local URI base for constructing request URLs (default none)',
 )
 
+parser.add_argument('-c', '--chunk-size',
+                    type=int,
+                    default=5000,
+                    help='Rows per pull/push request (default 5000)',
+)
+
+parser.add_argument('-S', '--state-file',
+                    type=str,
+                    default='~/.gwsync.json',
+                    help='File to save sync progress in (default ~/.gwsync.json)',
+)
+
+parser.add_argument('-j', '--json',
+                    action='store_true',
+                    help='Only use JSON, not the compressed columnar format',
+)
+
+parser.add_argument('-R', '--reconcile',
+                    action='store_true',
+                    help='Compare the whole history with /digest and repair any differences, instead of only syncing newer data',
+)
+
+parser.add_argument('--buckets',
+                    type=int,
+                    default=16,
+                    help='Time buckets per digest range in reconcile mode (default 16)',
+)
+
+parser.add_argument('--leaf-rows',
+                    type=int,
+                    default=1000,
+                    help='Compare differing buckets row by row once they hold this many rows or fewer in reconcile mode (default 1000)',
+)
+
 args = parser.parse_args()
 
-import http.client
-import json
-from datetime import datetime
+import syncclient
 
-if args.https:
-    l_conn = http.client.HTTPSConnection(args.local_host)
-else:
-    l_conn = http.client.HTTPConnection(args.local_host)
+scheme = 'https' if args.https else 'http'
+local = syncclient.Server('{}://{}{}'.format(scheme, args.local_host, args.local_uri_base), columnar=not args.json)
+remote = syncclient.Server('{}://{}{}'.format(scheme, args.remote_host, args.uri_base), columnar=not args.json)
+state = syncclient.StateFile(args.state_file)
 
-if args.https:
-    r_conn = http.client.HTTPSConnection(args.remote_host)
+# finish any sync that was interrupted last time before comparing timestamps again
+syncclient.resume(state, local, remote, args.chunk_size)
+if args.reconcile:
+    pushed, pulled = syncclient.reconcile(state, local, remote, args.buckets, args.leaf_rows, args.chunk_size)
+    print('RECONCILED pushed {} rows, pulled {} rows'.format(pushed, pulled))
 else:
-    r_conn = http.client.HTTPConnection(args.remote_host)
-
-headers = {
-    'Content-type': 'application/json',
-    'Accept': 'application/json',
-}
-
-# grab timestamps
-l_conn.request('GET', args.local_uri_base + '/gwlatest', None, headers)
-local_latest = json.loads(l_conn.getresponse().read().decode())
-l_conn.close()
-
-r_conn.request('GET', args.uri_base + '/gwlatest', None, headers)
-remote_latest = json.loads(r_conn.getresponse().read().decode())
-r_conn.close()
-
-push_list = {}
-pull_list = {}
-
-for gw_id in local_latest.keys():
-    # timestamps are in iso8601 format, eg 2019-01-03T22:48:16.080583+00:00
-    # python <3.7 doesn't have datetime.fromisoformat() so use strptime
-    local_ts = datetime.strptime(local_latest[gw_id], '%Y-%m-%dT%H:%M:%S.%f%z')
-    if gw_id in remote_latest:
-        remote_ts = datetime.strptime(remote_latest[gw_id], '%Y-%m-%dT%H:%M:%S.%f%z')
-        # remove key from remote_latest, because anything left will be added to the pull list
-        del remote_latest[gw_id]
-        if local_ts < remote_ts:
-            print('PULL {} at {}'.format(gw_id, local_ts.isoformat()))
-            pull_list[gw_id] = local_ts.isoformat()
-        elif local_ts > remote_ts:
-            print('PUSH {} at {}'.format(gw_id, remote_ts.isoformat()))
-            push_list[gw_id] = remote_ts.isoformat()
-        else:
-            # if timestamps match then no need to push or pull
-            print('MATCH {} at {}'.format(gw_id, local_ts.isoformat()))
-    else:
-        # remote doesn't have this gw, push all
-        print('PUSH {} at min'.format(gw_id))
-        push_list[gw_id] = datetime.min.isoformat()
-
-for gw_id in remote_latest.keys():
-    # anything left in remote_latest will be new, pull all
-    print('PULL {} at min'.format(gw_id))
-    pull_list[gw_id] = datetime.min.isoformat()
-
-if len(push_list) > 0:
-    # push_list: pull from local, push to remote
-    print('PULL local, PUSH remote')
-    l_conn.connect()
-    r_conn.connect()
-    l_conn.request('POST', args.local_uri_base + '/pull', json.dumps(push_list), headers)
-    r_conn.request('POST', args.uri_base + '/push', l_conn.getresponse().read(), headers)
-    r_conn.getresponse().read() # do nothing but wait for a 204
-    l_conn.close()
-    r_conn.close()
-
-if len(pull_list) > 0:
-    # pull_list: pull from remote, push to local
-    print('PULL remote, PUSH local')
-    l_conn.connect()
-    r_conn.connect()
-    r_conn.request('POST', args.uri_base + '/pull', json.dumps(pull_list), headers)
-    l_conn.request('POST', args.local_uri_base + '/push', r_conn.getresponse().read(), headers)
-    l_conn.getresponse().read() # do nothing but wait for a 204
-    l_conn.close()
-    r_conn.close()
+    syncclient.sync(state, local, remote, chunk_size=args.chunk_size)
+
+local.close()
+remote.close()
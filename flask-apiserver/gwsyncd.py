@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# sync daemon: keep the local API server in sync with a list of peers
+# eg. gwsyncd.py -l http://127.0.0.1 http://gw1.example https://gw2.example/loratracker
+# up to --workers peers are synced at once, each over its own kept-alive connection
+# the most out of date peers go first, peers that keep failing are tried less often,
+# and rows a peer sent us (or we sent it) are never sent back to it, so data that
+# changed on one server spreads through the mesh once instead of bouncing between peers
+# each sync works like gwsync.py, see syncclient.py
+
+# make sure running on python3
+import sys
+assert (sys.version_info[0] == 3), "This code requires python3"
+
+# handle arguments
+import argparse
+parser = argparse.ArgumentParser(description='tracker_data sync daemon')
+
+parser.add_argument('peers',
+                    type=str,
+                    nargs='+',
+                    help='Peer API server URLs, eg. http://host or https://host/uri-base',
+)
+
+parser.add_argument('-l', '--local',
+                    type=str,
+                    default='http://127.0.0.1',
+                    help='Local API server URL (default http://127.0.0.1)',
+)
+
+parser.add_argument('-w', '--workers',
+                    type=int,
+                    default=4,
+                    help='Maximum peers to sync at once (default 4)',
+)
+
+parser.add_argument('-i', '--interval',
+                    type=float,
+                    default=60,
+                    help='Minimum seconds between syncs with the same peer (default 60)',
+)
+
+parser.add_argument('-m', '--max-backoff',
+                    type=float,
+                    default=3600,
+                    help='Maximum seconds to wait before retrying a failing peer (default 3600)',
+)
+
+parser.add_argument('-t', '--timeout',
+                    type=float,
+                    default=60,
+                    help='Network timeout in seconds (default 60)',
+)
+
+parser.add_argument('-c', '--chunk-size',
+                    type=int,
+                    default=5000,
+                    help='Rows per pull/push request (default 5000)',
+)
+
+parser.add_argument('-S', '--state-file',
+                    type=str,
+                    default='~/.gwsyncd.json',
+                    help='File to save sync progress in (default ~/.gwsyncd.json)',
+)
+
+args = parser.parse_args()
+
+import time
+import threading
+import concurrent.futures
+import syncclient
+
+# weight of the latest sync in the link quality averages
+QUALITY_WEIGHT = 0.2
+
+class Peer(object):
+    def __init__(self, url):
+        self.server = syncclient.Server(url, args.timeout)
+        self.url = self.server.url
+        self.last_success = None # time.monotonic() of the last successful sync
+        self.next_due = 0
+        self.failures = 0
+        self.quality = 1.0 # moving average of sync success, 0 to 1
+        self.known = {} # gw_id: newest gw_rx_timestamp this peer is known to have
+
+    # peers that have gone longest without a sync go first, scaled down by how
+    # often syncing with them fails
+    def priority(self, now):
+        if self.last_success is None:
+            return float('inf')
+        return (now - self.last_success) * self.quality
+
+    def log(self, message):
+        print('{}: {}'.format(self.url, message))
+
+# http.client connections can't be shared between threads, so each worker keeps
+# its own connection to the local server
+worker = threading.local()
+
+def local_server():
+    if not hasattr(worker, 'local'):
+        worker.local = syncclient.Server(args.local, args.timeout)
+    return worker.local
+
+# one sync with a peer, runs in a worker thread, returns the number of rows copied
+def sync_peer(peer):
+    local = local_server()
+    try:
+        total = syncclient.resume(state, local, peer.server, args.chunk_size, peer.log)
+        pushed, pulled, local_latest, remote_latest, push_list, pull_list = syncclient.sync(
+            state, local, peer.server, peer.known, args.chunk_size, lambda message: None,
+        )
+    except Exception:
+        local.close()
+        raise
+    # the peer now has everything we had, and we have everything it had
+    for gw_id in push_list:
+        peer.known[gw_id] = local_latest[gw_id]
+    for gw_id in pull_list:
+        peer.known[gw_id] = remote_latest[gw_id]
+    if pushed > 0 or pulled > 0:
+        peer.log('pushed {} rows, pulled {} rows'.format(pushed, pulled))
+    return total + pushed + pulled
+
+state = syncclient.StateFile(args.state_file)
+peers = [Peer(url) for url in args.peers]
+running = {} # future: peer
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+    while True:
+        now = time.monotonic()
+        busy = set(running.values())
+        due = [peer for peer in peers if peer not in busy and peer.next_due <= now]
+        due.sort(key=lambda peer: peer.priority(now), reverse=True)
+        for peer in due[:args.workers - len(running)]:
+            running[executor.submit(sync_peer, peer)] = peer
+
+        if len(running) == 0:
+            time.sleep(1)
+            continue
+        done, pending = concurrent.futures.wait(running, timeout=1, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            peer = running.pop(future)
+            now = time.monotonic()
+            try:
+                future.result()
+            except Exception as e:
+                # network or server errors, a response that wasn't what we expected
+                # (eg. a corrupt body), or a local failure like writing the state file
+                # only this peer backs off, the others keep syncing
+                if not isinstance(e, (syncclient.SyncError, ValueError, KeyError)):
+                    e = '{}: {}'.format(type(e).__name__, e)
+                peer.failures += 1
+                peer.quality *= 1 - QUALITY_WEIGHT
+                # back off exponentially from a failing peer
+                delay = min(args.interval * 2 ** peer.failures, args.max_backoff)
+                peer.next_due = now + delay
+                peer.server.close()
+                peer.log('sync failed, retrying in {:.0f}s: {}'.format(delay, e))
+                continue
+            peer.failures = 0
+            peer.quality = peer.quality * (1 - QUALITY_WEIGHT) + QUALITY_WEIGHT
+            peer.last_success = now
+            peer.next_due = now + args.interval
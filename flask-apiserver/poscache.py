@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# in-memory cache of the latest tracker and gateway positions for one worker process
+# warmed from the tracker_latest/gateway_latest tables, then kept current from the
+# NOTIFY events sent by the update_latest_positions() trigger, see
+# simple-apiserver/latest-positions.pgsql
+# like dbpool.py, the listener thread is started lazily after passenger forks
+# the same listener also fans changed positions out to any number of subscribers
+# (eg. /stream clients), so every viewer in a process shares one LISTEN connection
+
+import os
+import sys
+import json
+import queue
+import math
+import time
+import select
+import datetime
+import threading
+import psycopg2
+
+CHANNELS = ('tracker_latest', 'gateway_latest', 'latest_rebuild')
+
+EARTH_RADIUS = 6371008.8 # M, mean radius
+
+def parse_ts(ts):
+    return datetime.datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S.%f').replace(tzinfo=datetime.timezone.utc)
+
+# same result as ST_AsGeoJSON(ST_Centroid(ST_Collect(points))) - the mean of the points
+def centroid(points):
+    lon = sum(p['coordinates'][0] for p in points) / len(points)
+    lat = sum(p['coordinates'][1] for p in points) / len(points)
+    return {'type': 'Point', 'coordinates': [lon, lat]}
+
+# bounding box polygon of a radius (M) around a point, like
+# ST_AsGeoJSON(Box2D(ST_Buffer(point::geography, radius, 'quad_segs=1')::geometry))
+# on a sphere rather than the spheroid, which is close enough for a map extent
+def area_box(point, radius):
+    lon, lat = point['coordinates'][0], point['coordinates'][1]
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    dlon = math.degrees(math.asin(min(1.0, math.sin(radius / EARTH_RADIUS) / max(math.cos(math.radians(lat)), 1e-12))))
+    xmin, xmax = lon - dlon, lon + dlon
+    ymin, ymax = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+    return {'type': 'Polygon', 'coordinates': [[[xmin, ymin], [xmin, ymax], [xmax, ymax], [xmax, ymin], [xmin, ymin]]]}
+
+class PositionCache(object):
+    def __init__(self, connect, poll_interval=5):
+        self.connect = connect # callable returning a new psycopg2 connection
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.thread = None
+        self.warm = threading.Event()
+        self.trackers = {} # dev_eui: (gps_timestamp, geojson, seq, updated)
+        self.gateways = {} # gw_id: (gw_rx_timestamp, geojson, seq, updated)
+        self.versions = {'tracker': (0, 0, None), 'gateway': (0, 0, None)}
+        self.subscribers = set()
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.warm = threading.Event()
+            self.trackers = {}
+            self.gateways = {}
+            self.versions = {'tracker': (0, 0, None), 'gateway': (0, 0, None)}
+            self.subscribers = set()
+            self.thread = threading.Thread(target=self._run, name='poscache', daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    # True once the cache is warm and following NOTIFY events
+    # handlers should fall back to the database while this is False
+    def ready(self):
+        if self.pid != os.getpid():
+            self._start()
+        return self.warm.is_set()
+
+    # copies, safe to iterate while the listener thread updates the cache
+    def tracker_positions(self):
+        with self.lock:
+            return dict(self.trackers)
+
+    def gateway_positions(self):
+        with self.lock:
+            return dict(self.gateways)
+
+    # kind is "tracker" or "gateway"
+    def position(self, kind, key):
+        with self.lock:
+            if kind == 'tracker':
+                return self.trackers.get(key)
+            return self.gateways.get(key)
+
+    # (row count, sum of seq, last change) of the whole table, the same as the
+    # gateway_version/tracker_version prepared statements in dbpool.py
+    def version(self, kind):
+        with self.lock:
+            return self.versions[kind]
+
+    # register for changes, returns a queue of (event, data) tuples where event is
+    # "tracker" or "gateway" with data {"id": ..., "geojson": ...}, or "reload" when
+    # the subscriber may have missed changes and should fetch everything again
+    # a subscriber that falls more than max_queue events behind gets a final
+    # "reload" and no more events, it should unsubscribe and start again
+    def subscribe(self, max_queue=1000):
+        if self.pid != os.getpid():
+            self._start()
+        subscriber = queue.Queue(max_queue)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    # called with self.lock held
+    def _publish(self, event, data):
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.put_nowait((event, data))
+            except queue.Full:
+                # too slow, drop it rather than hold up everyone else
+                self.subscribers.discard(subscriber)
+                try:
+                    subscriber.get_nowait()
+                    subscriber.put_nowait(('reload', None))
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def _run(self):
+        while True:
+            dbconn = None
+            try:
+                dbconn = self.connect()
+                dbconn.autocommit = True
+                cur = dbconn.cursor()
+                # LISTEN before loading so no update can fall between the two
+                for channel in CHANNELS:
+                    cur.execute("LISTEN {};".format(channel))
+                self._load(cur)
+                self.warm.set()
+                while True:
+                    if select.select([dbconn], [], [], self.poll_interval) == ([], [], []):
+                        # nothing happened, make sure the connection is still alive
+                        cur.execute("SELECT 1;")
+                        continue
+                    dbconn.poll()
+                    reload = False
+                    while dbconn.notifies:
+                        notify = dbconn.notifies.pop(0)
+                        if notify.channel == 'latest_rebuild':
+                            reload = True
+                        else:
+                            self._apply(notify.channel, json.loads(notify.payload))
+                    if reload:
+                        self._load(cur)
+            except Exception as e:
+                # a lost connection, or a NOTIFY payload that couldn't be applied
+                # stop serving from the cache until it has been reloaded, updates
+                # may have been missed, and the thread must keep running or the
+                # cache would stay warm and go stale
+                self.warm.clear()
+                with self.lock:
+                    self._publish('reload', None)
+                if isinstance(e, psycopg2.Error):
+                    print('poscache: database connection lost, reconnecting: {}'.format(e), file=sys.stderr)
+                else:
+                    print('poscache: bad notification, reloading: {!r}'.format(e), file=sys.stderr)
+                if dbconn is not None:
+                    try:
+                        dbconn.close()
+                    except psycopg2.Error:
+                        pass
+                time.sleep(self.poll_interval)
+
+    def _load(self, cur):
+        cur.execute("SELECT dev_eui, gps_timestamp, ST_AsGeoJSON(gps_location), seq, updated FROM tracker_latest;")
+        trackers = {}
+        for record in cur:
+            trackers[record[0]] = (record[1], json.loads(record[2]), record[3], record[4])
+        cur.execute("SELECT gw_id, gw_rx_timestamp, ST_AsGeoJSON(gw_location), seq, updated FROM gateway_latest;")
+        gateways = {}
+        for record in cur:
+            gateways[record[0]] = (record[1], json.loads(record[2]), record[3], record[4])
+        with self.lock:
+            self.trackers = trackers
+            self.gateways = gateways
+            self.versions = {'tracker': self._version(trackers), 'gateway': self._version(gateways)}
+            self._publish('reload', None)
+
+    def _version(self, positions):
+        if len(positions) == 0:
+            return (0, 0, None)
+        return (len(positions), sum(p[2] for p in positions.values()), max(p[3] for p in positions.values()))
+
+    def _apply(self, channel, update):
+        ts = parse_ts(update['ts'])
+        with self.lock:
+            if channel == 'tracker_latest':
+                positions = self.trackers
+                event = 'tracker'
+            else:
+                positions = self.gateways
+                event = 'gateway'
+            # notifications arrive in commit order, but never go backwards in time
+            current = positions.get(update['id'])
+            if current is None or current[0] < ts:
+                updated = parse_ts(update['updated'])
+                positions[update['id']] = (ts, update['geojson'], update['seq'], updated)
+                # keep the table version current without summing every row again
+                count, seq_sum, last = self.versions[event]
+                if current is None:
+                    count += 1
+                else:
+                    seq_sum -= current[2]
+                seq_sum += update['seq']
+                if last is None or last < updated:
+                    last = updated
+                self.versions[event] = (count, seq_sum, last)
+                self._publish(event, {'id': update['id'], 'geojson': update['geojson']})
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# serve GET /stream for map.html from one threaded process next to the passenger app
+# passenger runs one request at a time in each Python process, so a stream held open
+# there takes a whole worker process away from /uplink and the other endpoints
+# here each open stream is a thread, and all of them share the position cache's
+# single LISTEN connection
+# eg. streamserver.py -p 8090, with Apache proxying /stream to it, see README.md
+# only /stream is served, every other path is 404
+
+# make sure running on python3
+import sys
+assert (sys.version_info[0] == 3), "This code requires python3"
+
+# handle arguments
+import argparse
+parser = argparse.ArgumentParser(description='Server-Sent Events server for map.html')
+
+parser.add_argument('-l', '--listen',
+                    type=str,
+                    default='127.0.0.1',
+                    help='Address to listen on (default 127.0.0.1)',
+)
+
+parser.add_argument('-p', '--port',
+                    type=int,
+                    default=8090,
+                    help='TCP port to listen on (default 8090)',
+)
+
+parser.add_argument('-c', '--max-clients',
+                    type=int,
+                    default=None,
+                    help='Maximum open streams, further viewers get HTTP 503 and poll instead (default STREAMMAXCLIENTS from the config)',
+)
+
+args = parser.parse_args()
+
+import threading
+import werkzeug.serving
+import apiserver
+
+# the config turns /stream off for the passenger app, this process is where it runs
+apiserver.app.config['STREAM'] = True
+if args.max_clients is not None:
+    apiserver.stream_slots = threading.BoundedSemaphore(args.max_clients)
+if apiserver.cache is None:
+    print('/stream needs POSCACHE enabled', file=sys.stderr)
+    sys.exit(1)
+
+def application(environ, start_response):
+    if environ.get('PATH_INFO') != '/stream':
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'only /stream is served here\n']
+    return apiserver.app(environ, start_response)
+
+server = werkzeug.serving.make_server(args.listen, args.port, application, threaded=True)
+print('serving /stream on {} port {}'.format(args.listen, args.port))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# client side of tracker_data sync between API servers, used by gwsync.py and gwsyncd.py
+# servers are compared with /gwlatest, then rows are copied with /pull and /push in
+# chunks, in (gw_id, gw_rx_timestamp, dev_eui) order using the /pull continuation
+# token as a watermark, and the next chunk is pulled while the previous one is pushed
+# the watermark is saved in a state file after every pushed chunk, so an interrupted
+# copy carries on from the last pushed chunk instead of starting over
+# connections are plain http.client connections, kept alive between requests
+# rows are fetched in the compressed columnar format of wireformat.py when the
+# server offers it and passed on to the other server without decoding, falling
+# back to JSON for servers that don't support it
+
+import os
+import json
+import threading
+import http.client
+import urllib.parse
+import concurrent.futures
+from datetime import datetime, timedelta, timezone
+import wireformat
+
+class SyncError(Exception):
+    pass
+
+# request headers for JSON requests
+HEADERS = {
+    'Content-type': 'application/json',
+    'Accept': 'application/json',
+}
+
+# an API server, url is eg. http://127.0.0.1 or https://host.example/loratracker
+# columnar=False sticks to JSON
+class Server(object):
+    def __init__(self, url, timeout=60, columnar=True):
+        self.url = url
+        # formats to try for /push, dropped as the server rejects them with 415
+        self.push_formats = [('json', None)]
+        if columnar:
+            self.push_formats = [('columnar', e) for e in wireformat.ENCODINGS] + self.push_formats
+        parts = urllib.parse.urlsplit(url if '://' in url else 'http://' + url)
+        if parts.scheme == 'https':
+            self.conn = http.client.HTTPSConnection(parts.netloc, timeout=timeout)
+        else:
+            self.conn = http.client.HTTPConnection(parts.netloc, timeout=timeout)
+        self.base = parts.path.rstrip('/')
+
+    # send a request and read the whole response, returns (status, reason, body, response headers)
+    def request(self, method, path, body=None, headers=HEADERS):
+        try:
+            self.conn.request(method, self.base + path, body, headers)
+            response = self.conn.getresponse()
+            return (response.status, response.reason, response.read(), response.headers)
+        except (OSError, http.client.HTTPException) as e:
+            # start a new connection next time
+            self.conn.close()
+            raise SyncError('{}: {}'.format(self.url, e))
+
+    def close(self):
+        self.conn.close()
+
+# sync progress saved in a JSON file, shared by all threads
+# {key: {direction: {"request": request_list, "continuation": token}}}
+class StateFile(object):
+    def __init__(self, filename):
+        self.filename = os.path.expanduser(filename)
+        self.lock = threading.Lock()
+        try:
+            with open(self.filename) as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            self.state = {}
+
+    # unfinished copies for key, {direction: progress}
+    def pending(self, key):
+        with self.lock:
+            return dict(self.state.get(key, {}))
+
+    # progress None means the copy is finished
+    def update(self, key, direction, progress):
+        with self.lock:
+            if progress is None:
+                self.state.get(key, {}).pop(direction, None)
+                if key in self.state and len(self.state[key]) == 0:
+                    del self.state[key]
+            else:
+                self.state.setdefault(key, {})[direction] = progress
+            # write to a temporary file and rename, so a crash never leaves a half written state file
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(self.state, f)
+            os.replace(self.filename + '.tmp', self.filename)
+
+# timestamps are in iso8601 format, eg 2019-01-03T22:48:16.080583+00:00
+# python <3.7 doesn't have datetime.fromisoformat() so use strptime
+# .isoformat() leaves out the fraction when it is zero
+def parse_ts(ts):
+    if '.' in ts:
+        return datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S.%f%z')
+    return datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S%z')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+# exact microseconds since 1970, bucket boundaries are worked out in whole microseconds
+def to_microseconds(ts):
+    return (parse_ts(ts) - EPOCH) // MICROSECOND
+
+def from_microseconds(us):
+    return (EPOCH + us * MICROSECOND).isoformat()
+
+def get_latest(server):
+    status, reason, body, headers = server.request('GET', '/gwlatest')
+    if status != 200:
+        raise SyncError('{}: gwlatest failed: {} {}'.format(server.url, status, reason))
+    return json.loads(body.decode())
+
+# compare /gwlatest of both ends, returns (push_list, pull_list) of {gw_id: timestamp}
+# to send as /pull requests
+# known is {gw_id: timestamp} the remote is known to have already (eg. rows it sent
+# us, whose commit its /gwlatest may not show yet), nothing older is pushed back to it
+def compare(local_latest, remote_latest, known={}, log=print):
+    remote_latest = dict(remote_latest)
+    push_list = {}
+    pull_list = {}
+
+    for gw_id in local_latest.keys():
+        local_ts = parse_ts(local_latest[gw_id])
+        remote_ts = None
+        if gw_id in remote_latest:
+            remote_ts = parse_ts(remote_latest[gw_id])
+            # remove key from remote_latest, because anything left will be added to the pull list
+            del remote_latest[gw_id]
+        if gw_id in known:
+            known_ts = parse_ts(known[gw_id])
+            if remote_ts is None or remote_ts < known_ts:
+                remote_ts = known_ts
+        if remote_ts is None:
+            # remote doesn't have this gw, push all
+            log('PUSH {} at min'.format(gw_id))
+            push_list[gw_id] = datetime.min.isoformat()
+        elif local_ts < remote_ts:
+            log('PULL {} at {}'.format(gw_id, local_ts.isoformat()))
+            pull_list[gw_id] = local_ts.isoformat()
+        elif local_ts > remote_ts:
+            log('PUSH {} at {}'.format(gw_id, remote_ts.isoformat()))
+            push_list[gw_id] = remote_ts.isoformat()
+        else:
+            # if timestamps match then no need to push or pull
+            log('MATCH {} at {}'.format(gw_id, local_ts.isoformat()))
+
+    for gw_id in remote_latest.keys():
+        # anything left in remote_latest will be new, pull all
+        log('PULL {} at min'.format(gw_id))
+        pull_list[gw_id] = datetime.min.isoformat()
+
+    return (push_list, pull_list)
+
+# rows of one /pull page, as JSON encoded rows or as columnar frames
+class Chunk(object):
+    def __init__(self, rows=None, frames=None):
+        self.rows = rows
+        self.frames = frames
+        if frames is None:
+            self.count = len(rows)
+        else:
+            self.count = sum(wireformat.COUNT.unpack_from(frame, wireformat.FRAME.size)[0] for frame in frames)
+
+    def __len__(self):
+        return self.count
+
+    def json_body(self):
+        if self.rows is None:
+            self.rows = [json.dumps(row) for row in self.decoded()]
+        return '[' + ','.join(self.rows) + ']'
+
+    # the rows as lists
+    def decoded(self):
+        if self.frames is None:
+            return [json.loads(row) for row in self.rows]
+        return [row for frame in self.frames for row in wireformat.decode_block(frame[wireformat.FRAME.size:])]
+
+# pull one chunk, returns (chunk, continuation) where continuation is None once
+# there is nothing more to pull
+def pull_chunk(server, request_list, continuation, chunk_size):
+    path = '/pull?limit={}'.format(chunk_size)
+    if continuation is not None:
+        path += '&continuation=' + urllib.parse.quote(continuation)
+    accept = 'application/x-ndjson'
+    if server.push_formats[0][0] == 'columnar':
+        accept = wireformat.MIMETYPE + ', application/x-ndjson;q=0.5'
+    status, reason, body, headers = server.request('POST', path, json.dumps(request_list), {
+        'Content-type': 'application/json',
+        'Accept': accept,
+        'Accept-Encoding': ', '.join(wireformat.ENCODINGS),
+    })
+    if status == 404:
+        # data not found
+        return (Chunk([]), None)
+    if status != 200:
+        raise SyncError('{}: pull failed: {} {}'.format(server.url, status, reason))
+    body = wireformat.decompress(body, headers.get('Content-Encoding'))
+    content_type = headers.get_content_type()
+    if content_type == wireformat.MIMETYPE:
+        frames, continuation = wireformat.split_frames(body)
+        return (Chunk(frames=frames), continuation)
+    if content_type == 'application/json':
+        # older server without NDJSON, which sends one JSON array and may not page
+        try:
+            elements = json.loads(body.decode())
+        except ValueError as e:
+            raise SyncError('{}: pull failed: malformed JSON: {}'.format(server.url, e))
+        if not isinstance(elements, list):
+            raise SyncError('{}: pull failed: expected a JSON array'.format(server.url))
+        continuation = None
+        if len(elements) > 0 and isinstance(elements[-1], dict):
+            continuation = elements.pop()['continuation']
+        return (Chunk([json.dumps(row) for row in elements]), continuation)
+    if content_type != 'application/x-ndjson':
+        raise SyncError('{}: pull failed: unexpected Content-Type {}, the server may be too old to sync with'.format(server.url, content_type))
+    rows = []
+    continuation = None
+    for line in body.decode().splitlines():
+        if line.startswith('{'):
+            continuation = json.loads(line)['continuation']
+        elif line:
+            rows.append(line)
+    return (Chunk(rows), continuation)
+
+def push_chunk(server, chunk):
+    while True:
+        form, encoding = server.push_formats[0]
+        if form == 'columnar' and chunk.frames is not None:
+            headers = {'Content-type': wireformat.MIMETYPE}
+            if encoding is not None:
+                headers['Content-Encoding'] = encoding
+            body = wireformat.compress(b''.join(chunk.frames), encoding)
+        else:
+            headers = HEADERS
+            body = chunk.json_body()
+        status, reason, response_body, response_headers = server.request('POST', '/push', body, headers)
+        if status == 415 and len(server.push_formats) > 1 and headers is not HEADERS:
+            # older server, or no zstd there, try the next format
+            server.push_formats.pop(0)
+            continue
+        if status // 100 != 2:
+            raise SyncError('{}: push failed: {} {}'.format(server.url, status, reason))
+        return
+
+# copy everything newer than request_list from src to dst, starting after continuation
+# progress is kept in state under (key, direction) until the copy is finished
+# returns the number of rows copied
+def copy(state, key, direction, src, dst, request_list, continuation=None, chunk_size=5000, log=print):
+    state.update(key, direction, {'request': request_list, 'continuation': continuation})
+    total = 0
+    # one worker thread pushes, so pushes stay in watermark order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pusher:
+        rows, next_continuation = pull_chunk(src, request_list, continuation, chunk_size)
+        while len(rows) > 0:
+            pushing = pusher.submit(push_chunk, dst, rows)
+            following = ([], None)
+            try:
+                if next_continuation is not None:
+                    following = pull_chunk(src, request_list, next_continuation, chunk_size)
+            finally:
+                # only move the watermark once the chunk has been pushed
+                pushing.result()
+                total += len(rows)
+                if next_continuation is None:
+                    state.update(key, direction, None)
+                else:
+                    state.update(key, direction, {'request': request_list, 'continuation': next_continuation})
+            log('{} {} rows'.format(direction.upper(), total))
+            rows, next_continuation = following
+    if total == 0:
+        # nothing was pulled
+        state.update(key, direction, None)
+    return total
+
+# finish any copies between local and remote that were interrupted last time
+# returns the number of rows copied
+def resume(state, local, remote, chunk_size=5000, log=print):
+    key = '{} {}'.format(local.url, remote.url)
+    total = 0
+    for direction, progress in state.pending(key).items():
+        log('RESUME {}'.format(direction.upper()))
+        if direction == 'push':
+            total += copy(state, key, 'push', local, remote, progress['request'], progress['continuation'], chunk_size, log)
+        else:
+            total += copy(state, key, 'pull', remote, local, progress['request'], progress['continuation'], chunk_size, log)
+    return total
+
+# one full sync between local and remote, returns (rows pushed, rows pulled, local_latest, remote_latest, push_list, pull_list)
+def sync(state, local, remote, known={}, chunk_size=5000, log=print):
+    key = '{} {}'.format(local.url, remote.url)
+    local_latest = get_latest(local)
+    remote_latest = get_latest(remote)
+    push_list, pull_list = compare(local_latest, remote_latest, known, log)
+    pushed = 0
+    pulled = 0
+    if len(push_list) > 0:
+        # push_list: pull from local, push to remote
+        log('PULL local, PUSH remote')
+        pushed = copy(state, key, 'push', local, remote, push_list, None, chunk_size, log)
+    if len(pull_list) > 0:
+        # pull_list: pull from remote, push to local
+        log('PULL remote, PUSH local')
+        pulled = copy(state, key, 'pull', remote, local, pull_list, None, chunk_size, log)
+    return (pushed, pulled, local_latest, remote_latest, push_list, pull_list)
+
+# every row in request_list from server, as lists
+def fetch_rows(server, request_list, chunk_size=5000):
+    rows = []
+    continuation = None
+    while True:
+        chunk, continuation = pull_chunk(server, request_list, continuation, chunk_size)
+        rows.extend(chunk.decoded())
+        if continuation is None:
+            return rows
+
+# /digest of [gw_id, from, to] ranges, returns one {bucket: (count, hash, first, last)}
+# per range, first and last in microseconds
+def get_digest(server, ranges, buckets):
+    status, reason, body, headers = server.request('POST', '/digest?buckets={}'.format(buckets), json.dumps(ranges))
+    if status != 200:
+        raise SyncError('{}: digest failed: {} {}'.format(server.url, status, reason))
+    digests = []
+    for entries in json.loads(body.decode()):
+        digests.append(dict((b, (count, digest, to_microseconds(first), to_microseconds(last))) for b, count, digest, first, last in entries))
+    return digests
+
+# full consistency check and repair between local and remote
+# walks down a tree of /digest time buckets, only looking closer at buckets whose row
+# count or hash differ, so two servers that are already in sync only exchange one
+# digest per gateway
+# buckets that only one side has rows in are copied with copy(), buckets that both
+# have but differ are narrowed down until they hold at most leaf_rows rows, and then
+# the rows of both sides are compared and only the missing ones sent
+# returns (rows pushed, rows pulled)
+def reconcile(state, local, remote, buckets=16, leaf_rows=1000, chunk_size=5000, log=print):
+    key = '{} {}'.format(local.url, remote.url)
+    gateways = sorted(set(get_latest(local)) | set(get_latest(remote)))
+    work = [[gw_id, None, None] for gw_id in gateways]
+    push_ranges = []
+    pull_ranges = []
+    leaves = []
+    level = 0
+    while len(work) > 0:
+        level += 1
+        local_digests = get_digest(local, work, buckets)
+        remote_digests = get_digest(remote, work, buckets)
+        next_work = []
+        differ = 0
+        for (gw_id, lo, hi), local_buckets, remote_buckets in zip(work, local_digests, remote_digests):
+            for b in set(local_buckets) | set(remote_buckets):
+                l = local_buckets.get(b)
+                r = remote_buckets.get(b)
+                if l is not None and r is not None and l[:2] == r[:2]:
+                    continue
+                differ += 1
+                if r is None:
+                    push_ranges.append([gw_id, from_microseconds(l[2]), from_microseconds(l[3] + 1)])
+                elif l is None:
+                    pull_ranges.append([gw_id, from_microseconds(r[2]), from_microseconds(r[3] + 1)])
+                else:
+                    first = min(l[2], r[2])
+                    last = max(l[3], r[3])
+                    narrowed = [gw_id, from_microseconds(first), from_microseconds(last + 1)]
+                    if max(l[0], r[0]) <= leaf_rows or first == last:
+                        leaves.append(narrowed)
+                    else:
+                        next_work.append(narrowed)
+        log('LEVEL {} {} ranges, {} buckets differ'.format(level, len(work), differ))
+        work = next_work
+
+    pushed = 0
+    pulled = 0
+    if len(push_ranges) > 0:
+        log('PUSH {} ranges only local has'.format(len(push_ranges)))
+        pushed += copy(state, key, 'push', local, remote, push_ranges, None, chunk_size, log)
+    if len(pull_ranges) > 0:
+        log('PULL {} ranges only remote has'.format(len(pull_ranges)))
+        pulled += copy(state, key, 'pull', remote, local, pull_ranges, None, chunk_size, log)
+    if len(leaves) > 0:
+        # small enough to compare row by row
+        local_rows = fetch_rows(local, leaves, chunk_size)
+        remote_rows = fetch_rows(remote, leaves, chunk_size)
+        row_key = lambda row: (row[0], row[3], parse_ts(row[4]))
+        local_keys = set(row_key(row) for row in local_rows)
+        remote_keys = set(row_key(row) for row in remote_rows)
+        missing_remote = [json.dumps(row) for row in local_rows if row_key(row) not in remote_keys]
+        missing_local = [json.dumps(row) for row in remote_rows if row_key(row) not in local_keys]
+        log('COMPARE {} ranges, {} rows missing remote, {} rows missing local'.format(len(leaves), len(missing_remote), len(missing_local)))
+        for i in range(0, len(missing_remote), chunk_size):
+            push_chunk(remote, Chunk(missing_remote[i:i + chunk_size]))
+        for i in range(0, len(missing_local), chunk_size):
+            push_chunk(local, Chunk(missing_local[i:i + chunk_size]))
+        pushed += len(missing_remote)
+        pulled += len(missing_local)
+    return (pushed, pulled)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# tests for the columnar /pull and /push format in wireformat.py
+# run with python3 -m unittest test_wireformat (or pytest) from this directory
+# rows go the whole way a sync takes them: encoded into frames, compressed, read
+# back through DecompressingReader and iterframes() (or split_frames()) and decoded
+
+import io
+import struct
+import datetime
+import unittest
+import wireformat
+
+UTC = datetime.timezone.utc
+
+# (gw_id, gw location, app_id, dev_eui, gw_rx_timestamp, rssi, snr, gps_timestamp, gps location)
+# ids repeat and every delta encoded column goes down as well as up
+ROWS = [
+    ('00112233aabbccdd', (144.9631234, -37.8136276, 41.5), 1, '1122334455667788', datetime.datetime(2019, 1, 3, 22, 48, 16, 80583, tzinfo=UTC), -110, -3.5, datetime.datetime(2019, 1, 3, 22, 48, 15, tzinfo=UTC), (144.9701, -37.8201, 12.25)),
+    ('00112233aabbccdd', (144.9631234, -37.8136276, 41.5), 1, '99aabbccddeeff00', datetime.datetime(2019, 1, 3, 22, 48, 17, tzinfo=UTC), -95, 7.25, datetime.datetime(2019, 1, 3, 22, 48, 17, 500000, tzinfo=UTC), (144.95, -37.83, -2.0)),
+    ('ffeeddccbbaa9988', (-0.1276, 51.5072, 0.0), 2, '1122334455667788', datetime.datetime(2019, 1, 3, 22, 40, 0, tzinfo=UTC), -120, -12.0, datetime.datetime(2019, 1, 3, 22, 39, 59, 999999, tzinfo=UTC), (-0.1301, 51.5, 35.0)),
+    ('00112233aabbccdd', (144.9631234, -37.8136276, 41.5), 1, '1122334455667788', datetime.datetime(2019, 1, 3, 22, 48, 16, 80583, tzinfo=UTC), -110, -3.5, datetime.datetime(2019, 1, 3, 22, 48, 15, tzinfo=UTC), (144.9701, -37.8201, 12.25)),
+]
+
+# a location as hex EWKB with an SRID, the way psycopg2 returns a geography(PointZ, 4326)
+def ewkb(point):
+    return (struct.pack('<BII', 1, 0xa0000001, 4326) + struct.pack('<ddd', *point)).hex()
+
+def ewkt(point):
+    return 'SRID=4326;POINT Z({!r} {!r} {!r})'.format(*point)
+
+# database records, as /pull encodes them
+def records(rows):
+    return [(r[0], ewkb(r[1]), r[2], r[3], r[4], r[5], r[6], r[7], ewkb(r[8])) for r in rows]
+
+# the rows /push gets back from decode_block()
+def decoded(rows):
+    return [[r[0], ewkt(r[1]), r[2], r[3], r[4].isoformat(), r[5], r[6], r[7].isoformat(), ewkt(r[8])] for r in rows]
+
+# a /pull page: two blocks of rows and a continuation
+def body():
+    return wireformat.rows_frame(records(ROWS[:3])) + wireformat.rows_frame(records(ROWS[3:])) + wireformat.continuation_frame('token')
+
+def read_frames(data, encoding, read_size, max_frame=None, max_size=None):
+    stream = wireformat.DecompressingReader(io.BytesIO(data), encoding, read_size, max_size)
+    return list(wireformat.iterframes(stream, max_frame))
+
+class WireFormatTest(unittest.TestCase):
+    def test_block_round_trip(self):
+        self.assertEqual(wireformat.decode_block(wireformat.encode_block(records(ROWS))), decoded(ROWS))
+
+    def test_empty_block(self):
+        self.assertEqual(wireformat.decode_block(wireformat.encode_block([])), [])
+
+    def test_stream_round_trip(self):
+        for encoding in (None, 'identity') + wireformat.ENCODINGS:
+            data = wireformat.compress(body(), encoding)
+            for read_size in (1, 2, 7, 64, 65536):
+                with self.subTest(encoding=encoding, read_size=read_size):
+                    frames = read_frames(data, encoding, read_size)
+                    self.assertEqual([kind for kind, frame in frames], [b'R', b'R', b'C'])
+                    rows = [row for kind, frame in frames if kind == b'R' for row in wireformat.decode_block(frame)]
+                    self.assertEqual(rows, decoded(ROWS))
+                    self.assertEqual(frames[-1][1].decode(), 'token')
+
+    def test_split_frames(self):
+        for encoding in (None,) + wireformat.ENCODINGS:
+            with self.subTest(encoding=encoding):
+                frames, continuation = wireformat.split_frames(wireformat.decompress(wireformat.compress(body(), encoding), encoding))
+                self.assertEqual(continuation, 'token')
+                # frames are kept as they are, ready to be sent on to /push
+                self.assertEqual(b''.join(frames) + wireformat.continuation_frame('token'), body())
+                rows = [row for frame in frames for row in wireformat.decode_block(frame[wireformat.FRAME.size:])]
+                self.assertEqual(rows, decoded(ROWS))
+
+    def test_truncated_frame(self):
+        data = body()
+        # cutting between frames leaves a shorter, valid body
+        boundaries = set()
+        offset = 0
+        for kind, frame in read_frames(data, None, 65536):
+            offset += wireformat.FRAME.size + len(frame)
+            boundaries.add(offset)
+        for end in range(1, len(data)):
+            if end in boundaries:
+                continue
+            with self.subTest(end=end):
+                with self.assertRaises(ValueError):
+                    read_frames(data[:end], None, 65536)
+                with self.assertRaises(ValueError):
+                    wireformat.split_frames(data[:end])
+
+    def test_truncated_compressed_data(self):
+        for encoding in wireformat.ENCODINGS:
+            data = wireformat.compress(body(), encoding)
+            with self.subTest(encoding=encoding):
+                with self.assertRaises(ValueError):
+                    read_frames(data[:len(data) // 2], encoding, 64)
+
+    def test_malformed_block(self):
+        block = wireformat.encode_block(records(ROWS))
+        for data in (block[:-1], block + b'\0', b'\xff\xff\xff\xff'):
+            with self.subTest(data=data[:8]):
+                with self.assertRaises(ValueError):
+                    wireformat.decode_block(data)
+
+    def test_frame_too_large(self):
+        data = body()
+        longest = max(len(frame) for kind, frame in read_frames(data, None, 65536))
+        self.assertEqual(len(read_frames(data, None, 65536, max_frame=longest)), 3)
+        with self.assertRaises(wireformat.TooLarge):
+            read_frames(data, None, 65536, max_frame=longest - 1)
+        # checked from the frame header, before its data is read
+        with self.assertRaises(wireformat.TooLarge):
+            read_frames(wireformat.FRAME.pack(b'R', 1 << 31), None, 65536, max_frame=1 << 20)
+
+    def test_body_too_large(self):
+        for encoding in (None,) + wireformat.ENCODINGS:
+            data = wireformat.compress(body(), encoding)
+            with self.subTest(encoding=encoding):
+                self.assertEqual(len(read_frames(data, encoding, 64, max_size=len(body()))), 3)
+                with self.assertRaises(wireformat.TooLarge):
+                    read_frames(data, encoding, 64, max_size=len(body()) - 1)
+
+    def test_decompression_bomb(self):
+        # 64MB of zeros compresses to about 64kB, reading stops soon after the limit
+        data = wireformat.compress(bytes(64 << 20), 'gzip')
+        stream = wireformat.DecompressingReader(io.BytesIO(data), 'gzip', max_size=1 << 20)
+        with self.assertRaises(wireformat.TooLarge):
+            stream.read(64 << 20)
+        self.assertLess(len(stream.buf), 2 << 20)
+
+    def test_unsupported_encoding(self):
+        with self.assertRaises(ValueError):
+            wireformat.DecompressingReader(io.BytesIO(b''), 'br')
+        with self.assertRaises(ValueError):
+            wireformat.decompress(b'', 'br')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# compact columnar encoding of tracker_data rows for /pull and /push
+# negotiated with Accept/Content-Type: application/x-loratracker-columnar, and
+# compressed with Content-Encoding: zstd (if the zstandard module is installed) or gzip
+#
+# the body is a sequence of frames, each a type byte, a little-endian uint32 length
+# and the frame data:
+#   R: a block of rows
+#   C: a /pull continuation token (utf-8)
+# so /pull can stream one block per database fetch, and /push can load block by block
+#
+# a block of rows is a uint32 row count, the gw_id and dev_eui dictionaries
+# (uint32 count, then uint8 length + ascii for each entry) and then one column after
+# another, every column little-endian int64 except gw_rx_snr (float64):
+#   gw_id, dev_eui: index into the dictionary
+#   app_id, gw_rx_rssi: as is
+#   gw_rx_timestamp: microseconds since 1970, difference from the previous row
+#   gps_timestamp: microseconds after gw_rx_timestamp
+#   gw_location, gps_location: longitude and latitude in 1e-7 degrees and altitude
+#   in mm, each the difference from the previous row
+# rows from /pull are sorted by gateway and time, so the differences are small and
+# mostly repeated, which is what the compression is good at
+# coordinates are rounded to 1e-7 degrees (about 1cm) and altitudes to 1mm
+
+import sys
+import zlib
+import array
+import struct
+import datetime
+
+# zstd is optional, gzip always works
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MIMETYPE = 'application/x-loratracker-columnar'
+
+# supported Content-Encodings, most preferred first
+if zstandard is not None:
+    ENCODINGS = ('zstd', 'gzip')
+else:
+    ENCODINGS = ('gzip',)
+
+FRAME = struct.Struct('<cI')
+COUNT = struct.Struct('<I')
+
+UTC = datetime.timezone.utc
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=UTC)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+DEGREES = 10000000
+MM = 1000
+
+# geography(PointZ, 4326) as hex EWKB, the way psycopg2 returns it, to (x, y, z)
+def parse_ewkb_point(value):
+    data = bytes.fromhex(value)
+    if data[0] == 1:
+        endian = '<'
+    else:
+        endian = '>'
+    geometry_type = struct.unpack_from(endian + 'I', data, 1)[0]
+    offset = 5
+    if geometry_type & 0x20000000:
+        # SRID
+        offset += 4
+    if geometry_type & 0x80000000:
+        return struct.unpack_from(endian + 'ddd', data, offset)
+    x, y = struct.unpack_from(endian + 'dd', data, offset)
+    return (x, y, 0.0)
+
+def _ewkt(x, y, z):
+    return 'SRID=4326;POINT Z({!r} {!r} {!r})'.format(x, y, z)
+
+def _microseconds(ts):
+    return (ts - EPOCH) // MICROSECOND
+
+def _pack(typecode, values):
+    column = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column.tobytes()
+
+def _unpack(typecode, data, offset, count):
+    column = array.array(typecode)
+    end = offset + column.itemsize * count
+    if end > len(data):
+        raise ValueError('truncated columnar block')
+    column.frombytes(data[offset:end])
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return (column, end)
+
+def _deltas(values):
+    previous = 0
+    out = []
+    for value in values:
+        out.append(value - previous)
+        previous = value
+    return out
+
+def _undeltas(deltas):
+    value = 0
+    out = []
+    for delta in deltas:
+        value += delta
+        out.append(value)
+    return out
+
+def _pack_dictionary(entries):
+    out = [COUNT.pack(len(entries))]
+    for entry in entries:
+        encoded = entry.encode('ascii')
+        out.append(bytes((len(encoded),)) + encoded)
+    return b''.join(out)
+
+def _unpack_dictionary(data, offset):
+    count = COUNT.unpack_from(data, offset)[0]
+    offset += COUNT.size
+    entries = []
+    for i in range(count):
+        length = data[offset]
+        entries.append(data[offset + 1:offset + 1 + length].decode('ascii'))
+        offset += 1 + length
+    return (entries, offset)
+
+def _dictionary(values):
+    index = {}
+    for value in values:
+        if value not in index:
+            index[value] = len(index)
+    return (list(index), [index[value] for value in values])
+
+# encode database records (gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp,
+# gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location) as a block of rows, locations
+# as hex EWKB and timestamps as aware datetimes
+def encode_block(records):
+    gw_ids, gw_index = _dictionary([r[0] for r in records])
+    dev_euis, dev_index = _dictionary([r[3] for r in records])
+    rx_ts = [_microseconds(r[4]) for r in records]
+    gw_points = [parse_ewkb_point(r[1]) for r in records]
+    gps_points = [parse_ewkb_point(r[8]) for r in records]
+    columns = [
+        COUNT.pack(len(records)),
+        _pack_dictionary(gw_ids),
+        _pack_dictionary(dev_euis),
+        _pack('q', gw_index),
+        _pack('q', dev_index),
+        _pack('q', [r[2] for r in records]),
+        _pack('q', _deltas(rx_ts)),
+        _pack('q', [r[5] for r in records]),
+        _pack('d', [r[6] for r in records]),
+        _pack('q', [_microseconds(r[7]) - ts for r, ts in zip(records, rx_ts)]),
+    ]
+    for points in (gw_points, gps_points):
+        columns.append(_pack('q', _deltas([round(p[0] * DEGREES) for p in points])))
+        columns.append(_pack('q', _deltas([round(p[1] * DEGREES) for p in points])))
+        columns.append(_pack('q', _deltas([round(p[2] * MM) for p in points])))
+    return b''.join(columns)
+
+# decode a block of rows into the same 9 column rows /push accepts as JSON, with
+# locations as EWKT and timestamps as ISO 8601 strings
+# raises ValueError for a malformed block
+def decode_block(data):
+    try:
+        return _decode_block(data)
+    except (IndexError, OverflowError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError('malformed columnar block: {!r}'.format(e))
+
+def _decode_block(data):
+    count = COUNT.unpack_from(data, 0)[0]
+    gw_ids, offset = _unpack_dictionary(data, COUNT.size)
+    dev_euis, offset = _unpack_dictionary(data, offset)
+    gw_index, offset = _unpack('q', data, offset, count)
+    dev_index, offset = _unpack('q', data, offset, count)
+    app_id, offset = _unpack('q', data, offset, count)
+    rx_ts, offset = _unpack('q', data, offset, count)
+    rssi, offset = _unpack('q', data, offset, count)
+    snr, offset = _unpack('d', data, offset, count)
+    gps_ts, offset = _unpack('q', data, offset, count)
+    locations = []
+    for i in range(6):
+        column, offset = _unpack('q', data, offset, count)
+        locations.append(_undeltas(column))
+    if offset != len(data):
+        raise ValueError('malformed columnar block')
+    rx_ts = _undeltas(rx_ts)
+
+    rows = []
+    for i in range(count):
+        rows.append([
+            gw_ids[gw_index[i]],
+            _ewkt(locations[0][i] / DEGREES, locations[1][i] / DEGREES, locations[2][i] / MM),
+            app_id[i],
+            dev_euis[dev_index[i]],
+            (EPOCH + rx_ts[i] * MICROSECOND).isoformat(),
+            rssi[i],
+            snr[i],
+            (EPOCH + (rx_ts[i] + gps_ts[i]) * MICROSECOND).isoformat(),
+            _ewkt(locations[3][i] / DEGREES, locations[4][i] / DEGREES, locations[5][i] / MM),
+        ])
+    return rows
+
+def rows_frame(records):
+    block = encode_block(records)
+    return FRAME.pack(b'R', len(block)) + block
+
+def continuation_frame(token):
+    data = token.encode()
+    return FRAME.pack(b'C', len(data)) + data
+
+# split an uncompressed body into frames, returns (row block frames, continuation)
+# row block frames are returned still framed, ready to be sent on to /push
+def split_frames(data):
+    frames = []
+    continuation = None
+    offset = 0
+    while offset < len(data):
+        if offset + FRAME.size > len(data):
+            raise ValueError('truncated frame')
+        kind, length = FRAME.unpack_from(data, offset)
+        end = offset + FRAME.size + length
+        if end > len(data):
+            raise ValueError('truncated frame')
+        if kind == b'R':
+            frames.append(data[offset:end])
+        elif kind == b'C':
+            continuation = data[offset + FRAME.size:end].decode()
+        offset = end
+    return (frames, continuation)
+
+# raised by iterframes() and DecompressingReader when a body is over the given limits
+class TooLarge(ValueError):
+    pass
+
+# yield (kind, data) for each frame read from a file-like stream of decompressed data
+# frames longer than max_frame bytes (if given) raise TooLarge before they are read
+def iterframes(stream, max_frame=None):
+    while True:
+        header = stream.read(FRAME.size)
+        if len(header) == 0:
+            return
+        if len(header) < FRAME.size:
+            raise ValueError('truncated frame')
+        kind, length = FRAME.unpack(header)
+        if max_frame is not None and length > max_frame:
+            raise TooLarge('{} byte frame, the limit is {}'.format(length, max_frame))
+        data = stream.read(length)
+        if len(data) < length:
+            raise ValueError('truncated frame')
+        yield (kind, data)
+
+# first of the client's accepted encodings we support, from an Accept-Encoding
+# header value, or None for no compression
+def choose_encoding(accept_encoding):
+    accepted = [e.split(';')[0].strip().lower() for e in (accept_encoding or '').split(',')]
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+# streaming compressor for encoding (None for no compression)
+# compress() flushes, so each frame can be sent (and decoded) as soon as it is ready
+class Compressor(object):
+    def __init__(self, encoding):
+        if encoding == 'zstd':
+            self.obj = zstandard.ZstdCompressor().compressobj()
+            self.sync = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        elif encoding == 'gzip':
+            self.obj = zlib.compressobj(6, zlib.DEFLATED, 31)
+            self.sync = zlib.Z_SYNC_FLUSH
+        else:
+            self.obj = None
+
+    def compress(self, data):
+        if self.obj is None:
+            return data
+        return self.obj.compress(data) + self.obj.flush(self.sync)
+
+    def flush(self):
+        if self.obj is None:
+            return b''
+        return self.obj.flush()
+
+def compress(data, encoding):
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+# raises ValueError for an unsupported encoding or malformed data, like DecompressingReader
+def decompress(data, encoding):
+    if encoding in (None, '', 'identity'):
+        return data
+    if encoding not in ENCODINGS:
+        raise ValueError('unsupported Content-Encoding {}'.format(encoding))
+    try:
+        if encoding == 'zstd':
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        return zlib.decompress(data, 31)
+    except Exception as e:
+        # zlib.error or zstandard.ZstdError
+        raise ValueError('malformed compressed data: {}'.format(e))
+
+# file-like object that decompresses a stream as it is read
+# at most read_size bytes are decompressed at a time, so a small, highly compressed
+# body can't expand in memory all at once, and more than max_size decompressed bytes
+# (if given) raise TooLarge
+class DecompressingReader(object):
+    def __init__(self, stream, encoding, read_size=65536, max_size=None):
+        self.stream = stream
+        self.read_size = read_size
+        self.max_size = max_size
+        self.total = 0
+        self.buf = bytearray()
+        self.pos = 0
+        self.eof = False
+        self.reader = None
+        self.obj = None
+        if encoding in (None, '', 'identity'):
+            pass
+        elif encoding not in ENCODINGS:
+            raise ValueError('unsupported Content-Encoding {}'.format(encoding))
+        elif encoding == 'zstd':
+            self.reader = zstandard.ZstdDecompressor().stream_reader(stream, read_size=read_size)
+        else:
+            self.obj = zlib.decompressobj(31)
+
+    # next piece of decompressed data, sets eof at the end of the stream
+    # a piece of compressed data can decompress to nothing, so b'' is not the end
+    def _fill(self):
+        if self.reader is None and self.obj is None:
+            data = self.stream.read(self.read_size)
+            self.eof = not data
+            return data
+        data = b''
+        if self.obj is not None and not self.obj.unconsumed_tail:
+            data = self.stream.read(self.read_size)
+        try:
+            if self.reader is not None:
+                data = self.reader.read(self.read_size)
+                self.eof = not data
+                return data
+            if self.obj.unconsumed_tail:
+                return self.obj.decompress(self.obj.unconsumed_tail, self.read_size)
+            if data:
+                return self.obj.decompress(data, self.read_size)
+            data = self.obj.flush()
+        except Exception as e:
+            # zlib.error or zstandard.ZstdError
+            raise ValueError('malformed compressed data: {}'.format(e))
+        if not self.obj.eof:
+            raise ValueError('truncated compressed data')
+        self.eof = True
+        return data
+
+    def read(self, size):
+        if len(self.buf) - self.pos < size and not self.eof:
+            # drop what has been read once per call, not once per piece
+            del self.buf[:self.pos]
+            self.pos = 0
+        while len(self.buf) - self.pos < size and not self.eof:
+            data = self._fill()
+            self.total += len(data)
+            if self.max_size is not None and self.total > self.max_size:
+                raise TooLarge('over {} bytes decompressed'.format(self.max_size))
+            self.buf += data
+        out = bytes(self.buf[self.pos:self.pos + size])
+        self.pos += len(out)
+        return out
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# asyncio uplink server for lora-apiserver.py --asyncio
+# one event loop on one core, HTTP/1.1 keep-alive so loraserver's HTTP integration
+# can reuse its connection, an asyncpg connection pool, a cap on uplinks being
+# written at once, and logging done by a background thread so a slow terminal
+# never stalls the event loop
+# needs asyncpg (apt install python3-asyncpg, or pip3 install asyncpg), except with
+# --batch, where every write goes through the batch writer's psycopg2 connection
+
+import json
+import queue
+import asyncio
+import logging
+import logging.handlers
+import batchwriter
+import uplinkdecode
+
+log = logging.getLogger('lora-apiserver')
+
+INSERT_SQL = """INSERT INTO tracker_data (gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location)
+    VALUES ($1, ST_SetSRID(st_makepoint($2,$3,$4),4326), $5, $6, $7, $8, $9, $10, ST_SetSRID(st_makepoint($11,$12,$13),4326))
+    ON CONFLICT DO NOTHING;"""
+
+MAX_CONTENT_LENGTH = 4096
+MAX_HEADER_LINES = 100
+
+REASONS = {
+    200: 'OK',
+    204: 'No Content',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    408: 'Request Timeout',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    415: 'Unsupported Media Type',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+# asyncpg's binary protocol wants real floats where the SQL says float8,
+# but JSON gives ints for whole numbers
+def _insert_args(row):
+    return (row[0], float(row[1]), float(row[2]), float(row[3]), row[4], row[5], row[6], row[7], float(row[8]), row[9], float(row[10]), float(row[11]), float(row[12]))
+
+# send log records through a queue to a background thread
+def setup_logging(verbose):
+    records = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = logging.handlers.QueueListener(records, handler)
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(logging.DEBUG if verbose else logging.INFO)
+    listener.start()
+    return listener
+
+class UplinkServer(object):
+    def __init__(self, pool, max_concurrency, keepalive_timeout, writer=None, request_timeout=10):
+        self.pool = pool # asyncpg pool, None when every write goes through writer
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout # seconds for the headers and body after the request line
+        self.writer = writer # optional common/batchwriter.py BatchWriter
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                keep_alive = await self.handle_request(reader, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    # handle one request, returns True if the connection can be kept open
+    async def handle_request(self, reader, writer):
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+        except asyncio.TimeoutError:
+            # idle keep-alive connection
+            return False
+        if not line:
+            return False
+        try:
+            method, path, version = line.decode('latin-1').split()
+        except ValueError:
+            await self.respond(writer, 400, False)
+            return False
+
+        # a client trickling in its headers or body (slowloris) gets 408, not a
+        # connection held open for as long as it likes
+        deadline = asyncio.get_event_loop().time() + self.request_timeout
+        headers = {}
+        try:
+            for i in range(MAX_HEADER_LINES):
+                line = await self.before(deadline, reader.readline())
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().casefold()] = value.strip()
+            else:
+                await self.respond(writer, 400, False)
+                return False
+        except asyncio.TimeoutError:
+            await self.respond(writer, 408, False)
+            return False
+
+        connection = headers.get('connection', '').casefold()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        if method != 'POST':
+            await self.respond(writer, 405, False, [('Allow', 'POST')])
+            return False
+        if 'transfer-encoding' in headers or 'content-length' not in headers:
+            # check for a content length header
+            await self.respond(writer, 411, False)
+            return False
+        try:
+            content_length = int(headers['content-length'])
+        except ValueError:
+            await self.respond(writer, 400, False)
+            return False
+        if content_length > MAX_CONTENT_LENGTH:
+            # check that content length is 4096 bytes or less
+            await self.respond(writer, 413, False)
+            return False
+        # read the body before any other checks so the connection stays in step
+        try:
+            body = await self.before(deadline, reader.readexactly(content_length))
+        except asyncio.TimeoutError:
+            await self.respond(writer, 408, False)
+            return False
+        if headers.get('content-type', '').casefold() != 'application/json':
+            # check content type is JSON
+            await self.respond(writer, 415, keep_alive)
+            return keep_alive
+        if path != '/uplink':
+            await self.respond(writer, 404, keep_alive)
+            return keep_alive
+
+        try:
+            payload = json.loads(body.decode())
+            row = uplinkdecode.decode_uplink(payload)
+        except (UnicodeDecodeError, ValueError):
+            # includes json and uplinkdecode.DecodeError
+            await self.respond(writer, 400, keep_alive)
+            return keep_alive
+        log.debug('uplink %s', payload)
+
+        status, inserted = await self.store(row)
+        if status == 200:
+            # same response as /uplink in flask-apiserver
+            body = json.dumps({'inserted': inserted, 'skipped': 1 - inserted}).encode()
+            await self.respond(writer, status, keep_alive, [('Content-Type', 'application/json')], body)
+        else:
+            await self.respond(writer, status, keep_alive)
+        return keep_alive
+
+    # await a read, raising asyncio.TimeoutError if it isn't done by deadline (event loop time)
+    def before(self, deadline, awaitable):
+        return asyncio.wait_for(awaitable, max(deadline - asyncio.get_event_loop().time(), 0))
+
+    # write one uplink to the database, returns (HTTP status, rows inserted)
+    # an uplink that is already there (a loraserver retry) inserts 0 rows
+    async def store(self, row):
+        async with self.slots:
+            try:
+                if self.writer is not None:
+                    # the group-commit writer blocks, so wait for it in a worker thread
+                    inserted = await asyncio.get_event_loop().run_in_executor(None, self.writer.submit, row)
+                    if inserted is None:
+                        # "queued" durability, not written yet
+                        return (204, None)
+                    return (200, int(inserted))
+                # status is eg. "INSERT 0 1"
+                status = await self.pool.execute(INSERT_SQL, *_insert_args(row))
+                return (200, int(status.split()[-1]))
+            except batchwriter.QueueFull:
+                return (503, None)
+            except Exception as e:
+                # WriteFailed, or any asyncpg error
+                log.error('insert failed: %s', e)
+                return (500, None)
+
+    async def respond(self, writer, status, keep_alive, headers=(), body=b''):
+        lines = ['HTTP/1.1 {} {}'.format(status, REASONS[status]), 'Content-Length: {}'.format(len(body))]
+        if status == 204:
+            # 204 must not have a body or a content length
+            lines.pop()
+        lines.append('Connection: keep-alive' if keep_alive else 'Connection: close')
+        for name, value in headers:
+            lines.append('{}: {}'.format(name, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+async def serve(args, writer=None):
+    pool = None
+    if writer is None:
+        import asyncpg
+        pool = await asyncpg.create_pool(
+            database=args.database, user=args.dbuser, password=args.dbpass, host=args.dbhost, port=args.dbport,
+            min_size=1, max_size=args.pool_size,
+        )
+    server = UplinkServer(pool, args.max_concurrency, args.keepalive_timeout, writer, args.request_timeout)
+    httpd = await asyncio.start_server(server.handle_connection, args.listen, args.port, backlog=1024)
+    log.info('listening on %s port %s', args.listen, args.port)
+    async with httpd:
+        await httpd.serve_forever()
+
+def run(args, writer=None):
+    listener = setup_logging(args.verbose)
+    try:
+        asyncio.run(serve(args, writer))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# one-off cleanup of duplicate tracker_data rows in databases created before the
+# natural key (gw_id, dev_eui, gw_rx_timestamp) was unique, eg.
+# dedup-tracker-data.py -n   to count the duplicates
+# dedup-tracker-data.py      to delete them and create idx_td_natural_key
+# of each set of duplicates the first row stored is kept
+# duplicates are deleted one gateway per transaction so the API servers keep running,
+# then tracker_data is locked against writes (reads still work) while any duplicates
+# written in the meantime are deleted and the unique index is built
+# the API servers skip duplicates with ON CONFLICT DO NOTHING once the index exists,
+# and can be upgraded before or after this is run
+
+# make sure running on python3
+import sys
+assert (sys.version_info[0] == 3), "This code requires python3"
+
+# handle arguments
+import argparse
+parser = argparse.ArgumentParser(description='tracker_data duplicate cleanup')
+
+parser.add_argument('-d', '--database',
+                    type=str,
+                    default="loratracker",
+                    help='Database name to connect to (default loratracker)',
+)
+
+parser.add_argument('-H', '--dbhost',
+                    type=str,
+                    default=None,
+                    help='Database IP host to connect to (default None - use local socket)',
+)
+
+parser.add_argument('-O', '--dbport',
+                    type=int,
+                    default=5432,
+                    help='Database TCP Port to connect to (default 5432)',
+)
+
+parser.add_argument('-U', '--dbuser',
+                    type=str,
+                    default=None,
+                    help='Database user name to use (default same as database name)',
+)
+
+parser.add_argument('-P', '--dbpass',
+                    type=str,
+                    default=None,
+                    help='Database password to use (default no password)',
+)
+
+parser.add_argument('-n', '--dry-run',
+                    action='store_true',
+                    help='Only count the duplicates, change nothing',
+)
+
+args = parser.parse_args()
+
+dbname = args.database
+dbuser = args.dbuser
+if dbuser == None:
+    dbuser = dbname
+
+# every row after the first with the same natural key, as (tableoid, ctid) so it also
+# works on a partitioned tracker_data
+DUPLICATES_SQL = """SELECT tableoid, ctid FROM (
+    SELECT tableoid, ctid, row_number() OVER (PARTITION BY gw_id, dev_eui, gw_rx_timestamp ORDER BY tableoid, ctid) AS n
+    FROM tracker_data
+    {where}
+) AS d
+WHERE n > 1"""
+
+DELETE_SQL = """DELETE FROM tracker_data td
+USING ({duplicates}) AS dup
+WHERE td.tableoid = dup.tableoid AND td.ctid = dup.ctid;"""
+
+import psycopg2
+dbconn = psycopg2.connect(dbname=dbname, user=dbuser, password=args.dbpass, host=args.dbhost, port=args.dbport)
+cur = dbconn.cursor()
+
+cur.execute("SELECT to_regclass('idx_td_natural_key') IS NOT NULL;")
+if cur.fetchone()[0]:
+    print('idx_td_natural_key already exists, tracker_data has no duplicates')
+    sys.exit(0)
+
+cur.execute("SELECT DISTINCT gw_id FROM tracker_data ORDER BY gw_id;")
+gateways = [record[0] for record in cur]
+dbconn.commit()
+
+total = 0
+for gw_id in gateways:
+    if args.dry_run:
+        cur.execute("SELECT count(*) FROM (" + DUPLICATES_SQL.format(where='WHERE gw_id = %s') + ") AS dup;", (gw_id,))
+        count = cur.fetchone()[0]
+    else:
+        cur.execute(DELETE_SQL.format(duplicates=DUPLICATES_SQL.format(where='WHERE gw_id = %s')), (gw_id,))
+        count = cur.rowcount
+    dbconn.commit()
+    if count > 0:
+        print('gateway {}: {} duplicates'.format(gw_id, count))
+    total += count
+
+if args.dry_run:
+    print('{} duplicate rows'.format(total))
+    sys.exit(0)
+print('deleted {} duplicate rows'.format(total))
+
+# one transaction: no new duplicates can be written between the last delete and the index
+cur.execute("LOCK TABLE tracker_data IN SHARE MODE;")
+cur.execute(DELETE_SQL.format(duplicates=DUPLICATES_SQL.format(where='')))
+if cur.rowcount > 0:
+    print('deleted {} duplicate rows written during the cleanup'.format(cur.rowcount))
+print('creating idx_td_natural_key')
+cur.execute("CREATE UNIQUE INDEX idx_td_natural_key ON tracker_data (gw_id, gw_rx_timestamp, dev_eui);")
+# superseded by the natural key index
+cur.execute("DROP INDEX IF EXISTS idx_td_gateway_timestamp;")
+dbconn.commit()
+
+dbconn.close()
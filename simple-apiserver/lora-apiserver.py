@@ -56,11 +56,80 @@ parser.add_argument('-P', '--dbpass',
                     help='Database password to use (default no password)',
 )
 
+parser.add_argument('-b', '--batch',
+                    action='store_true',
+                    help='Queue uplinks for a background group-commit writer instead of one INSERT per uplink',
+)
+
+parser.add_argument('--batch-size',
+                    type=int,
+                    default=500,
+                    help='Maximum rows per COPY/commit in batch mode (default 500)',
+)
+
+parser.add_argument('--batch-delay',
+                    type=float,
+                    default=0.2,
+                    help='Maximum seconds an uplink waits for its batch to fill in batch mode (default 0.2)',
+)
+
+parser.add_argument('--queue-size',
+                    type=int,
+                    default=10000,
+                    help='Maximum queued uplinks in batch mode (default 10000)',
+)
+
+parser.add_argument('--durability',
+                    type=str,
+                    choices=['queued', 'committed'],
+                    default='committed',
+                    help='Acknowledge uplinks once queued or once committed in batch mode (default committed)',
+)
+
+parser.add_argument('--stats-interval',
+                    type=int,
+                    default=60,
+                    help='Seconds between batch writer statistics lines (default 60)',
+)
+
+parser.add_argument('-a', '--asyncio',
+                    action='store_true',
+                    help='Serve with a single asyncio event loop, HTTP keep-alive and an asyncpg connection pool',
+)
+
+parser.add_argument('--pool-size',
+                    type=int,
+                    default=10,
+                    help='Maximum database connections in asyncio mode, unused with --batch (default 10)',
+)
+
+parser.add_argument('--max-concurrency',
+                    type=int,
+                    default=100,
+                    help='Maximum uplinks being written at once in asyncio mode (default 100)',
+)
+
+parser.add_argument('--keepalive-timeout',
+                    type=float,
+                    default=75,
+                    help='Seconds an idle keep-alive connection stays open in asyncio mode (default 75)',
+)
+
+parser.add_argument('--request-timeout',
+                    type=float,
+                    default=10,
+                    help='Seconds a client has to send the headers and body of a request in asyncio mode, or it gets HTTP 408 (default 10)',
+)
+
+parser.add_argument('-v', '--verbose',
+                    action='store_true',
+                    help='Log every uplink payload in asyncio mode',
+)
+
 args = parser.parse_args()
 
+import os
 import json
-import datetime
-import base64
 import http.server
 
 dbname = args.database
@@ -71,8 +140,32 @@ dbpass = args.dbpass
 
 if dbuser == None:
     dbuser = dbname
+    args.dbuser = dbuser
+
+# modules shared with flask-apiserver live in ../common
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import batchwriter
+import uplinkdecode
 
 import psycopg2
+
+writer = None
+if args.batch:
+    writer = batchwriter.BatchWriter(
+        lambda: psycopg2.connect(dbname=dbname, user=dbuser, password=dbpass, host=dbhost, port=dbport),
+        batch_size=args.batch_size,
+        max_delay=args.batch_delay,
+        queue_size=args.queue_size,
+        durability=args.durability,
+        stats_interval=args.stats_interval,
+    )
+
+if args.asyncio:
+    # see asyncserver.py, replaces the thread-per-request server below
+    import asyncserver
+    asyncserver.run(args, writer)
+    sys.exit(0)
+
 dbconn = psycopg2.connect(dbname=dbname, user=dbuser, password=dbpass, host=dbhost, port=dbport)
 dbconn.autocommit = True
 
@@ -100,48 +193,49 @@ class CustomHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         print(self.path)
         print(payload)
         if(self.path == '/uplink'):
-            # handle uplink data
-            app_id = payload['applicationID']
-            dev_eui = payload['devEUI']
-            gw_id = payload['rxInfo'][0]['gatewayID']
-            gw_lat = payload['rxInfo'][0]['location']['latitude']
-            gw_lon = payload['rxInfo'][0]['location']['longitude']
-            gw_alt = payload['rxInfo'][0]['location']['altitude']
-            gw_rx_time = payload['rxInfo'][0]['time']
-            gw_rx_rssi = payload['rxInfo'][0]['rssi']
-            gw_rx_snr = payload['rxInfo'][0]['loRaSNR']
-            uplink_data = base64.decodebytes(payload['data'].encode())
-
-            # uplink_data is the byte stream coming out of the tracker
-            # output is 20 bytes of packed data (5 x 32bit words):
-            # long i_lat: decimal latitude millionths - divide by 1,000,000 for decimal
-            # long i_lon: decimal longitude millionths
-            # long i_alt: cm above sea level - divide by 100 for decimal M
-            # u_long gps_date: date stamp of GPS in DDMMYY
-            # u_long gps_time: time stamp of GPS in HHMMSSff - divide by 100 for decimal S
-            
-            f_lat = int.from_bytes(uplink_data[0:4], byteorder='big', signed=True) / 1000000
-            f_lon = int.from_bytes(uplink_data[4:8], byteorder='big', signed=True) / 1000000
-            f_alt = int.from_bytes(uplink_data[8:12], byteorder='big', signed=True) / 100
-            gps_date = int.from_bytes(uplink_data[12:16], byteorder='big', signed=False)
-            gps_time = int.from_bytes(uplink_data[16:20], byteorder='big', signed=False)
-
-            gw_rx_timestamp = datetime.datetime.strptime(gw_rx_time, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=datetime.timezone.utc)
-            if gps_time == 0:
-                # LoRa packet received without GPS fix, insert a dummy timestamp
-                gps_timestamp = datetime.datetime.min().replace(tzinfo=datetime.timezone.utc)
-            else:
-                gps_timestamp = datetime.datetime.strptime("{0:0>6} {1:0>8}".format(gps_date, gps_time), '%d%m%y %H%M%S%f').replace(tzinfo=datetime.timezone.utc)
+            # handle uplink data, see common/uplinkdecode.py
+            try:
+                row = uplinkdecode.decode_uplink(payload)
+            except uplinkdecode.DecodeError:
+                self.send_error(400)
+                return
+
+            if writer is not None:
+                # hand off to the group-commit writer
+                try:
+                    inserted = writer.submit(row)
+                except batchwriter.QueueFull:
+                    self.send_error(503)
+                    return
+                except batchwriter.WriteFailed:
+                    self.send_error(500)
+                    return
+                if inserted is None:
+                    # "queued" durability, not written yet
+                    self.send_response(204)
+                    self.end_headers()
+                    return
+                self.send_inserted(int(inserted))
+                return
 
             # insert into the db
+            # a retried uplink that is already there inserts nothing
             cur.execute("""INSERT INTO tracker_data (gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location) 
-                VALUES (%s, ST_SetSRID(st_makepoint(%s,%s,%s),4326), %s, %s, %s, %s, %s, %s, ST_SetSRID(st_makepoint(%s,%s,%s),4326));""", 
-                (gw_id, gw_lat, gw_lon, gw_alt, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, f_lat, f_lon, f_alt)
+                VALUES (%s, ST_SetSRID(st_makepoint(%s,%s,%s),4326), %s, %s, %s, %s, %s, %s, ST_SetSRID(st_makepoint(%s,%s,%s),4326))
+                ON CONFLICT DO NOTHING;""", 
+                row
             )
-            self.send_response(204)
-            self.end_headers()
+            self.send_inserted(cur.rowcount)
         else:
             self.send_error(404)
+    # same response as /uplink in flask-apiserver
+    def send_inserted(self, inserted):
+        body = json.dumps({'inserted': inserted, 'skipped': 1 - inserted}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
     def _Err405(self):
         self.send_response(405)
         self.send_header('Allow','POST')
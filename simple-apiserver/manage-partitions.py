@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# tracker_data partition management, see partitions.pgsql
+# run daily from cron to create upcoming partitions and expire old ones, eg.
+# manage-partitions.py -g month -a 3 -r '13 months'
+# or once with --migrate to convert an existing plain tracker_data table
+
+# make sure running on python3
+import sys
+assert (sys.version_info[0] == 3), "This code requires python3"
+
+# handle arguments
+import argparse
+parser = argparse.ArgumentParser(description='tracker_data partition management')
+
+parser.add_argument('-d', '--database',
+                    type=str,
+                    default="loratracker",
+                    help='Database name to connect to (default loratracker)',
+)
+
+parser.add_argument('-H', '--dbhost',
+                    type=str,
+                    default=None,
+                    help='Database IP host to connect to (default None - use local socket)',
+)
+
+parser.add_argument('-O', '--dbport',
+                    type=int,
+                    default=5432,
+                    help='Database TCP Port to connect to (default 5432)',
+)
+
+parser.add_argument('-U', '--dbuser',
+                    type=str,
+                    default=None,
+                    help='Database user name to use (default same as database name)',
+)
+
+parser.add_argument('-P', '--dbpass',
+                    type=str,
+                    default=None,
+                    help='Database password to use (default no password)',
+)
+
+parser.add_argument('-g', '--granularity',
+                    type=str,
+                    choices=['month', 'day'],
+                    default='month',
+                    help='Size of new partitions (default month)',
+)
+
+parser.add_argument('-a', '--ahead',
+                    type=int,
+                    default=3,
+                    help='Number of future partitions to keep created (default 3)',
+)
+
+parser.add_argument('-r', '--retention',
+                    type=str,
+                    default=None,
+                    help='Expire partitions that ended longer ago than this PostgreSQL interval, eg. "13 months" (default keep everything)',
+)
+
+parser.add_argument('--detach-only',
+                    action='store_true',
+                    help='Detach expired partitions but keep them as plain tables, eg. for archiving',
+)
+
+parser.add_argument('--migrate',
+                    action='store_true',
+                    help='Convert a plain tracker_data table to a partitioned one first',
+)
+
+args = parser.parse_args()
+
+dbname = args.database
+dbuser = args.dbuser
+if dbuser == None:
+    dbuser = dbname
+
+import psycopg2
+dbconn = psycopg2.connect(dbname=dbname, user=dbuser, password=args.dbpass, host=args.dbhost, port=args.dbport)
+cur = dbconn.cursor()
+
+cur.execute("SELECT relkind FROM pg_class WHERE oid = 'tracker_data'::regclass;")
+partitioned = cur.fetchone()[0] == 'p'
+
+if partitioned:
+    cur.execute("SELECT create_tracker_data_partitions(%s, %s);", (args.granularity, args.ahead))
+elif args.migrate:
+    # one transaction, tracker_data is locked until it commits
+    cur.execute("SELECT partition_tracker_data(%s, %s);", (args.granularity, args.ahead))
+else:
+    print('tracker_data is not partitioned, run with --migrate to convert it', file=sys.stderr)
+    sys.exit(1)
+for record in cur:
+    print('created {}'.format(record[0]))
+dbconn.commit()
+
+if args.retention is not None:
+    cur.execute("SELECT expire_tracker_data_partitions(%s::interval, %s);", (args.retention, args.detach_only))
+    for record in cur:
+        if args.detach_only:
+            print('detached {}'.format(record[0]))
+        else:
+            print('dropped {}'.format(record[0]))
+    dbconn.commit()
+
+dbconn.close()
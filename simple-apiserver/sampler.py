@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# weighted random values for simulate-data.py and simengine.py
+# the (minimum, 25%, 50%, 75%, maximum) parameters of the simulator's wrand() are
+# interpolated over 100 steps, and one step picked with weights rising 1 to 50 up to
+# the median and falling back to 1 at the top
+# Sampler works out the cumulative weights once per parameter set and draws by
+# inverse CDF, instead of building a list of every step repeated by its weight (about
+# 2,500 items) on every call
+
+import bisect
+import itertools
+
+# numpy is only needed to draw many values at once
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Sampler(object):
+    def __init__(self, minimum, q1, half, q3, maximum):
+        self.params = (minimum, q1, half, q3, maximum)
+        self.values = []
+        self.weights = []
+        weight = 0
+        # interpolate over 100 steps
+        for i in range(100):
+            if i < 50:
+                weight += 1
+            elif i > 50:
+                weight -= 1
+            if i < 25:
+                cur = minimum + (q1 - minimum) / 25 * i
+            elif i < 50:
+                cur = q1 + (half - q1) / 25 * (i - 25)
+            elif i < 75:
+                cur = half + (q3 - half) / 25 * (i - 50)
+            else:
+                cur = q3 + (maximum - q3) / 25 * (i - 75)
+            self.values.append(cur)
+            self.weights.append(weight)
+        # integers, so the CDF is exact
+        self.cdf = list(itertools.accumulate(self.weights))
+        self.total = self.cdf[-1]
+        self.minimum = min(self.values)
+        self.maximum = max(self.values)
+        if numpy is not None:
+            self.values_array = numpy.array(self.values)
+            self.weights_array = numpy.array(self.weights)
+            self.cdf_array = numpy.array(self.cdf)
+
+    # one value with rng.random() (the random module, a random.Random or a numpy
+    # Generator), or n values as a numpy array with a numpy Generator
+    def sample(self, rng, n=None):
+        if n is None:
+            return self.values[bisect.bisect_right(self.cdf, rng.random() * self.total)]
+        if numpy is None:
+            raise RuntimeError('Sampler.sample(rng, n) needs numpy')
+        return self.values_array[numpy.searchsorted(self.cdf_array, rng.random(n) * self.total, 'right')]
+
+    # expected value of f(value), f takes and returns numpy arrays
+    def expect(self, f=None):
+        values = self.values_array if f is None else f(self.values_array)
+        return float((self.weights_array * values).sum() / self.total)
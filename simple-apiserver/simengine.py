@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# in-memory simulation engine for simulate-data.py --engine numpy
+# the same model as the SQL engine in simulate-data.py, but every tracker and
+# gateway is held in numpy arrays and moved with vectorized geodesy, instead of a
+# ST_Project() and UPDATE round trip to PostGIS per entity per tick
+# and instead of stepping every entity once a second, it jumps from event to event
+# (chirps, gateways starting and stopping), so run time follows the number of
+# chirps rather than simulated seconds times entities
+# only the generated tracker_data rows leave it, see simoutput.py
+#
+# geodesy is on a sphere of the mean earth radius, PostGIS geography uses the
+# WGS84 spheroid, distances differ by at most about 0.5%
+
+import heapq
+import numpy
+from sampler import Sampler
+
+EARTH_RADIUS = 6371008.8 # mean radius (M)
+
+# heading change of every step, the same as the SQL engine
+JITTER = (-45, -5, 0, 5, 45)
+
+# signal of a heard chirp, log-distance path loss from a 14 dBm tracker with
+# lognormal fading, and the SNR over the noise floor of a 125 kHz channel
+# (the SQL engine writes 0 for both)
+TX_POWER = 14 # dBm
+PATH_LOSS_1M = 31.7 # dB at 1 M, 915 MHz
+PATH_LOSS_EXPONENT = 2.7
+FADING = 4.0 # dB standard deviation
+NOISE_FLOOR = -117.0 # dBm
+SNR_RANGE = (-20.0, 10.0) # as reported by the concentrator, in 0.25 dB steps
+
+# gateway events, at the same time starts go first, as in the SQL engine
+START = 0
+STOP = 1
+
+# great circle distance (M) between points, in degrees
+def distance(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = (numpy.radians(v) for v in (lon1, lat1, lon2, lat2))
+    a = numpy.sin((lat2 - lat1) / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+# initial bearing (degrees, 0 to 360, clockwise from north) from point 1 to point 2,
+# like degrees(ST_Azimuth())
+def azimuth(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = (numpy.radians(v) for v in (lon1, lat1, lon2, lat2))
+    y = numpy.sin(lon2 - lon1) * numpy.cos(lat2)
+    x = numpy.cos(lat1) * numpy.sin(lat2) - numpy.sin(lat1) * numpy.cos(lat2) * numpy.cos(lon2 - lon1)
+    return numpy.degrees(numpy.arctan2(y, x)) % 360
+
+# point distance (M) away from (lon, lat) along bearing (degrees), like ST_Project()
+# returns (lon, lat)
+def project(lon, lat, dist, bearing):
+    lon, lat, bearing = (numpy.radians(v) for v in (lon, lat, bearing))
+    delta = numpy.asarray(dist) / EARTH_RADIUS
+    lat2 = numpy.arcsin(numpy.sin(lat) * numpy.cos(delta) + numpy.cos(lat) * numpy.sin(delta) * numpy.cos(bearing))
+    lon2 = lon + numpy.arctan2(numpy.sin(bearing) * numpy.sin(delta) * numpy.cos(lat), numpy.cos(delta) - numpy.sin(lat) * numpy.sin(lat2))
+    return ((numpy.degrees(lon2) + 180) % 360 - 180, numpy.degrees(lat2))
+
+# grid hash of points for nearest neighbour queries
+# cells are cell_size (M) high and as many degrees wide, narrower in metres away
+# from the equator, searches take in more columns to make up for it
+# searches start with the cells next to the query and double their radius for the
+# queries that haven't found anything yet, so dense areas stay cheap
+# points are inserted and removed one at a time as they start and stop moving, the
+# sorted arrays that searches use are rebuilt on the next query after a change
+class GridIndex(object):
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cell = numpy.degrees(cell_size / EARTH_RADIUS) # degrees
+        self.columns = int(numpy.ceil(360 / self.cell))
+        self.points = {} # id: (lon, lat)
+        self.dirty = True
+
+    def __len__(self):
+        return len(self.points)
+
+    def insert(self, i, lon, lat):
+        self.points[i] = (lon, lat)
+        self.dirty = True
+
+    def remove(self, i):
+        del self.points[i]
+        self.dirty = True
+
+    def keys(self, lon, lat):
+        return ((lat + 90) // self.cell).astype(int) * self.columns + (((lon + 180) % 360) // self.cell).astype(int)
+
+    # points sorted by cell key, so each cell is one slice
+    def build(self):
+        if len(self.points) > 0:
+            ids = numpy.fromiter(self.points, dtype=int, count=len(self.points))
+            lon, lat = numpy.array(list(self.points.values())).T
+        else:
+            ids = numpy.empty(0, dtype=int)
+            lon = lat = numpy.empty(0)
+        keys = self.keys(lon, lat)
+        order = numpy.argsort(keys, kind='stable')
+        self.sorted_keys = keys[order]
+        self.sorted_ids = ids[order]
+        self.sorted_lon = lon[order]
+        self.sorted_lat = lat[order]
+        self.dirty = False
+
+    # closest point to each of the (lon, lat) arrays within max_distance (M, default
+    # anywhere), returns (ids, distances), -1 and inf where there is none
+    def nearest(self, lon, lat, max_distance=None):
+        if self.dirty:
+            self.build()
+        lon = numpy.asarray(lon, dtype=float)
+        lat = numpy.asarray(lat, dtype=float)
+        found = numpy.full(len(lon), -1)
+        dist = numpy.full(len(lon), numpy.inf)
+        # everything is in range at half way round the earth
+        max_distance = min(max_distance or numpy.inf, numpy.pi * EARTH_RADIUS)
+        pending = numpy.arange(len(lon))
+        radius = min(self.cell_size, max_distance)
+        while len(pending) > 0 and len(self.sorted_ids) > 0:
+            f, d = self.search(lon[pending], lat[pending], radius)
+            done = f >= 0
+            found[pending[done]] = f[done]
+            dist[pending[done]] = d[done]
+            pending = pending[~done]
+            if radius >= max_distance:
+                break
+            radius = min(radius * 2, max_distance)
+        return (found, dist)
+
+    # closest point within radius (M) of each query, like nearest()
+    def search(self, lon, lat, radius):
+        found = numpy.full(len(lon), -1)
+        dist = numpy.full(len(lon), numpy.inf)
+
+        # cells to look in around each query
+        dlat = numpy.degrees(radius / EARTH_RADIUS)
+        edge = numpy.abs(lat).max() + dlat
+        row_span = int(numpy.ceil(dlat / self.cell))
+        if edge < 89:
+            column_span = int(numpy.ceil(dlat / numpy.cos(numpy.radians(edge)) / self.cell))
+        else:
+            column_span = self.columns
+        stencil = (2 * row_span + 1) * (2 * column_span + 1)
+        if stencil > len(self.sorted_ids) or 2 * column_span + 1 >= self.columns:
+            # a wider search than there are points, compare with every point instead
+            query = numpy.repeat(numpy.arange(len(lon)), len(self.sorted_ids))
+            point = numpy.tile(numpy.arange(len(self.sorted_ids)), len(lon))
+        else:
+            rows = ((lat + 90) // self.cell).astype(int)
+            columns = (((lon + 180) % 360) // self.cell).astype(int)
+            dr, dc = numpy.meshgrid(numpy.arange(-row_span, row_span + 1), numpy.arange(-column_span, column_span + 1))
+            keys = (rows[:, None] + dr.ravel()[None, :]) * self.columns + (columns[:, None] + dc.ravel()[None, :]) % self.columns
+            start = numpy.searchsorted(self.sorted_keys, keys.ravel(), 'left')
+            counts = numpy.searchsorted(self.sorted_keys, keys.ravel(), 'right') - start
+            # one (query, point) pair for every point in every cell looked in
+            query = numpy.repeat(numpy.repeat(numpy.arange(len(lon)), stencil), counts)
+            offsets = numpy.cumsum(counts) - counts
+            point = numpy.arange(counts.sum()) - numpy.repeat(offsets - start, counts)
+        d = distance(lon[query], lat[query], self.sorted_lon[point], self.sorted_lat[point])
+        within = d <= radius
+        query, point, d = query[within], point[within], d[within]
+        # the closest pair of each query
+        order = numpy.lexsort((d, query))
+        first = numpy.unique(query[order], return_index=True)[1]
+        closest = order[first]
+        found[query[closest]] = self.sorted_ids[point[closest]]
+        dist[query[closest]] = d[closest]
+        return (found, dist)
+
+# a random walk of one step per second (the SQL engine's tick), each step a
+# distance from the speed Sampler and a heading change from the jitter Sampler
+# the sum of n steps is close to normal, so a walk over any length of time is
+# sampled in one go from the mean and variance of a single step
+class Walk(object):
+    def __init__(self, speeds, jitter):
+        cos = jitter.expect(lambda v: numpy.cos(numpy.radians(v)))
+        cos2 = jitter.expect(lambda v: numpy.cos(numpy.radians(v)) ** 2)
+        sin2 = jitter.expect(lambda v: numpy.sin(numpy.radians(v)) ** 2)
+        speed2 = speeds.expect(lambda v: v ** 2)
+        self.forward = speeds.expect() * cos
+        self.forward_var = speed2 * cos2 - self.forward ** 2
+        self.sideways_var = speed2 * sin2
+
+    # (distance, bearing change) after walks of seconds, the mean distance if not random
+    def sample(self, seconds, rng=None):
+        seconds = numpy.maximum(seconds, 0)
+        forward = self.forward * seconds
+        if rng is None:
+            return (forward, numpy.zeros_like(forward))
+        forward = forward + rng.standard_normal(len(seconds)) * numpy.sqrt(self.forward_var * seconds)
+        sideways = rng.standard_normal(len(seconds)) * numpy.sqrt(self.sideways_var * seconds)
+        return (numpy.hypot(forward, sideways), numpy.degrees(numpy.arctan2(sideways, forward)))
+
+# discrete event simulation of the same model as the SQL engine
+# events are tracker chirps and gateways starting and stopping moving, kept in
+# heaps, positions are only worked out when an event needs them
+# chirps of different trackers don't affect each other, so all chirps up to the
+# next gateway event are handled together
+# gateways draw from gw_rng (default the same Generator as the trackers), so shards
+# that simulate different trackers with the same gateway seed move the gateways the
+# same way, see simulate-data.py --shards
+# in a shard (shared is set) a gateway that starts moving can't see every tracker,
+# so it heads for the furthest of its shard's trackers and is left in unresolved
+# until resolve() gives it the direction to the furthest of all shards' trackers,
+# run() stops before such a gateway stops moving to let that happen
+class Simulation(object):
+    def __init__(self, args, rng=None, gw_rng=None, shared=False):
+        self.args = args # simulate-data.py arguments
+        # seeded with --seed unless given a Generator
+        self.rng = rng if rng is not None else numpy.random.default_rng(args.seed)
+        self.gw_rng = gw_rng if gw_rng is not None else self.rng
+        self.shared = shared
+        self.unresolved = {} # gateway: (distance, direction) to the furthest tracker of this shard
+        self.now = 0.0 # seconds since the start of the simulation
+        self.samplers = {}
+
+        self.gw_id = []
+        self.gw_lon = numpy.empty(0)
+        self.gw_lat = numpy.empty(0)
+        self.gw_alt = numpy.empty(0)
+        self.gw_rx = numpy.empty(0, dtype=bool)
+        self.gw_dir = numpy.empty(0)
+        self.gw_since = numpy.empty(0) # time the gateway started moving
+        self.gw_events = [] # heap of (time, STOP or START, gateway)
+        # gateways with RX enabled, which stand still
+        self.gw_index = GridIndex(args.gwmaxrange / 4)
+
+        # trackers were at (lon, lat) at time since, and walk along dir from there
+        self.tr_id = []
+        self.tr_lon = numpy.empty(0)
+        self.tr_lat = numpy.empty(0)
+        self.tr_alt = numpy.empty(0)
+        self.tr_since = numpy.empty(0)
+        self.tr_dir = numpy.empty(0)
+        self.chirps = [] # heap of (time, tracker)
+
+        self.tr_walk = Walk(self.sampler(args.trackerspeed), self.sampler(JITTER))
+        self.gw_walk = Walk(self.sampler(args.gwspeed), self.sampler(JITTER))
+
+    def sampler(self, params):
+        params = tuple(params)
+        if params not in self.samplers:
+            self.samplers[params] = Sampler(*params)
+        return self.samplers[params]
+
+    # n samples of wrand(*params), from the trackers' Generator unless given another
+    def wrand(self, params, n, rng=None):
+        return self.sampler(params).sample(self.rng if rng is None else rng, n)
+
+    def random_id(self, rng):
+        return '{:016x}'.format(int(rng.integers(2**64, dtype=numpy.uint64)))
+
+    def add_gateway(self, gw_id, lon, lat, alt):
+        g = len(self.gw_id)
+        self.gw_id.append(gw_id)
+        self.gw_lon = numpy.append(self.gw_lon, lon)
+        self.gw_lat = numpy.append(self.gw_lat, lat)
+        self.gw_alt = numpy.append(self.gw_alt, alt)
+        self.gw_rx = numpy.append(self.gw_rx, True)
+        self.gw_dir = numpy.append(self.gw_dir, 0.0)
+        self.gw_since = numpy.append(self.gw_since, self.now)
+        self.gw_index.insert(g, lon, lat)
+        # use a fully random time so we don't have a simultaneous gateway march
+        self.schedule_move(g, self.now + self.gw_rng.integers(self.args.gwdwell[4]))
+
+    def schedule_move(self, g, start):
+        heapq.heappush(self.gw_events, (start, START, g))
+        heapq.heappush(self.gw_events, (start + self.wrand(self.args.gwtime, 1, self.gw_rng)[0], STOP, g))
+
+    # new gateways a random distance away from a random existing gateway
+    def add_random_gateways(self, count):
+        for i in range(count):
+            src = self.gw_rng.integers(len(self.gw_id))
+            lon, lat = project(self.gw_lon[src], self.gw_lat[src], self.wrand(self.args.gwradius, 1, self.gw_rng)[0], self.gw_rng.random() * 360)
+            self.add_gateway(self.random_id(self.gw_rng), lon, lat, 0.0)
+
+    def add_tracker(self, dev_eui, lon, lat, alt):
+        t = len(self.tr_id)
+        self.tr_id.append(dev_eui)
+        self.tr_lon = numpy.append(self.tr_lon, lon)
+        self.tr_lat = numpy.append(self.tr_lat, lat)
+        self.tr_alt = numpy.append(self.tr_alt, alt)
+        self.tr_since = numpy.append(self.tr_since, self.now)
+        self.tr_dir = numpy.append(self.tr_dir, self.rng.random() * 360)
+        # use a fully random time so we don't have a simultaneous tracker chirp
+        heapq.heappush(self.chirps, (self.now + self.rng.integers(self.args.trackertime[4]), t))
+
+    # new trackers within range of a random gateway
+    def add_random_trackers(self, count):
+        for i in range(count):
+            src = self.rng.integers(len(self.gw_id))
+            lon, lat = project(self.gw_lon[src], self.gw_lat[src], self.rng.integers(self.args.gwmaxrange), self.rng.random() * 360)
+            self.add_tracker(self.random_id(self.rng), lon, lat, 0.0)
+
+    # positions of trackers at times, and if move is set make them the new starting points
+    # without rng the mean position, which doesn't change the walk
+    def tracker_positions(self, trackers, times, rng=None, move=False):
+        dist, turn = self.tr_walk.sample(times - self.tr_since[trackers], rng)
+        lon, lat = project(self.tr_lon[trackers], self.tr_lat[trackers], dist, self.tr_dir[trackers] + turn)
+        if move:
+            self.tr_lon[trackers] = lon
+            self.tr_lat[trackers] = lat
+            self.tr_since[trackers] = times
+        return (lon, lat)
+
+    # run the simulation until end (seconds since the start)
+    # yields the rows of the chirps that were heard, in time order, with times as
+    # seconds since the start of the simulation:
+    # [(gw_id, gw_lon, gw_lat, gw_alt, dev_eui, gw_rx_time, gw_rx_rssi, gw_rx_snr, lon, lat, alt)]
+    def run(self, end):
+        # a chirp schedules the next one at least this long after it, so windows this
+        # long can be handled at once and still come out in time order
+        # with a minimum of 0 each batch is the chirps of a single timestamp
+        window = self.sampler(self.args.trackertime).minimum
+        while True:
+            next_gw = self.gw_events[0][0] if len(self.gw_events) > 0 else numpy.inf
+            if len(self.chirps) > 0 and self.chirps[0][0] < next_gw and self.chirps[0][0] <= end:
+                first = self.chirps[0][0]
+                until = min(next_gw, first + window)
+                batch = []
+                while len(self.chirps) > 0 and (self.chirps[0][0] < until or self.chirps[0][0] == first) and self.chirps[0][0] <= end:
+                    batch.append(heapq.heappop(self.chirps))
+                times, trackers = numpy.array(batch).T
+                self.now = times[-1]
+                yield self.chirp(trackers.astype(int), times)
+            elif next_gw <= end:
+                if self.gw_events[0][1] == STOP and self.gw_events[0][2] in self.unresolved:
+                    # wait for resolve()
+                    self.now = next_gw
+                    return
+                self.now, kind, g = heapq.heappop(self.gw_events)
+                if kind == START:
+                    self.start_move(g)
+                else:
+                    self.stop_move(g)
+            else:
+                self.now = end
+                return
+
+    # chirp trackers at times, returns the rows of the chirps that were heard
+    def chirp(self, trackers, times):
+        args = self.args
+        lon, lat = self.tracker_positions(trackers, times, self.rng, move=True)
+        rows = []
+
+        # closest gateway with RX enabled
+        nearest, d = self.gw_index.nearest(lon, lat, args.gwmaxrange)
+        heard = nearest >= 0
+        rssi, snr = self.signal(d[heard])
+        for i, rx_rssi, rx_snr in zip(numpy.flatnonzero(heard), rssi, snr):
+            g = nearest[i]
+            t = trackers[i]
+            rows.append((
+                self.gw_id[g], float(self.gw_lon[g]), float(self.gw_lat[g]), float(self.gw_alt[g]),
+                self.tr_id[t], float(times[i]), int(rx_rssi), float(rx_snr),
+                float(lon[i]), float(lat[i]), float(self.tr_alt[t]),
+            ))
+
+        # all gateways too far away to hear the chirp
+        # 50% chance tracker will turn towards the closest gateway
+        turn = numpy.flatnonzero(~heard & (self.rng.random(len(trackers)) >= 0.5))
+        closest, d = self.gw_index.nearest(lon[turn], lat[turn])
+        turn, closest = turn[closest >= 0], closest[closest >= 0]
+        self.tr_dir[trackers[turn]] = azimuth(lon[turn], lat[turn], self.gw_lon[closest], self.gw_lat[closest])
+
+        for t, time in zip(trackers, times + self.wrand(args.trackertime, len(trackers))):
+            heapq.heappush(self.chirps, (time, t))
+        return rows
+
+    # (rssi, snr) of chirps heard dist (M) away
+    def signal(self, dist):
+        loss = PATH_LOSS_1M + 10 * PATH_LOSS_EXPONENT * numpy.log10(numpy.maximum(dist, 1.0))
+        rssi = numpy.round(TX_POWER - loss + self.rng.standard_normal(len(dist)) * FADING)
+        snr = numpy.clip(numpy.round((rssi - NOISE_FLOOR) * 4) / 4, *SNR_RANGE)
+        return (rssi, snr)
+
+    # gateway started moving, disable RX and set direction to furthest tracker
+    def start_move(self, g):
+        if len(self.tr_id) > 0:
+            trackers = numpy.arange(len(self.tr_id))
+            lon, lat = self.tracker_positions(trackers, numpy.full(len(trackers), self.now))
+            d = distance(self.gw_lon[g], self.gw_lat[g], lon, lat)
+            furthest = d.argmax()
+            self.gw_dir[g] = azimuth(self.gw_lon[g], self.gw_lat[g], lon[furthest], lat[furthest])
+            if self.shared:
+                self.unresolved[g] = (float(d[furthest]), float(self.gw_dir[g]))
+        elif self.shared:
+            self.unresolved[g] = (-1.0, float(self.gw_dir[g]))
+        self.gw_rx[g] = False
+        self.gw_since[g] = self.now
+        self.gw_index.remove(g)
+
+    # directions of unresolved gateways, {gateway: direction}, see furthest()
+    def resolve(self, directions):
+        for g, direction in directions.items():
+            self.gw_dir[g] = direction
+        self.unresolved = {}
+
+    # gateway finished moving, enable RX, and set new move time
+    def stop_move(self, g):
+        dist, turn = self.gw_walk.sample(numpy.array([self.now - self.gw_since[g]]), self.gw_rng)
+        lon, lat = project(self.gw_lon[g], self.gw_lat[g], dist[0], self.gw_dir[g] + turn[0])
+        self.gw_lon[g] = lon
+        self.gw_lat[g] = lat
+        self.gw_rx[g] = True
+        self.gw_index.insert(g, lon, lat)
+        self.schedule_move(g, self.now + self.wrand(self.args.gwdwell, 1, self.gw_rng)[0])
+
+# the direction of each gateway in the shards' unresolved to the furthest tracker of
+# all of them, [{gateway: (distance, direction)}] to {gateway: direction}
+# a shard without trackers offers a distance of -1 and the direction the gateway had
+def furthest(unresolved):
+    best = {}
+    for shard in unresolved:
+        for g, (d, direction) in shard.items():
+            if g not in best or d > best[g][0]:
+                best[g] = (d, direction)
+    return {g: direction for g, (d, direction) in best.items()}
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf_8 -*-
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# where simulate-data.py --engine numpy sends its rows, see --output
+# every output takes lists of rows in the tracker_data row layout of
+# common/uplinkdecode.py, in gw_rx_timestamp order, with write(), and close() at the end:
+# (gw_id, gw_lon, gw_lat, gw_alt, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, lon, lat, alt)
+# - insert: multi-row INSERT into tracker_data, one commit per write()
+# - copy: COPY through the common/batchwriter.py staging table, one commit per write()
+# - ndjson: one loraserver uplink JSON message per line, to replay or load test with
+# - http: POST each uplink to an API server's /uplink when it was received, or
+#   speed times faster, over a few keep-alive connections
+
+import io
+import sys
+import json
+import time
+import queue
+import threading
+import collections
+import http.client
+import urllib.parse
+import uplinkdecode
+
+# psycopg2 is only needed by the database outputs
+try:
+    import psycopg2.extras
+    import batchwriter
+except ImportError:
+    psycopg2 = batchwriter = None
+
+class InsertOutput(object):
+    def __init__(self, dbconn):
+        self.dbconn = dbconn
+        self.cur = dbconn.cursor()
+
+    def write(self, rows):
+        psycopg2.extras.execute_values(self.cur, """INSERT INTO tracker_data (gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location)
+            VALUES %s
+            ON CONFLICT DO NOTHING;""",
+            rows,
+            template='(%s, ST_SetSRID(st_makepoint(%s,%s,%s),4326), %s, %s, %s, %s, %s, %s, ST_SetSRID(st_makepoint(%s,%s,%s),4326))',
+            page_size=len(rows),
+        )
+        self.dbconn.commit()
+
+    def close(self):
+        pass
+
+# rows already in tracker_data are skipped by the merge, like batch mode in the API servers
+class CopyOutput(object):
+    def __init__(self, dbconn):
+        self.dbconn = dbconn
+        self.cur = dbconn.cursor()
+        self.cur.execute(batchwriter.STAGE_SQL)
+        dbconn.commit()
+
+    def write(self, rows):
+        self.cur.copy_expert(batchwriter.COPY_SQL, io.StringIO(''.join(batchwriter.copy_line(row) for row in rows)))
+        self.cur.execute(batchwriter.MERGE_SQL)
+        self.dbconn.commit()
+
+    def close(self):
+        pass
+
+# path - is stdout
+class NDJSONOutput(object):
+    def __init__(self, path):
+        if path == '-':
+            self.f = sys.stdout
+        else:
+            self.f = open(path, 'w')
+
+    def write(self, rows):
+        self.f.write(''.join(json.dumps(uplinkdecode.encode_uplink(row), separators=(',', ':')) + '\n' for row in rows))
+
+    def close(self):
+        if self.f is sys.stdout:
+            self.f.flush()
+        else:
+            self.f.close()
+
+# the first row is sent straight away, every other row when its gw_rx_timestamp is
+# due after the first one's, divided by speed (0 sends as fast as possible)
+# or with origin (gw_rx_timestamp, time.monotonic()), each row when it is due after
+# that, so several processes replaying parts of one simulation keep in step
+# write() blocks while queue_size uplinks are waiting, so the simulation never gets
+# far ahead of the replay
+class ReplayOutput(object):
+    def __init__(self, url, speed=1.0, connections=4, queue_size=10000, timeout=30, origin=None, log=print):
+        url = urllib.parse.urlsplit(url)
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path or '/uplink'
+        self.https = url.scheme == 'https'
+        self.speed = speed
+        self.timeout = timeout
+        self.log = log
+        self.queue = queue.Queue(queue_size)
+        self.first = origin # (gw_rx_timestamp, time.monotonic()) of the first row
+
+        self.lock = threading.Lock()
+        self.responses = collections.Counter() # status (or the exception name): count
+        self.latency = 0.0 # total seconds waiting for responses
+        self.late = 0.0 # most seconds an uplink was sent behind time
+
+        self.threads = [threading.Thread(target=self._run, daemon=True) for i in range(connections)]
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, rows):
+        for row in rows:
+            if self.first is None:
+                self.first = (row[6], time.monotonic())
+            due = 0
+            if self.speed > 0:
+                due = self.first[1] + (row[6] - self.first[0]).total_seconds() / self.speed
+            self.queue.put((due, json.dumps(uplinkdecode.encode_uplink(row)).encode()))
+
+    def _connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            due, body = item
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            sent = time.monotonic()
+            try:
+                conn.request('POST', self.path, body, {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException) as e:
+                # reconnect for the next uplink, this one is counted as failed
+                conn.close()
+                conn = self._connect()
+                status = type(e).__name__
+            with self.lock:
+                self.responses[status] += 1
+                self.latency += time.monotonic() - sent
+                if due > 0:
+                    self.late = max(self.late, sent - due)
+        conn.close()
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        sent = sum(self.responses.values())
+        seconds = time.monotonic() - self.first[1] if self.first is not None else 0
+        self.log('replay sent={} seconds={:.1f} rate={:.1f}/s latency={:.1f}ms late={:.1f}s responses={}'.format(
+            sent, seconds, sent / seconds if seconds > 0 else 0, self.latency * 1000 / sent if sent > 0 else 0, self.late,
+            ' '.join('{}:{}'.format(status, count) for status, count in sorted(self.responses.items(), key=str)),
+        ))
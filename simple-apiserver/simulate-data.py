@@ -179,7 +179,69 @@ parser.add_argument('-X', '--delete-existing-data',
                     help='Delete any existing tracker data (recommended if using existing tracer/gateway locations)',
 )
 
+parser.add_argument('-E', '--engine',
+                    type=str,
+                    choices=['sql', 'numpy'],
+                    default='sql',
+                    help='Simulate in PostGIS (sql), or in memory and only write tracker_data (numpy, much faster, needs numpy) (default sql)',
+)
+
+parser.add_argument('-b', '--batch-size',
+                    type=int,
+                    default=1000,
+                    help='Rows per INSERT or COPY and commit, or per write to --output, with --engine numpy (default 1000)',
+)
+
+parser.add_argument('--seed',
+                    type=int,
+                    default=None,
+                    help='Random seed, the same seed and arguments simulate the same rows (default random)',
+)
+
+parser.add_argument('-j', '--shards',
+                    type=int,
+                    default=1,
+                    help='Processes to run --engine numpy in, each simulates a share of the trackers and writes its own rows (default 1)',
+)
+
+parser.add_argument('--output',
+                    type=str,
+                    choices=['insert', 'copy', 'ndjson', 'http'],
+                    default='insert',
+                    help='Where --engine numpy writes its rows: INSERT or COPY into tracker_data, loraserver uplink JSON lines to --file, or POST them to --url in real time (default insert)',
+)
+
+parser.add_argument('--file',
+                    type=str,
+                    default='-',
+                    help='File to write with --output ndjson (default - for stdout)',
+)
+
+parser.add_argument('--url',
+                    type=str,
+                    default='http://127.0.0.1:8088/uplink',
+                    help='API server /uplink URL for --output http (default http://127.0.0.1:8088/uplink)',
+)
+
+parser.add_argument('--speed',
+                    type=float,
+                    default=1.0,
+                    help='Replay speed for --output http, times real time, 0 for as fast as possible (default 1)',
+)
+
+parser.add_argument('--connections',
+                    type=int,
+                    default=4,
+                    help='Concurrent connections for --output http (default 4)',
+)
+
 args = parser.parse_args()
+if args.engine != 'numpy' and args.output != 'insert':
+    parser.error('--output {} needs --engine numpy'.format(args.output))
+if args.engine != 'numpy' and args.shards != 1:
+    parser.error('--shards needs --engine numpy')
+if args.shards > 1 and args.output == 'ndjson' and args.file == '-':
+    parser.error('--shards with --output ndjson needs --file')
 
 gateways = args.gateway_id
 trackers = args.tracker_eui
@@ -193,44 +255,195 @@ dbpass = args.dbpass
 if dbuser == None:
     dbuser = dbname
 
-# DB connection
-import psycopg2
-dbconn = psycopg2.connect(dbname=dbname, user=dbuser, password=dbpass, host=dbhost, port=dbport)
-dbconn.autocommit = False
-cur = dbconn.cursor()
+# DB connection, not needed to write uplinks to a file or an API server unless
+# existing gateways or trackers are simulated
+dbconn = None
+if args.output in ('insert', 'copy') or len(gateways) > 0 or len(trackers) > 0:
+    import psycopg2
+    dbconn = psycopg2.connect(dbname=dbname, user=dbuser, password=dbpass, host=dbhost, port=dbport)
+    dbconn.autocommit = False
+    cur = dbconn.cursor()
 
-# roll-your-own weighted random function
+# weighted random values, one Sampler per parameter set, see sampler.py
 import random
-random.seed()
-def wrand(min,q1,half,q3,max):
-    weight = 0
-    a = []
-    # interpolate over 100 steps
-    for i in range(100):
-        if i < 50:
-            weight += 1
-        elif i > 50:
-            weight -= 1
-        if i < 25:
-            step = (q1 - min) / 25
-            cur = min + (step * i)
-        elif i < 50:
-            step = (half - q1) / 25
-            cur = q1 + (step * (i - 25))
-        elif i < 75:
-            step = (q3 - half) / 25
-            cur = half + (step * (i - 50))
-        else:
-            step = (max - q3) / 25
-            cur = q3 + (step * (i - 75))
-        for j in range(weight):
-            a.append(cur)
-    return(a[random.randrange(len(a))])
+import sampler
+random.seed(args.seed)
+samplers = {}
+def wrand(*params):
+    if params not in samplers:
+        samplers[params] = sampler.Sampler(*params)
+    return samplers[params].sample(random)
 
 # find simulation start time
 from datetime import datetime, timezone, timedelta
 sim_end = datetime.utcnow().replace(tzinfo=timezone.utc)
 sim_cur = sim_end - timedelta(seconds=3600 * args.runtime)
+
+if args.engine == 'numpy':
+    # see simengine.py, replaces the sim_gateway/sim_tracker tables below
+    # and simoutput.py for where the rows go
+    import os
+    import time
+    import numpy
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+    import simengine
+    import simoutput
+    sim_start = sim_cur
+
+    # progress goes to stderr when the uplinks go to stdout
+    status = sys.stdout
+    if args.output == 'ndjson' and args.file == '-':
+        status = sys.stderr
+
+    # gateways and trackers that already exist, as (id, lon, lat, alt)
+    existing_gateways = []
+    for gateway in gateways:
+        cur.execute("""SELECT ST_X(gw_location::geometry), ST_Y(gw_location::geometry), coalesce(ST_Z(gw_location::geometry), 0)
+            FROM gateway_latest
+            WHERE gw_id = %s;""",
+            (gateway,)
+        )
+        if cur.rowcount == 0:
+            raise ValueError('-G {} not found'.format(gateway))
+        existing_gateways.append((gateway,) + cur.fetchone())
+    existing_trackers = []
+    for tracker in trackers:
+        cur.execute("""SELECT ST_X(gps_location::geometry), ST_Y(gps_location::geometry), coalesce(ST_Z(gps_location::geometry), 0)
+            FROM tracker_latest
+            WHERE dev_eui = %s;""",
+            (tracker,)
+        )
+        if cur.rowcount == 0:
+            raise ValueError('-T {} not found'.format(tracker))
+        existing_trackers.append((tracker,) + cur.fetchone())
+    if dbconn is not None:
+        dbconn.commit()
+
+    # the simulation of trackers (existing ones plus count random ones), and of all gateways
+    def build(trackers, count, rng=None, gw_rng=None, shared=False):
+        sim = simengine.Simulation(args, rng, gw_rng, shared)
+        for gateway in existing_gateways:
+            sim.add_gateway(*gateway)
+        if len(existing_gateways) == 0:
+            # the first gateway at the supplied lat/long
+            sim.add_gateway(sim.random_id(sim.gw_rng), args.gwlon, args.gwlat, args.gwalt)
+        sim.add_random_gateways(args.gateways - len(sim.gw_id))
+        for tracker in trackers:
+            sim.add_tracker(*tracker)
+        sim.add_random_trackers(count)
+        return sim
+
+    # shard None is the only process, and can use the connection already open
+    def open_output(shard=None, origin=None):
+        if args.output in ('insert', 'copy'):
+            conn = dbconn
+            if shard is not None:
+                conn = psycopg2.connect(dbname=dbname, user=dbuser, password=dbpass, host=dbhost, port=dbport)
+                conn.autocommit = False
+            if args.output == 'insert':
+                return simoutput.InsertOutput(conn)
+            return simoutput.CopyOutput(conn)
+        if args.output == 'ndjson':
+            if shard is None:
+                return simoutput.NDJSONOutput(args.file)
+            # one file per shard, eg. out.ndjson to out.0.ndjson, out.1.ndjson...
+            root, ext = os.path.splitext(args.file)
+            return simoutput.NDJSONOutput('{}.{}{}'.format(root, shard, ext))
+        return simoutput.ReplayOutput(args.url, args.speed, args.connections, origin=origin, log=lambda message: print(message, file=status))
+
+    # simengine rows to the tracker_data row layout of common/uplinkdecode.py
+    def uplink_rows(chirps):
+        rows = []
+        for gw_id, gw_lon, gw_lat, gw_alt, dev_eui, rx_time, rssi, snr, lon, lat, alt in chirps:
+            ts = sim_start + timedelta(seconds=rx_time)
+            rows.append((gw_id, gw_lon, gw_lat, gw_alt, 1, dev_eui, ts, rssi, snr, ts.replace(microsecond=0), lon, lat, alt))
+        return rows
+
+    # run the simulation to the end, returns the number of rows written
+    # sync(sim.unresolved) returns the directions for sim.resolve() in a shard
+    def simulate(sim, output, sync=None, name='sim'):
+        end = (sim_end - sim_start).total_seconds()
+        total = 0
+        rows = []
+        while True:
+            for chirps in sim.run(end):
+                rows.extend(uplink_rows(chirps))
+                if len(rows) >= args.batch_size:
+                    output.write(rows)
+                    total += len(rows)
+                    rows = []
+                    print("{} timestamp={} rows={}".format(name, sim_start + timedelta(seconds=sim.now), total), file=status)
+            if len(sim.unresolved) == 0:
+                break
+            sim.resolve(sync(sim.unresolved))
+        if len(rows) > 0:
+            output.write(rows)
+            total += len(rows)
+        output.close()
+        return total
+
+    if args.shards == 1:
+        total = simulate(build(existing_trackers, args.trackers - len(existing_trackers)), open_output())
+        print("sim finished rows={}".format(total), file=status)
+        sys.exit(0)
+
+    # sharded: every shard process simulates its share of the trackers and all of the
+    # gateways, with the same gateway seed so the gateways move the same way in all
+    # of them, and writes its own rows in parallel
+    # at each point where a gateway that started moving needs the direction to the
+    # furthest of all trackers, the shards send theirs here and get the furthest back
+    import multiprocessing
+    context = multiprocessing.get_context('fork') # shards share the setup above
+    seeds = numpy.random.SeedSequence(args.seed).spawn(args.shards + 1)
+    random_trackers = args.trackers - len(existing_trackers)
+    if dbconn is not None:
+        # forked copies of the connection would close it under us when they exit
+        dbconn.close()
+        dbconn = None
+    origin = (sim_start, time.monotonic()) # common start for --output http
+
+    def run_shard(shard, conn):
+        def sync(unresolved):
+            conn.send(unresolved)
+            return conn.recv()
+        sim = build(
+            existing_trackers[shard::args.shards],
+            random_trackers // args.shards + (1 if shard < random_trackers % args.shards else 0),
+            numpy.random.default_rng(seeds[shard + 1]), numpy.random.default_rng(seeds[0]), shared=True,
+        )
+        conn.send(simulate(sim, open_output(shard, origin), sync, 'shard {}'.format(shard)))
+
+    pipes = []
+    processes = []
+    for shard in range(args.shards):
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=run_shard, args=(shard, child_conn))
+        process.start()
+        child_conn.close()
+        pipes.append(parent_conn)
+        processes.append(process)
+    try:
+        while True:
+            # EOFError if a shard died
+            messages = [conn.recv() for conn in pipes]
+            if all(isinstance(message, int) for message in messages):
+                break
+            if any(isinstance(message, int) for message in messages):
+                # they all see the same gateway events, so this is a bug
+                raise RuntimeError('simulation shards out of step')
+            directions = simengine.furthest(messages)
+            for conn in pipes:
+                conn.send(directions)
+    except EOFError:
+        for process in processes:
+            process.terminate()
+        print("sim shard failed", file=sys.stderr)
+        sys.exit(1)
+    for process in processes:
+        process.join()
+    print("sim finished rows={} shards={}".format(sum(messages), args.shards), file=status)
+    sys.exit(0)
+
 # create temp table to store gateways
 cur.execute("DROP TABLE IF EXISTS sim_gateway;")
 cur.execute("""CREATE TABLE sim_gateway (
@@ -246,10 +459,9 @@ dbconn.commit()
 
 # create gateways that already exist
 for gateway in gateways:
-    cur.execute("""SELECT DISTINCT ON (gw_id) gw_id, gw_location
-        FROM tracker_data
-        WHERE gw_id = %s
-        ORDER BY gw_id, gw_rx_timestamp DESC;""",
+    cur.execute("""SELECT gw_id, gw_location
+        FROM gateway_latest
+        WHERE gw_id = %s;""",
         (gateway,)
     )
     if cur.rowcount == 0:
@@ -297,10 +509,9 @@ dbconn.commit()
 
 # create trackers that already exist
 for tracker in trackers:
-    cur.execute("""SELECT DISTINCT ON (dev_eui) dev_eui, gps_location
-        FROM tracker_data
-        WHERE dev_eui = %s
-        ORDER BY dev_eui, gps_timestamp DESC;""",
+    cur.execute("""SELECT dev_eui, gps_location
+        FROM tracker_latest
+        WHERE dev_eui = %s;""",
         (tracker,)
     )
     if cur.rowcount == 0:
@@ -349,7 +560,8 @@ while sim_cur <= sim_end:
         else:
             # send a chirp to the closest gateway
             c2.execute("""INSERT INTO tracker_data (gw_id, gw_location, app_id, dev_eui, gw_rx_timestamp, gw_rx_rssi, gw_rx_snr, gps_timestamp, gps_location) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);""", 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT DO NOTHING;""", 
                 (chirp_data[0], chirp_data[1], 1, tracker, sim_cur, 0, 0, sim_cur.replace(microsecond=0), chirp_data[3])
             )
         tr_nextchirptime = sim_cur + timedelta(seconds=wrand(*args.trackertime))